@@ -0,0 +1,88 @@
+import numpy as np
+
+
+def _character_lookup(characters):
+    lookup = np.zeros(256, dtype=bool)
+    lookup[np.frombuffer(characters.encode('ascii'), dtype=np.uint8)] = True
+    return lookup
+
+# Characters found only in insert columns of HMM alignments: lower case
+# residues, and in hmmalign output '.' gaps.
+INSERT_CHARACTERS = _character_lookup('abcdefghijklmnopqrstuvwxyz')
+INSERT_OR_INSERT_GAP_CHARACTERS = _character_lookup('abcdefghijklmnopqrstuvwxyz.')
+GAP_CHARACTERS = _character_lookup('-')
+
+
+def alignment_matrix(aligned_sequences):
+    '''Return a 2D numpy uint8 array of the characters of a list of
+    Sequence objects, one row per sequence.'''
+    if len(aligned_sequences) == 0:
+        return np.zeros((0, 0), dtype=np.uint8)
+    num_columns = len(aligned_sequences[0].seq)
+    if any(len(s.seq) != num_columns for s in aligned_sequences):
+        raise Exception("Aligned sequences must all be the same length")
+    return np.frombuffer(
+        ''.join(s.seq for s in aligned_sequences).encode('ascii'), dtype=np.uint8
+    ).reshape(len(aligned_sequences), num_columns)
+
+
+class AlignmentColumns:
+    '''The columns of an HMM alignment, recording which are insert columns
+    (those that were not aligned to the HMM) and which are match state
+    columns. Positions counting only match state columns are converted to
+    and from indices into the alignment.'''
+
+    # Number of sequences to read into a matrix at once
+    BLOCK_SIZE = 10000
+
+    def __init__(self, is_insert):
+        '''
+        Parameters
+        ----------
+        is_insert: numpy array of bool
+            True for each insert column of the alignment
+        '''
+        self.is_insert = is_insert
+        self.match_columns = np.flatnonzero(~is_insert)
+
+    @staticmethod
+    def from_alignment(aligned_sequences):
+        '''Return the columns of a list of aligned Sequence objects, where
+        insert columns are those containing a lower case character in any
+        sequence.'''
+        if len(aligned_sequences) == 0:
+            return AlignmentColumns(np.zeros(0, dtype=bool))
+        is_insert = np.zeros(len(aligned_sequences[0].seq), dtype=bool)
+        for start in range(0, len(aligned_sequences), AlignmentColumns.BLOCK_SIZE):
+            block = alignment_matrix(
+                aligned_sequences[start:(start+AlignmentColumns.BLOCK_SIZE)])
+            if block.shape[1] != len(is_insert):
+                raise Exception("Aligned sequences must all be the same length")
+            is_insert |= np.any(INSERT_CHARACTERS[block], axis=0)
+        return AlignmentColumns(is_insert)
+
+    @staticmethod
+    def from_hmmalign_sequence(aligned_sequence):
+        '''Return the columns of an alignment as seen from one sequence of it,
+        which must have '.' gaps in insert columns as in hmmalign output, so
+        that insert columns (lower case or '.') can be told apart from match
+        state columns (upper case or '-').'''
+        return AlignmentColumns(INSERT_OR_INSERT_GAP_CHARACTERS[
+            np.frombuffer(aligned_sequence.encode('ascii'), dtype=np.uint8)])
+
+    def __len__(self):
+        return len(self.is_insert)
+
+    def insert_columns(self):
+        return np.flatnonzero(self.is_insert)
+
+    def window(self, position, length):
+        '''Return a numpy array of the alignment indices of the length match
+        state columns starting at the given position, which does not count
+        insert columns.'''
+        if position < 0 or position + length > len(self.match_columns):
+            raise Exception(
+                "The window of length %i at position %i extends beyond the "
+                "%i match state columns of the alignment" % (
+                    length, position, len(self.match_columns)))
+        return self.match_columns[position:(position+length)]
@@ -0,0 +1,144 @@
+import os
+import json
+import time
+import pickle
+import shutil
+import hashlib
+import logging
+
+
+class Checkpointer:
+    '''Record the completion of each stage of a pipe run in the working
+    directory, so that a later run with the same inputs and parameters can
+    skip the stages that have already completed.
+
+    Each completed stage is recorded as a JSON manifest plus a pickle of the
+    stage's return value. A stage is only skipped when resuming and its
+    manifest records the same fingerprint as the current run. Once a stage has
+    to be re-run, all stages after it are re-run too.
+    '''
+
+    CHECKPOINT_DIRECTORY_NAME = 'checkpoints'
+
+    def __init__(self, working_directory, fingerprint, resume, stage_prefix=None):
+        '''
+        Parameters
+        ----------
+        working_directory: str or None
+            directory to write checkpoints into. If None, checkpointing is
+            disabled and each stage is simply run.
+        fingerprint: str
+            identifier of the inputs and parameters of this run, see
+            fingerprint()
+        resume: boolean
+            skip stages that were completed by a previous run
+        stage_prefix: str or None
+            prefix for stage names e.g. to distinguish between sample batches
+        '''
+        if working_directory is None:
+            self._directory = None
+        else:
+            self._directory = os.path.join(
+                working_directory, Checkpointer.CHECKPOINT_DIRECTORY_NAME)
+            os.makedirs(self._directory, exist_ok=True)
+        self._fingerprint = fingerprint
+        self._resume = resume
+        self._stage_prefix = stage_prefix
+
+    @staticmethod
+    def fingerprint(parameters):
+        '''Return a str identifying the given parameters, a JSON-serialisable
+        dict.'''
+        return hashlib.sha256(
+            json.dumps(parameters, sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def file_fingerprint(path):
+        '''Return a JSON-serialisable description of a file which changes when
+        the file is modified.'''
+        stat = os.stat(path)
+        return [os.path.abspath(path), stat.st_size, stat.st_mtime]
+
+    def _stage_name(self, stage):
+        if self._stage_prefix is None:
+            return stage
+        else:
+            return '%s_%s' % (self._stage_prefix, stage)
+
+    def _manifest_path(self, stage):
+        return os.path.join(self._directory, '%s.json' % self._stage_name(stage))
+
+    def _result_path(self, stage):
+        return os.path.join(self._directory, '%s.pickle' % self._stage_name(stage))
+
+    def is_complete(self, stage):
+        '''Return True if the stage was completed by a run with the same
+        fingerprint.'''
+        if self._directory is None: return False
+        manifest_path = self._manifest_path(stage)
+        if not os.path.exists(manifest_path) or \
+           not os.path.exists(self._result_path(stage)):
+            return False
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        return manifest['fingerprint'] == self._fingerprint
+
+    def run_stage(self, stage, function, output_paths=[]):
+        '''Run function and return its result, unless resuming and the stage has
+        already been completed, in which case return the result recorded
+        previously.
+
+        Parameters
+        ----------
+        stage: str
+            name of the stage
+        function: callable
+            called with no arguments to run the stage
+        output_paths: list of str
+            files or directories created by the stage, which are removed
+            before it is run so that output from an interrupted or
+            differently parameterised run does not get in the way.
+        '''
+        if self._directory is None:
+            return function()
+
+        if self._resume:
+            if self.is_complete(stage):
+                logging.info("Skipping stage '%s' as it was completed in a previous run" % \
+                             self._stage_name(stage))
+                with open(self._result_path(stage), 'rb') as f:
+                    return pickle.load(f)
+            logging.info("Stage '%s' was not completed in a previous run, resuming from here" % \
+                         self._stage_name(stage))
+            self._resume = False
+
+        for path in output_paths:
+            if os.path.isdir(path):
+                logging.debug("Removing previous output directory %s" % path)
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                logging.debug("Removing previous output file %s" % path)
+                os.remove(path)
+
+        # Remove any previous record of this stage so it cannot be mistaken
+        # as complete if this run is interrupted.
+        for path in (self._manifest_path(stage), self._result_path(stage)):
+            if os.path.exists(path): os.remove(path)
+
+        result = function()
+
+        # Write to a temporary file then move into place so that a partially
+        # written checkpoint is never read.
+        result_path = self._result_path(stage)
+        with open(result_path+'.partial', 'wb') as f:
+            pickle.dump(result, f)
+        os.rename(result_path+'.partial', result_path)
+        manifest_path = self._manifest_path(stage)
+        with open(manifest_path+'.partial', 'w') as f:
+            json.dump({
+                'stage': self._stage_name(stage),
+                'fingerprint': self._fingerprint,
+                'completed': time.strftime('%Y-%m-%dT%H:%M:%S')}, f)
+        os.rename(manifest_path+'.partial', manifest_path)
+        logging.debug("Recorded completion of stage '%s'" % self._stage_name(stage))
+        return result
@@ -0,0 +1,80 @@
+import threading
+
+
+class EarlyStopper:
+    '''Track the number of reads hit by each SingleM package as chunks of a
+    sample are searched, to decide when enough of the sample has been read.
+
+    Reading can stop once every package has hit at least a given number of
+    reads, or once the hit rate of every package (hits per sequence searched)
+    has converged, i.e. changed by no more than a given proportion when the
+    latest chunk was included. A package with no hits before the latest chunk
+    has not converged, since its rate cannot yet be estimated.
+
+    Chunks may finish being searched in any order, but are evaluated in the
+    order they were read, chunks finishing early being held back until the
+    chunks before them are added. The chunks used are then the same however
+    the searches are scheduled, and chunks after those that met the criteria
+    are ignored.'''
+
+    def __init__(self, package_names, min_hits=None, convergence=None):
+        '''
+        Parameters
+        ----------
+        package_names: list of str
+            names of the packages searched
+        min_hits: int or None
+            stop once every package has hit this many reads
+        convergence: float or None
+            stop once the hit rate of every package changes by no more than
+            this proportion of its previous value after a chunk is searched
+        '''
+        if min_hits is None and convergence is None:
+            raise Exception("At least one early stopping criterion must be given")
+        self._package_names = package_names
+        self._min_hits = min_hits
+        self._convergence = convergence
+        self.num_sequences = 0
+        self.package_to_hits = dict((name, 0) for name in package_names)
+        # Number of chunks evaluated, which once complete is the number of
+        # leading chunks that met the criteria
+        self.num_chunks = 0
+        self._pending_chunks = {}
+        self._previous_rates = None
+        self._complete = False
+        self._lock = threading.Lock()
+
+    def add_chunk(self, chunk_index, num_sequences, package_to_hits):
+        '''Record the results of searching a chunk of num_sequences sequences,
+        the chunk_index'th (from 0) chunk read, given as a dict of package name
+        to number of reads hit.'''
+        with self._lock:
+            self._pending_chunks[chunk_index] = (num_sequences, package_to_hits)
+            while not self._complete and self.num_chunks in self._pending_chunks:
+                self._evaluate_chunk(*self._pending_chunks.pop(self.num_chunks))
+                self.num_chunks += 1
+
+    def _evaluate_chunk(self, num_sequences, package_to_hits):
+        self.num_sequences += num_sequences
+        for name, hits in package_to_hits.items():
+            self.package_to_hits[name] += hits
+
+        if self._min_hits is not None and \
+           all(hits >= self._min_hits for hits in self.package_to_hits.values()):
+            self._complete = True
+
+        if self._convergence is not None and self.num_sequences > 0:
+            rates = dict(
+                (name, float(hits) / self.num_sequences)
+                for name, hits in self.package_to_hits.items())
+            if self._previous_rates is not None and all(
+                    self._previous_rates[name] > 0 and
+                    abs(rates[name] - self._previous_rates[name]) <= \
+                    self._convergence * self._previous_rates[name]
+                    for name in self._package_names):
+                self._complete = True
+            self._previous_rates = rates
+
+    def is_complete(self):
+        with self._lock:
+            return self._complete
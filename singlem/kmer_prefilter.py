@@ -0,0 +1,287 @@
+import os
+import logging
+import itertools
+
+import numpy as np
+from Bio.Data.CodonTable import standard_dna_table
+
+from .singlem import singlem_cache_directory
+from .sequence_classes import SeqReader
+
+# Code of characters which cannot be part of a k-mer, including the separator
+# placed between concatenated sequences.
+_INVALID = 255
+
+# Reduced amino acid alphabet, as used by DIAMOND, so that seeds match across
+# conservative substitutions.
+_REDUCED_AMINO_ACID_GROUPS = ['KREDQN', 'C', 'G', 'H', 'ILV', 'M', 'F', 'Y', 'W', 'P', 'STA']
+
+def _nucleotide_codes():
+    codes = np.full(256, _INVALID, dtype=np.uint8)
+    for code, bases in enumerate(['Aa', 'Cc', 'Gg', 'TtUu']):
+        for base in bases:
+            codes[ord(base)] = code
+    return codes
+
+def _amino_acid_codes():
+    codes = np.full(256, _INVALID, dtype=np.uint8)
+    for code, amino_acids in enumerate(_REDUCED_AMINO_ACID_GROUPS):
+        for amino_acid in amino_acids:
+            codes[ord(amino_acid)] = code
+            codes[ord(amino_acid.lower())] = code
+    return codes
+
+def _codon_codes():
+    '''Return an array of the reduced amino acid code of each codon, indexed
+    by 16*base1 + 4*base2 + base3. Stop codons are invalid.'''
+    amino_acid_codes = _amino_acid_codes()
+    codes = np.full(64, _INVALID, dtype=np.uint8)
+    for i, codon in enumerate(itertools.product('ACGT', repeat=3)):
+        amino_acid = standard_dna_table.forward_table.get(''.join(codon))
+        if amino_acid is not None:
+            codes[i] = amino_acid_codes[ord(amino_acid)]
+    return codes
+
+_NUCLEOTIDE_CODES = _nucleotide_codes()
+_AMINO_ACID_CODES = _amino_acid_codes()
+_CODON_CODES = _codon_codes()
+
+
+def _concatenate(sequences):
+    '''Return the sequences joined into one array of bytes with a separator
+    between each, and the start position of each sequence.'''
+    lengths = np.array([len(s) for s in sequences], dtype=np.int64)
+    starts = np.zeros(len(sequences), dtype=np.int64)
+    if len(sequences) > 1:
+        starts[1:] = np.cumsum(lengths[:-1] + 1)
+    joined = np.frombuffer('*'.join(sequences).encode(), dtype=np.uint8)
+    return joined, starts
+
+def _kmer_codes(symbols, k, alphabet_size, stride=1):
+    '''Return the start positions and integer codes of each k-mer in an array
+    of symbol codes which does not include an invalid symbol. Each k-mer is
+    made of the symbols stride apart, so that a stride of 3 gives k-mers of
+    amino acids when symbols has the code of the codon starting at each
+    position.'''
+    num_kmers = len(symbols) - stride*(k-1)
+    if num_kmers <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint64)
+    codes = np.zeros(num_kmers, dtype=np.uint64)
+    valid = np.ones(num_kmers, dtype=bool)
+    alphabet_size = np.uint64(alphabet_size)
+    for i in range(k):
+        window = symbols[i*stride:i*stride+num_kmers]
+        valid &= window != _INVALID
+        codes = codes * alphabet_size + window.astype(np.uint64)
+    positions = np.nonzero(valid)[0]
+    return positions, codes[positions]
+
+def _reverse_complement(nucleotides):
+    reverse = nucleotides[::-1]
+    return np.where(reverse == _INVALID, _INVALID, 3 - reverse).astype(np.uint8)
+
+def _codons(nucleotides):
+    '''Return the reduced amino acid code of the codon starting at each
+    position of an array of nucleotide codes.'''
+    if len(nucleotides) < 3:
+        return np.zeros(0, dtype=np.uint8)
+    first = nucleotides[:-2]
+    second = nucleotides[1:-1]
+    third = nucleotides[2:]
+    invalid = (first == _INVALID) | (second == _INVALID) | (third == _INVALID)
+    codon = (first.astype(np.uint16) * 16 + second.astype(np.uint16) * 4 + third) & 63
+    return np.where(invalid, _INVALID, _CODON_CODES[codon]).astype(np.uint8)
+
+
+class KmerPrefilter:
+    '''Remove reads which share no k-mer with the unaligned sequences of any of
+    a set of SingleM packages, before they are searched with HMMs.
+
+    Reads are translated in all 6 frames and compared to protein packages
+    using k-mers in a reduced amino acid alphabet, and compared to nucleotide
+    packages using nucleotide k-mers of both strands. The k-mers of each
+    package are cached on disk, keyed on the package's sha256.
+    '''
+
+    DEFAULT_PROTEIN_K = 11
+    DEFAULT_NUCLEOTIDE_K = 16
+    CACHE_DIRECTORY_NAME = 'kmer_prefilter'
+
+    # Number of bases of reads to process at once
+    _BATCH_SIZE = 4000000
+
+    def __init__(self, singlem_packages, cache_directory=None,
+                 protein_k=DEFAULT_PROTEIN_K, nucleotide_k=DEFAULT_NUCLEOTIDE_K):
+        '''
+        Parameters
+        ----------
+        singlem_packages: list of SingleMPackage
+            packages whose sequences reads must match
+        cache_directory: str or None
+            directory to cache package k-mers in, by default 'kmer_prefilter'
+            in the SingleM cache directory
+        protein_k: int
+            length of amino acid k-mers
+        nucleotide_k: int
+            length of nucleotide k-mers
+        '''
+        # Codes must fit in 64 bits
+        if protein_k < 1 or protein_k > 18:
+            raise Exception("The protein k-mer length must be between 1 and 18")
+        if nucleotide_k < 1 or nucleotide_k > 32:
+            raise Exception("The nucleotide k-mer length must be between 1 and 32")
+        if cache_directory is None:
+            cache_directory = os.path.join(
+                singlem_cache_directory(), KmerPrefilter.CACHE_DIRECTORY_NAME)
+        self._cache_directory = cache_directory
+        self._protein_k = protein_k
+        self._nucleotide_k = nucleotide_k
+
+        protein_indices = []
+        nucleotide_indices = []
+        for pkg in singlem_packages:
+            if pkg.is_protein_package():
+                protein_indices.append(self._package_kmers(pkg, True))
+            else:
+                nucleotide_indices.append(self._package_kmers(pkg, False))
+        self._protein_index = np.unique(np.concatenate(
+            protein_indices + [np.zeros(0, dtype=np.uint64)]))
+        self._nucleotide_index = np.unique(np.concatenate(
+            nucleotide_indices + [np.zeros(0, dtype=np.uint64)]))
+        logging.debug("Using %i protein and %i nucleotide k-mers for prefiltering" % (
+            len(self._protein_index), len(self._nucleotide_index)))
+
+    def _package_kmers(self, singlem_package, is_protein):
+        '''Return a sorted array of the distinct k-mer codes of the package's
+        unaligned sequences, reading them from the cache if possible.'''
+        sha256 = singlem_package.recorded_or_calculated_singlem_package_sha256()
+        if is_protein:
+            cache_name = '%s.protein%i.npy' % (sha256, self._protein_k)
+        else:
+            cache_name = '%s.nucleotide%i.npy' % (sha256, self._nucleotide_k)
+        cache_path = os.path.join(self._cache_directory, cache_name)
+        if os.path.exists(cache_path):
+            logging.debug("Using cached prefilter k-mers %s" % cache_path)
+            return np.load(cache_path)
+
+        sequences_path = singlem_package.graftm_package().unaligned_sequence_database_path()
+        logging.info("Finding prefilter k-mers of %s" % sequences_path)
+        with SeqReader().open(sequences_path) as f:
+            sequences = [seq for _, seq, _ in SeqReader().readfq(f)]
+        if is_protein:
+            symbols, _ = _concatenate(sequences)
+            _, codes = _kmer_codes(
+                _AMINO_ACID_CODES[symbols], self._protein_k, len(_REDUCED_AMINO_ACID_GROUPS))
+        else:
+            symbols, _ = _concatenate(sequences)
+            nucleotides = _NUCLEOTIDE_CODES[symbols]
+            _, forward_codes = _kmer_codes(nucleotides, self._nucleotide_k, 4)
+            _, reverse_codes = _kmer_codes(
+                _reverse_complement(nucleotides), self._nucleotide_k, 4)
+            codes = np.concatenate([forward_codes, reverse_codes])
+        kmers = np.unique(codes)
+
+        try:
+            os.makedirs(self._cache_directory, exist_ok=True)
+            # Write to a separate file and move it into place so that a
+            # partially written cache file is never read.
+            partial_path = '%s.%i.partial' % (cache_path, os.getpid())
+            with open(partial_path, 'wb') as f:
+                np.save(f, kmers)
+            os.rename(partial_path, cache_path)
+        except OSError as e:
+            logging.warning("Unable to cache prefilter k-mers in %s (%s)" % (
+                self._cache_directory, e))
+        return kmers
+
+    def _count_hits(self, index, codes):
+        if len(index) == 0 or len(codes) == 0:
+            return np.zeros(len(codes), dtype=bool)
+        found = np.searchsorted(index, codes)
+        return index[np.minimum(found, len(index)-1)] == codes
+
+    def matching_reads(self, sequences):
+        '''Return a boolean array of whether each of the given nucleotide
+        sequences shares at least one k-mer with the packages.'''
+        if len(sequences) == 0:
+            return np.zeros(0, dtype=bool)
+        symbols, starts = _concatenate(sequences)
+        nucleotides = _NUCLEOTIDE_CODES[symbols]
+        reverse = _reverse_complement(nucleotides)
+        hit_positions = []
+
+        if len(self._protein_index) > 0:
+            for strand, is_reverse in ((nucleotides, False), (reverse, True)):
+                positions, codes = _kmer_codes(
+                    _codons(strand), self._protein_k, len(_REDUCED_AMINO_ACID_GROUPS), 3)
+                positions = positions[self._count_hits(self._protein_index, codes)]
+                if is_reverse:
+                    positions = len(nucleotides) - 1 - positions
+                hit_positions.append(positions)
+        if len(self._nucleotide_index) > 0:
+            positions, codes = _kmer_codes(nucleotides, self._nucleotide_k, 4)
+            hit_positions.append(positions[self._count_hits(self._nucleotide_index, codes)])
+
+        matching = np.zeros(len(sequences), dtype=bool)
+        for positions in hit_positions:
+            matching[np.searchsorted(starts, positions, side='right') - 1] = True
+        return matching
+
+    def _batches(self, records):
+        batch = []
+        num_bases = 0
+        for record in records:
+            batch.append(record)
+            num_bases += len(record[0][1])
+            if num_bases >= self._BATCH_SIZE:
+                yield batch
+                batch = []
+                num_bases = 0
+        if len(batch) > 0:
+            yield batch
+
+    def filter(self, forward_path, forward_output_path,
+               reverse_path=None, reverse_output_path=None):
+        '''Write the reads of forward_path which match the packages to
+        forward_output_path in FASTA format. If reverse_path is given, a pair is
+        kept when either read matches, and the reverse reads are written to
+        reverse_output_path.
+
+        Returns the number of reads (or pairs) read and the number kept.'''
+        num_reads = 0
+        num_kept = 0
+        with SeqReader().open(forward_path) as forward_file, \
+             open(forward_output_path, 'w') as forward_output:
+            forward_records = SeqReader().readfq(forward_file)
+            if reverse_path is None:
+                reverse_file = None
+                reverse_output = None
+                records = ((r, None) for r in forward_records)
+            else:
+                reverse_file = SeqReader().open(reverse_path)
+                reverse_output = open(reverse_output_path, 'w')
+                records = self._paired_records(
+                    forward_records, SeqReader().readfq(reverse_file))
+            try:
+                for batch in self._batches(records):
+                    matching = self.matching_reads([r[0][1] for r in batch])
+                    if reverse_file is not None:
+                        matching |= self.matching_reads([r[1][1] for r in batch])
+                    for keep, (forward, reverse) in zip(matching, batch):
+                        if not keep: continue
+                        forward_output.write(">%s\n%s\n" % (forward[0], forward[1]))
+                        if reverse_output is not None:
+                            reverse_output.write(">%s\n%s\n" % (reverse[0], reverse[1]))
+                    num_reads += len(batch)
+                    num_kept += int(np.sum(matching))
+            finally:
+                if reverse_file is not None:
+                    reverse_file.close()
+                    reverse_output.close()
+        return num_reads, num_kept
+
+    def _paired_records(self, forward_records, reverse_records):
+        for forward, reverse in itertools.zip_longest(forward_records, reverse_records):
+            if forward is None or reverse is None:
+                raise Exception("Forward and reverse read files contain different numbers of sequences")
+            yield (forward, reverse)
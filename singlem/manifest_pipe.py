@@ -0,0 +1,186 @@
+import os
+import csv
+import logging
+import multiprocessing
+import concurrent.futures
+
+from .pipe import SearchPipe
+from .singlem import HmmDatabase
+from .otu_table import OtuTable
+
+# Packages loaded once by the main process, and inherited by each forked
+# worker process.
+_manifest_hmm_database = None
+
+def _initialise_manifest_worker(hmm_database):
+    global _manifest_hmm_database
+    _manifest_hmm_database = hmm_database
+
+def _run_manifest_sample(sample, pipe_kwargs, output_extras):
+    return ManifestPipe._run_sample(
+        sample, pipe_kwargs, output_extras, _manifest_hmm_database)
+
+
+class ManifestSample:
+    def __init__(self, name, forward, reverse, output):
+        self.name = name
+        self.forward = forward
+        self.reverse = reverse
+        self.output = output
+
+
+class ManifestPipe:
+    '''Run pipe on each sample listed in a manifest file, loading the SingleM
+    packages once and running several samples at once.'''
+
+    def __init__(self, manifest_path):
+        '''
+        Parameters
+        ----------
+        manifest_path: str
+            path to the manifest, see read_manifest()
+        '''
+        self.samples = ManifestPipe.read_manifest(manifest_path)
+
+    @staticmethod
+    def read_manifest(manifest_path):
+        '''Return a list of ManifestSample objects read from a tab-separated
+        manifest file. Each line has a sample name, a forward read file, and
+        optionally a reverse read file and an output OTU table path, either of
+        which may be left empty. Blank lines and lines starting with '#' are
+        ignored.'''
+        samples = []
+        with open(manifest_path) as f:
+            for (i, row) in enumerate(csv.reader(f, delimiter='\t')):
+                if len(row) == 0 or row[0].startswith('#'): continue
+                if len(row) < 2 or len(row) > 4:
+                    raise Exception(
+                        "Line %i of manifest %s does not have between 2 and 4 tab-separated columns" % (
+                            i+1, manifest_path))
+                row = row + [''] * (4 - len(row))
+                if row[0] == '' or row[1] == '':
+                    raise Exception(
+                        "Line %i of manifest %s is missing the sample name or forward read file" % (
+                            i+1, manifest_path))
+                samples.append(ManifestSample(
+                    row[0], row[1],
+                    row[2] if row[2] != '' else None,
+                    row[3] if row[3] != '' else None))
+        if len(samples) == 0:
+            raise Exception("No samples found in manifest %s" % manifest_path)
+        names = set()
+        for sample in samples:
+            if sample.name in names:
+                raise Exception("Sample name '%s' is found more than once in manifest %s" % (
+                    sample.name, manifest_path))
+            names.add(sample.name)
+        if len(set(s.reverse is None for s in samples)) > 1:
+            raise Exception("Either all or none of the samples in manifest %s must have reverse read files" % manifest_path)
+        return samples
+
+    def run(self, **kwargs):
+        '''Run pipe on each sample, writing each sample's OTU table to the
+        output path given in the manifest, and the OTU table of all samples to
+        otu_table and/or archive_otu_table if specified. Other arguments are
+        as for SearchPipe.run_to_otu_table().'''
+        output_otu_table = kwargs.pop('otu_table', None)
+        archive_otu_table = kwargs.pop('archive_otu_table', None)
+        output_extras = kwargs.pop('output_extras')
+        num_threads = kwargs.pop('threads')
+        working_directory = kwargs.pop('working_directory')
+        sequences = kwargs.pop('sequences', None)
+        reverse_read_files = kwargs.pop('reverse_read_files', None)
+        if sequences or reverse_read_files:
+            raise Exception("Sequence files cannot be specified outside the manifest")
+        singlem_packages = kwargs['singlem_packages']
+
+        if output_otu_table is None and archive_otu_table is None:
+            for sample in self.samples:
+                if sample.output is None:
+                    raise Exception(
+                        "Sample '%s' has no output path in the manifest, and no combined OTU table was specified" % sample.name)
+
+        if working_directory is not None:
+            if os.path.exists(working_directory) and \
+               not kwargs.get('resume', False) and not kwargs['force']:
+                raise Exception("Working directory '%s' already exists, not continuing" % working_directory)
+            os.makedirs(working_directory, exist_ok=True)
+
+        # Load the packages and their GraftM packages once, and build the
+        # DIAMOND database, so each sample does not have to.
+        hmms = HmmDatabase(singlem_packages)
+        for pkg in hmms:
+            pkg.graftm_package()
+        if kwargs.get('diamond_prefilter', False):
+            hmms.get_dmnd()
+
+        num_workers = min(num_threads, len(self.samples))
+        threads_per_sample = max(1, num_threads // num_workers)
+        logging.info("Running %i samples, %i at a time with %i thread(s) each" % (
+            len(self.samples), num_workers, threads_per_sample))
+
+        tasks = []
+        for sample in self.samples:
+            pipe_kwargs = dict(kwargs)
+            pipe_kwargs['sequences'] = [sample.forward]
+            pipe_kwargs['reverse_read_files'] = \
+                None if sample.reverse is None else [sample.reverse]
+            pipe_kwargs['threads'] = threads_per_sample
+            pipe_kwargs['collect_read_names'] = output_extras or bool(archive_otu_table)
+            pipe_kwargs['working_directory'] = None if working_directory is None else \
+                os.path.join(working_directory, sample.name)
+            tasks.append((sample, pipe_kwargs))
+
+        if num_workers == 1:
+            results = [ManifestPipe._run_sample(sample, pipe_kwargs, output_extras, hmms)
+                       for sample, pipe_kwargs in tasks]
+        else:
+            # Worker processes are forked so that they share the loaded
+            # packages. Samples run in separate processes since pipe changes
+            # process-wide state such as the temporary directory.
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=num_workers,
+                    mp_context=multiprocessing.get_context('fork'),
+                    initializer=_initialise_manifest_worker,
+                    initargs=(hmms,)) as executor:
+                futures = [executor.submit(
+                    _run_manifest_sample, sample, pipe_kwargs, output_extras)
+                           for sample, pipe_kwargs in tasks]
+                results = [future.result() for future in futures]
+
+        if output_otu_table is not None or archive_otu_table is not None:
+            otu_table_object = OtuTable()
+            for data in results:
+                otu_table_object.data.extend(data)
+            SearchPipe().write_otu_tables(
+                otu_table_object,
+                output_otu_table,
+                archive_otu_table,
+                output_extras,
+                singlem_packages,
+                hmms)
+
+    @staticmethod
+    def _run_sample(sample, pipe_kwargs, output_extras, hmm_database):
+        '''Run pipe on one sample, writing its OTU table if an output path is
+        given for it, and return the rows of its OTU table.'''
+        logging.info("Running sample %s" % sample.name)
+        pipe_kwargs = dict(pipe_kwargs)
+        pipe_kwargs['hmm_database'] = hmm_database
+        otu_table_object = SearchPipe().run_to_otu_table(**pipe_kwargs)
+        if otu_table_object is None:
+            otu_table_object = OtuTable()
+        for row in otu_table_object.data:
+            # Use the sample name from the manifest rather than one derived
+            # from the file name.
+            row[1] = sample.name
+        if sample.output is not None:
+            SearchPipe().write_otu_tables(
+                otu_table_object,
+                sample.output,
+                None,
+                output_extras,
+                pipe_kwargs['singlem_packages'],
+                hmm_database)
+        logging.info("Finished sample %s" % sample.name)
+        return otu_table_object.data
@@ -0,0 +1,94 @@
+import collections
+
+
+class MedianTaxonomy:
+    '''Find the median (majority-rule) taxonomy of sets of taxonomy strings.
+
+    Each distinct taxonomy string is interned as a lineage id, whose lineage
+    is stored as a tuple of integer ids of the taxon at each level. Since the
+    same sets of taxonomies recur many times, medians are cached keyed on the
+    multiset of lineage ids.'''
+
+    DEFAULT_MAX_CACHED = 100000
+
+    def __init__(self, max_cached=DEFAULT_MAX_CACHED):
+        '''
+        Parameters
+        ----------
+        max_cached: int
+            maximum number of medians to cache, after which the cache is
+            cleared
+        '''
+        self._taxonomy_to_lineage_id = {}
+        self._lineages = []
+        # Each lineage joined back into a normalised string
+        self._lineage_strings = []
+        self._taxon_to_id = {}
+        self._taxa = []
+        self._max_cached = max_cached
+        self._cache = {}
+
+    def lineage_id(self, taxonomy):
+        '''Return the id of the given taxonomy string, e.g. 'Root; d__Bacteria',
+        interning it if it has not been seen before.'''
+        try:
+            return self._taxonomy_to_lineage_id[taxonomy]
+        except KeyError:
+            lineage = []
+            for taxon in taxonomy.split(';'):
+                taxon = taxon.strip()
+                taxon_id = self._taxon_to_id.get(taxon)
+                if taxon_id is None:
+                    taxon_id = len(self._taxa)
+                    self._taxon_to_id[taxon] = taxon_id
+                    self._taxa.append(taxon)
+                lineage.append(taxon_id)
+            lineage_id = len(self._lineages)
+            self._lineages.append(tuple(lineage))
+            self._lineage_strings.append('; '.join(self._taxa[i] for i in lineage))
+            self._taxonomy_to_lineage_id[taxonomy] = lineage_id
+            return lineage_id
+
+    def median(self, taxonomies):
+        '''Return the median of a list of taxonomy strings as a string. At each
+        level, the taxon of more than half of the taxonomies is taken, stopping
+        at the first level where there is no such taxon.'''
+        taxonomy_to_lineage_id = self._taxonomy_to_lineage_id
+        lineage_ids = [
+            taxonomy_to_lineage_id[taxonomy] if taxonomy in taxonomy_to_lineage_id \
+            else self.lineage_id(taxonomy) for taxonomy in taxonomies]
+        if len(lineage_ids) > 0 and lineage_ids.count(lineage_ids[0]) == len(lineage_ids):
+            # All the same, the usual case
+            return self._lineage_strings[lineage_ids[0]]
+
+        key = tuple(sorted(collections.Counter(lineage_ids).items()))
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        median = '; '.join(self._taxa[taxon_id] for taxon_id in
+                           self._median_lineage(key, len(taxonomies)))
+        if len(self._cache) >= self._max_cached:
+            self._cache = {}
+        self._cache[key] = median
+        return median
+
+    def _median_lineage(self, lineage_id_counts, total):
+        lineages = [(self._lineages[lineage_id], count)
+                    for lineage_id, count in lineage_id_counts]
+        median_lineage = []
+        level = 0
+        while True:
+            level_counts = collections.Counter()
+            for lineage, count in lineages:
+                if level < len(lineage):
+                    level_counts[lineage[level]] += count
+            if len(level_counts) == 0:
+                break
+            taxon_id, max_count = level_counts.most_common(1)[0]
+            if float(max_count) / total > 0.5:
+                median_lineage.append(taxon_id)
+                level += 1
+            else:
+                break
+        return median_lineage
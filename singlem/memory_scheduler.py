@@ -0,0 +1,101 @@
+import logging
+import threading
+
+
+class MemoryScheduler:
+    '''Run jobs concurrently, but only as many at once as fit within a memory
+    budget according to an estimate of each job's memory usage. The available
+    threads are split evenly among the jobs that can run at once.'''
+
+    def __init__(self, max_memory, num_threads):
+        '''
+        Parameters
+        ----------
+        max_memory: int
+            memory budget in bytes
+        num_threads: int
+            total number of threads to split among concurrent jobs
+        '''
+        self._max_memory = max_memory
+        self._num_threads = num_threads
+
+    def max_concurrent_jobs(self, memory_estimates):
+        '''Return the largest number of jobs which could run at once, which is
+        at least 1 if there are any jobs.'''
+        total = 0
+        num_jobs = 0
+        for memory in sorted(memory_estimates):
+            total += memory
+            if total > self._max_memory: break
+            num_jobs += 1
+        return max(1, min(num_jobs, self._num_threads))
+
+    def threads_per_job(self, memory_estimates):
+        return max(1, self._num_threads // self.max_concurrent_jobs(memory_estimates))
+
+    def run(self, jobs):
+        '''Run each job and return their results in the same order as jobs.
+
+        Parameters
+        ----------
+        jobs: list of (memory_estimate, function) tuples
+            memory_estimate is in bytes. function is called with the number of
+            threads it may use.
+
+        Largest jobs are started first. A job is started when enough memory is
+        free for it, or when nothing else is running so that jobs larger than
+        the budget still run, one at a time. If a job raises an exception, no
+        more jobs are started and the exception is raised once running jobs
+        have finished.
+        '''
+        if len(jobs) == 0: return []
+        memory_estimates = [job[0] for job in jobs]
+        threads_per_job = self.threads_per_job(memory_estimates)
+        max_running = max(1, self._num_threads // threads_per_job)
+        logging.debug("Running %i jobs with %i threads each, up to %i at once" % (
+            len(jobs), threads_per_job, max_running))
+
+        pending = sorted(range(len(jobs)), key=lambda i: -memory_estimates[i])
+        results = [None] * len(jobs)
+        errors = []
+        condition = threading.Condition()
+        running = {'count': 0, 'memory': 0}
+
+        def run_job(i):
+            try:
+                results[i] = jobs[i][1](threads_per_job)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                with condition:
+                    running['count'] -= 1
+                    running['memory'] -= memory_estimates[i]
+                    condition.notify_all()
+
+        with condition:
+            while len(pending) > 0 and len(errors) == 0:
+                to_start = None
+                if running['count'] < max_running:
+                    for i in pending:
+                        if running['count'] == 0 or \
+                           running['memory'] + memory_estimates[i] <= self._max_memory:
+                            to_start = i
+                            break
+                if to_start is None:
+                    condition.wait()
+                    continue
+                if memory_estimates[to_start] > self._max_memory:
+                    logging.warning(
+                        "A job is estimated to need %.1fGB of memory, more than the maximum of %.1fGB, running it alone" % (
+                            memory_estimates[to_start] / 1024**3,
+                            self._max_memory / 1024**3))
+                pending.remove(to_start)
+                running['count'] += 1
+                running['memory'] += memory_estimates[to_start]
+                threading.Thread(target=run_job, args=(to_start,)).start()
+            while running['count'] > 0:
+                condition.wait()
+
+        if len(errors) > 0:
+            raise errors[0]
+        return results
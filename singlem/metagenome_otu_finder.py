@@ -1,7 +1,8 @@
 import logging
-import re
 from .sequence_classes import UnalignedAlignedNucleotideSequence
-import itertools
+from .alignment_columns import AlignmentColumns, alignment_matrix, GAP_CHARACTERS
+
+import numpy as np
 
 class MetagenomeOtuFinder:
     def find_windowed_sequences(self,
@@ -33,26 +34,14 @@ class MetagenomeOtuFinder:
 
         '''
         if len(aligned_sequences) == 0: return []
-        ignored_columns = self._find_lower_case_columns(aligned_sequences)
-        logging.debug("Ignoring columns %s", str(ignored_columns))
+        columns = AlignmentColumns.from_alignment(aligned_sequences)
+        logging.debug("Ignoring columns %s", str(columns.insert_columns().tolist()))
 
-        # Internally stretch_length is the length of the alignment
-        if is_protein_alignment:
-            if stretch_length % 3 != 0:
-                raise Exception(
-                    "For protein alignments the window length must be divisible "
-                    "by 3 i.e. correspond to whole codons")
-            stretch_length = stretch_length / 3
-        if stretch_length < 1:
-            raise Exception("stretch_length must be positive")
+        stretch_length = self._alignment_stretch_length(stretch_length, is_protein_alignment)
 
-        start_position = self._upper_case_position_to_alignment_position(
-            best_position, ignored_columns)
+        chosen_positions = columns.window(best_position, stretch_length).tolist()
         logging.debug("Using pre-defined best section of the alignment starting from %i" % (
-            start_position+1))
-
-        chosen_positions = self._best_position_to_chosen_positions(
-            start_position, stretch_length, ignored_columns)
+            chosen_positions[0]+1))
         logging.debug("Found chosen positions %s", chosen_positions)
 
         # For each read aligned to that region (e.g. that has the first and last bases),
@@ -76,14 +65,78 @@ class MetagenomeOtuFinder:
                     UnalignedAlignedNucleotideSequence(name, s.name, align, nuc, aligned_length))
         return windowed_sequences
 
-    def _find_lower_case_columns(self, protein_alignment):
-        lower_cases = [False]*len(protein_alignment[0].seq)
-        lower_case_chars = re.compile(r'[a-z]')
-        for pro in protein_alignment:
-            for i, aa in enumerate(pro.seq):
-                if lower_case_chars.match(aa):
-                    lower_cases[i] = True
-        return [i for i, is_lower in enumerate(lower_cases) if is_lower]
+    def stream_windowed_sequences(self,
+                                  aligned_sequences,
+                                  nucleotide_sequences,
+                                  stretch_length,
+                                  include_inserts,
+                                  is_protein_alignment,
+                                  best_position):
+        '''Generator yielding an UnalignedAlignedNucleotideSequence for each of
+        the aligned sequences that covers the window at the given best_position,
+        as per find_windowed_sequences.
+
+        Unlike find_windowed_sequences, the window of each sequence is found
+        from that sequence alone, without first scanning the whole alignment
+        for insert columns, so aligned_sequences may be any iterable, e.g. the
+        output of hmmalign as it is read, and is read only once. This requires
+        that gaps in insert columns are '.' rather than '-', as in the
+        Pfam/Stockholm output of hmmalign, so that match state columns (upper
+        case or '-') can be told apart from insert columns (lower case or
+        '.').
+
+        Parameters
+        ----------
+        aligned_sequences: iterable of Sequence or AlignedProteinSequence
+            aligned sequences, with '.' gaps in insert columns
+        nucleotide_sequences: dict of sequence name to Sequence object
+            unaligned nucleotide sequences
+        stretch_length: int
+            window size, measured in nucleotides (ie 60 not 20)
+        include_inserts: boolean
+            include lower case bases (that were not aligned to the HMM) in the
+            returned sequences.
+        is_protein_alignment: boolean
+            True for a protein alignment, False for a nucleotide one
+        best_position: int
+            Start of the window in the alignment not counting 'insert' columns.
+
+        '''
+        stretch_length = self._alignment_stretch_length(stretch_length, is_protein_alignment)
+
+        for s in aligned_sequences:
+            chosen_positions = AlignmentColumns.from_hmmalign_sequence(s.seq).window(
+                best_position, stretch_length).tolist()
+            if s.seq[chosen_positions[0]] != '-' and s.seq[chosen_positions[-1]] != '-':
+                # Downstream, all gaps are '-'
+                s = type(s)(s.name, s.seq.replace('.', '-'))
+                if is_protein_alignment:
+                    name = s.un_orfm_name()
+                    nuc = nucleotide_sequences[name]
+                    aligned_nucleotides = s.orfm_nucleotides(nuc)
+                else:
+                    name = s.name
+                    nuc = nucleotide_sequences[name]
+                    aligned_nucleotides = nuc.replace('-','')
+                align, aligned_length = self._nucleotide_alignment(
+                    s, aligned_nucleotides, chosen_positions, is_protein_alignment,
+                    include_inserts=include_inserts)
+
+                yield UnalignedAlignedNucleotideSequence(
+                    name, s.name, align, nuc, aligned_length)
+
+    def _alignment_stretch_length(self, stretch_length, is_protein_alignment):
+        '''Return the number of alignment columns in a window of stretch_length
+        nucleotides.'''
+        if is_protein_alignment:
+            if stretch_length % 3 != 0:
+                raise Exception(
+                    "For protein alignments the window length must be divisible "
+                    "by 3 i.e. correspond to whole codons")
+            stretch_length = stretch_length // 3
+        if stretch_length < 1:
+            raise Exception("stretch_length must be positive")
+        return stretch_length
 
     def find_best_window(self, alignment, stretch_length, is_protein_alignment):
         '''Return the position in the alignment that has the most bases aligned only
@@ -106,81 +159,74 @@ class MetagenomeOtuFinder:
             the best position
 
         '''
-         # Internally stretch_length is the length of the alignment
-        if is_protein_alignment:
-            if stretch_length % 3 != 0:
-                raise Exception(
-                    "For protein alignments the window length must be divisible "
-                    "by 3 i.e. correspond to whole codons")
-            stretch_length = int(stretch_length / 3)
-        if stretch_length < 1:
-            raise Exception("stretch_length must be positive")
+        scores = self.window_score_profiles(
+            alignment, [stretch_length], is_protein_alignment)[stretch_length]
+        if len(scores) == 0:
+            best_position = 0
+            max_num_aligned_bases = 0
+        else:
+            # The first of equally good positions
+            best_position = int(np.argmax(scores))
+            max_num_aligned_bases = int(scores[best_position])
+        logging.info("Found a window starting at position %i with %i bases aligned" % (
+            best_position, max_num_aligned_bases))
+        logging.info("Found best section of the alignment starting from %i" % (
+            best_position+1))
+        return best_position
 
-        ignored_columns = self._find_lower_case_columns(alignment)
+    def window_score_profiles(self, alignment, stretch_lengths, is_protein_alignment):
+        '''Return the number of bases aligned in the window starting at each
+        position in the alignment, for each of several window sizes. As in
+        find_best_window, only sequences that overlap the entirety of the window
+        are counted, and columns containing insert (lower case) characters are
+        ignored and not counted in positions.
 
-        # Convert the alignment into a True/False matrix for ease,
-        # True meaning that there is something aligned, else False
-        binary_alignment = []
-        for s in alignment:
-            aln = []
-            for i, base in enumerate(s.seq):
-                if base=='-':
-                    aln.append(False)
-                else:
-                    aln.append(True)
-            binary_alignment.append(aln)
-
-        # Find the number of aligned bases at each position
-        current_best_position = 0
-        current_max_num_aligned_bases = 0
-        for i in range(0, len(binary_alignment[0])-stretch_length+1):
-            if i in ignored_columns: continue #don't start from ignored columns
-            positions = self._best_position_to_chosen_positions(i, stretch_length, ignored_columns)
-            logging.debug("Testing positions %s" % str(positions))
-            num_bases_covered_here = 0
-            end_index = positions[-1]
-            #if ignored char is within stretch length of end of aln
-            if end_index >= len(binary_alignment[0]): continue
-            for s in binary_alignment:
-                if not s[i] or not s[end_index]: continue #ignore reads that don't cover the entirety
-                for pos in positions:
-                    if s[pos]: num_bases_covered_here += 1
-            logging.debug("Found %i aligned bases at position %i" % (num_bases_covered_here, i))
-            if num_bases_covered_here > current_max_num_aligned_bases:
-                current_best_position = i
-                current_max_num_aligned_bases = num_bases_covered_here
-        logging.info("Found a window starting at position %i with %i bases aligned" % (
-            current_best_position, current_max_num_aligned_bases))
+        Parameters
+        ----------
+        alignment: list of Sequence or AlignedProteinSequence
+            aligned sequences
+        stretch_lengths: list of int
+            window sizes, measured in nucleotides (ie 60 not 20)
+        is_protein_alignment: boolean
+            True for a protein alignment, False for a nucleotide one
 
-        # Convert the best position to the best position not including ignored columns
-        start_position_without_gaps = current_best_position
-        for col in ignored_columns:
-            if col < current_best_position:
-                start_position_without_gaps -= 1
-        logging.info("Found best section of the alignment starting from %i" % (
-            start_position_without_gaps+1))
-
-        return start_position_without_gaps
-
-    def _best_position_to_chosen_positions(self, best_position, stretch_length, ignored_columns):
-        '''Given a position to start from, and the number of positions to index,
-        return the consecutive indices that are not in the ignored_columns list'''
-        chosens = []
-        i = best_position
-        while len(chosens) < stretch_length:
-            if i not in ignored_columns:
-                chosens.append(i)
-            i += 1
-        return chosens
-
-    def _upper_case_position_to_alignment_position(self, position, ignored_columns):
-        target = position
-        for i in ignored_columns:
-            if i <= target:
-                target += 1
-            else:
-                return target
-        return target
+        Returns
+        -------
+        dict of window size to a numpy array of the number of bases aligned in
+        the window starting at each position. Windows which would extend
+        beyond the end of the alignment are not included.
+        '''
+        # Internally stretch_length is the length of the alignment
+        alignment_lengths = dict(
+            (stretch_length, self._alignment_stretch_length(stretch_length, is_protein_alignment))
+            for stretch_length in stretch_lengths)
+
+        # Ignore columns with insert characters, reading the alignment in
+        # blocks of sequences to limit memory usage.
+        columns = AlignmentColumns.from_alignment(alignment)
+        logging.debug("Ignoring columns %s", str(columns.insert_columns().tolist()))
+        kept_columns = columns.match_columns
+        num_kept = len(kept_columns)
+
+        profiles = dict(
+            (stretch_length, np.zeros(max(0, num_kept-length+1), dtype=np.int64))
+            for stretch_length, length in alignment_lengths.items())
+        for start in range(0, len(alignment), AlignmentColumns.BLOCK_SIZE):
+            # True where there is something aligned, else False
+            aligned = ~GAP_CHARACTERS[alignment_matrix(
+                alignment[start:(start+AlignmentColumns.BLOCK_SIZE)])][:, kept_columns]
+            cumulative_aligned = np.zeros((aligned.shape[0], num_kept+1), dtype=np.int32)
+            np.cumsum(aligned, axis=1, out=cumulative_aligned[:, 1:])
+            for stretch_length, length in alignment_lengths.items():
+                num_windows = num_kept-length+1
+                if num_windows < 1:
+                    continue
+                # Only count reads that cover the first and last positions
+                covering = aligned[:, :num_windows] & aligned[:, length-1:]
+                num_aligned = cumulative_aligned[:, length:] - cumulative_aligned[:, :num_windows]
+                profiles[stretch_length] += np.sum(
+                    num_aligned * covering, axis=0, dtype=np.int64)
+        return profiles
 
     def _nucleotide_alignment(self,
                               protein_sequence,
@@ -221,39 +267,46 @@ class MetagenomeOtuFinder:
             length_ratio = 1
             empty_codon = '-'
 
-        codons = []
-        # For each position in the amino acid sequence
-        # If non-dash character, take 3 nucleotides off the nucleotide sequence and
-        # add that as the codon
-        # else add None
-        for aa in protein_sequence.seq:
-            if aa=='-':
-                codons.append(empty_codon)
-            else:
-                if len(nucleotides) < length_ratio: raise Exception("Insufficient nucleotide length found")
-                codons.append(nucleotides[:length_ratio])
-                if len(nucleotides)>=length_ratio: nucleotides = nucleotides[length_ratio:]
-                if nucleotides[:length_ratio] == empty_codon: raise Exception("Input nucleotide sequence had gap characters, didn't expect this")
-        if len(nucleotides) > 0:
+        seq = protein_sequence.seq
+        num_residues = len(seq) - seq.count('-')
+        if '-' in nucleotides:
+            # Gaps are only a problem at the start of a codon
+            for i in range(1, min(num_residues, len(nucleotides) // length_ratio)+1):
+                if nucleotides[i*length_ratio:(i+1)*length_ratio] == empty_codon:
+                    raise Exception("Input nucleotide sequence had gap characters, didn't expect this")
+        if len(nucleotides) < num_residues * length_ratio:
+            raise Exception("Insufficient nucleotide length found")
+        if len(nucleotides) > num_residues * length_ratio:
             raise Exception(
                 "Insufficient aligned length found - were unaligned columns"
                 " removed? Don't remove them.")
 
-        aligned_length = 0
-        for i in range(chosen_positions[0],chosen_positions[-1]+1):
-            if protein_sequence.seq[i] != '-':
-                aligned_length += length_ratio
+        # Take the codon of each column of the window, starting from the
+        # nucleotides of the residues before the window
+        first = chosen_positions[0]
+        last = chosen_positions[-1]
+        offset = (first - seq.count('-', 0, first)) * length_ratio
+        window_codons = []
+        for aa in seq[first:last+1]:
+            if aa == '-':
+                window_codons.append(empty_codon)
+            else:
+                window_codons.append(nucleotides[offset:offset+length_ratio])
+                offset += length_ratio
+
+        aligned_length = (last + 1 - first - seq.count('-', first, last+1)) * length_ratio
 
         if include_inserts:
+            chosen = set(chosen_positions)
             to_return = []
-            for i in range(chosen_positions[0], chosen_positions[-1]+1):
-                if i in chosen_positions:
-                    to_return += codons[i]
-                elif codons[i] == empty_codon:
+            for i, codon in enumerate(window_codons, first):
+                if i in chosen:
+                    to_return.append(codon)
+                elif codon == empty_codon:
                     pass
                 else:
-                    to_return += codons[i].lower()
+                    to_return.append(codon.lower())
             return ''.join(to_return), aligned_length
         else:
-            return ''.join(itertools.chain(codons[i] for i in chosen_positions)), \
+            return ''.join(window_codons[i-first] for i in chosen_positions), \
                 aligned_length
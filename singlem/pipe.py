@@ -7,8 +7,12 @@ import itertools
 import tempfile
 import json
 import re
-from Bio import SeqIO
-from io import StringIO
+import math
+import multiprocessing
+import multiprocessing.pool
+import subprocess
+import threading
+import concurrent.futures
 
 from .singlem import HmmDatabase, TaxonomyFile, OrfMUtils
 from .otu_table import OtuTable
@@ -19,28 +23,59 @@ from .diamond_parser import DiamondResultParser
 from .graftm_result import GraftMResult
 from . import sequence_extractor as singlem_sequence_extractor
 from .placement_parser import PlacementParser
-from .taxonomy_bihash import TaxonomyBihash
+from .taxonomy_tree import TaxonomyTree
+from .checkpointer import Checkpointer
+from .memory_scheduler import MemoryScheduler
+from .sequence_chunker import SequenceChunker
+from .taxonomy_cache import TaxonomyCache
+from .timing_report import TimingReport
+from .shared_memory_budget import SharedMemoryBudget
+from .kmer_prefilter import KmerPrefilter
+from .early_stopper import EarlyStopper
+from .sequence_aggregator import SequenceAggregator
+from .median_taxonomy import MedianTaxonomy
 
 from graftm.sequence_extractor import SequenceExtractor
 from graftm.greengenes_taxonomy import GreenGenesTaxonomy
 from graftm.sequence_search_results import HMMSearchResult, SequenceSearchResult
 from graftm.sequence_io import SequenceIO
+from graftm.unpack_sequences import UnpackRawReads
 
 PPLACER_ASSIGNMENT_METHOD = 'pplacer'
 DIAMOND_ASSIGNMENT_METHOD = 'diamond'
 DIAMOND_EXAMPLE_BEST_HIT_ASSIGNMENT_METHOD = 'diamond_example'
 NO_ASSIGNMENT_METHOD = 'no_assign_taxonomy'
 
+# State shared with read extraction worker processes, set by
+# _initialise_extract_reads_worker so it is not sent with each task.
+_extract_reads_pipe = None
+_extract_reads_known_taxonomy = None
+
+def _initialise_extract_reads_worker(search_pipe, known_taxonomy):
+    global _extract_reads_pipe, _extract_reads_known_taxonomy
+    _extract_reads_pipe = search_pipe
+    _extract_reads_known_taxonomy = known_taxonomy
+
+def _align_and_extract_reads_worker(indexed_tasks):
+    return _extract_reads_pipe._align_and_extract_reads(
+        indexed_tasks, _extract_reads_known_taxonomy)
+
 class SearchPipe:
     DEFAULT_MIN_ORF_LENGTH = 96
     DEFAULT_FILTER_MINIMUM_PROTEIN = 28
     DEFAULT_FILTER_MINIMUM_NUCLEOTIDE = 95
+    # Number of sequences read at a time when stopping early, if the search
+    # chunk size is not specified.
+    DEFAULT_EARLY_STOP_CHUNK_SIZE = 100000
 
     def run(self, **kwargs):
         output_otu_table = kwargs.pop('otu_table', None)
         archive_otu_table = kwargs.pop('archive_otu_table', None)
         output_extras = kwargs.pop('output_extras')
         singlem_packages = kwargs['singlem_packages']
+        hmm_database = kwargs.get('hmm_database', None)
+        # Read names are only output in these cases
+        kwargs['collect_read_names'] = output_extras or bool(archive_otu_table)
 
         otu_table_object = self.run_to_otu_table(**kwargs)
         if otu_table_object is not None:
@@ -49,14 +84,16 @@ class SearchPipe:
                 output_otu_table,
                 archive_otu_table,
                 output_extras,
-                singlem_packages)
+                singlem_packages,
+                hmm_database)
 
     def write_otu_tables(self,
             otu_table_object,
             output_otu_table,
             archive_otu_table,
             output_extras,
-            singlem_packages):
+            singlem_packages,
+            hmm_database=None):
         regular_output_fields = str.split('gene sample sequence num_hits coverage taxonomy')
         otu_table_object.fields = regular_output_fields + \
             str.split('read_names nucleotides_aligned taxonomy_by_known?')
@@ -68,11 +105,28 @@ class SearchPipe:
                     otu_table_object.write_to(f, regular_output_fields)
         if archive_otu_table:
             with open(archive_otu_table, 'w') as f:
-                otu_table_object.archive(HmmDatabase(singlem_packages)).write_to(f)
+                if hmm_database is None:
+                    hmm_database = HmmDatabase(singlem_packages)
+                otu_table_object.archive(hmm_database).write_to(f)
 
 
     def run_to_otu_table(self, **kwargs):
         '''Run the pipe, '''
+        # The temporary directory is pointed into the working directory during
+        # the run. The original is restored afterwards, since the working
+        # directory is then removed and other runs may follow in this process.
+        original_tempdir = tempfile.tempdir
+        original_temp = os.environ.get('TEMP')
+        try:
+            return self._run_to_otu_table(tempfile.gettempdir(), **kwargs)
+        finally:
+            tempfile.tempdir = original_tempdir
+            if original_temp is None:
+                os.environ.pop('TEMP', None)
+            else:
+                os.environ['TEMP'] = original_temp
+
+    def _run_to_otu_table(self, original_temporary_directory, **kwargs):
         forward_read_files = kwargs.pop('sequences')
         reverse_read_files = kwargs.pop('reverse_read_files', None)
         num_threads = kwargs.pop('threads')
@@ -86,29 +140,101 @@ class SearchPipe:
         filter_minimum_nucleotide = kwargs.pop('filter_minimum_nucleotide')
         include_inserts = kwargs.pop('include_inserts')
         singlem_packages = kwargs.pop('singlem_packages')
+        # Packages already loaded e.g. when running many samples
+        hmms = kwargs.pop('hmm_database', None)
         assign_taxonomy = kwargs.pop('assign_taxonomy')
         known_sequence_taxonomy = kwargs.pop('known_sequence_taxonomy')
         diamond_prefilter = kwargs.pop('diamond_prefilter')
+        kmer_prefilter = kwargs.pop('kmer_prefilter', False)
+        sample_batch_size = kwargs.pop('sample_batch_size', None)
+        resume = kwargs.pop('resume', False)
+        max_memory = kwargs.pop('max_memory', None)
+        search_chunk_size = kwargs.pop('search_chunk_size', None)
+        taxonomy_cache = kwargs.pop('taxonomy_cache', None)
+        taxonomy_cache_max_entries = kwargs.pop(
+            'taxonomy_cache_max_entries', TaxonomyCache.DEFAULT_MAX_ENTRIES)
+        deduplicate_assignment = kwargs.pop('deduplicate_assignment', False)
+        timing_report = kwargs.pop('timing_report', None)
+        shm_budget = kwargs.pop('shm_budget', None)
+        early_stop_hits = kwargs.pop('early_stop_hits', None)
+        early_stop_convergence = kwargs.pop('early_stop_convergence', None)
+        collect_read_names = kwargs.pop('collect_read_names', True)
 
         working_directory = kwargs.pop('working_directory')
         working_directory_tmpdir = kwargs.pop('working_directory_tmpdir')
         force = kwargs.pop('force')
         if len(kwargs) > 0:
             raise Exception("Unexpected arguments detected: %s" % kwargs)
+        if sample_batch_size is not None and sample_batch_size < 1:
+            raise Exception("The sample batch size must be at least 1")
+        if resume and working_directory is None:
+            raise Exception("Resuming a previous run requires the working directory to be specified")
+        if search_chunk_size is not None and search_chunk_size < 1:
+            raise Exception("The search chunk size must be at least 1")
+        if max_memory is not None and max_memory <= 0:
+            raise Exception("The maximum memory must be greater than 0")
+        if shm_budget is not None and shm_budget <= 0:
+            raise Exception("The shared memory budget must be greater than 0")
+        if diamond_prefilter and kmer_prefilter:
+            raise Exception("The DIAMOND and k-mer prefilters cannot be used together")
+        if deduplicate_assignment and reverse_read_files is not None:
+            raise Exception("Deduplicated taxonomic assignment is not currently supported for paired reads")
+        if deduplicate_assignment and output_jplace:
+            raise Exception("Deduplicated taxonomic assignment is incompatible with jplace output")
+        early_stopping = early_stop_hits is not None or early_stop_convergence is not None
+        if early_stop_hits is not None and early_stop_hits < 1:
+            raise Exception("The early stopping hit count must be at least 1")
+        if early_stop_convergence is not None and early_stop_convergence < 0:
+            raise Exception("The early stopping convergence threshold cannot be negative")
+        if early_stopping and reverse_read_files is not None:
+            raise Exception("Early stopping is not currently supported for paired reads")
+        if early_stopping and (diamond_prefilter or kmer_prefilter):
+            raise Exception("Early stopping cannot be used with a prefilter, since prefiltering reads all of the input")
 
         self._num_threads = num_threads
+        # Maximum memory in bytes for taxonomic assignment, or None to run one
+        # package at a time.
+        self._max_memory = None if max_memory is None else int(max_memory * 1024**3)
+        self._search_chunk_size = search_chunk_size
+        # Read names and aligned lengths of each OTU are only needed for
+        # some outputs.
+        self._collect_read_names = collect_read_names or bool(output_jplace)
+        # Stop reading each input file once these criteria are met, see
+        # EarlyStopper.
+        self._early_stopping = early_stopping
+        self._early_stop_hits = early_stop_hits
+        self._early_stop_convergence = early_stop_convergence
+        if early_stopping and search_chunk_size is None:
+            self._search_chunk_size = SearchPipe.DEFAULT_EARLY_STOP_CHUNK_SIZE
+        # Assign taxonomy to one read per distinct OTU sequence in each
+        # package, rather than to every read.
+        self._deduplicate_assignment = deduplicate_assignment
+        self._assignment_file_cache = {}
+        # Taxonomies are interned for the whole run, since the same ones are
+        # seen in many samples.
+        self._median_taxonomy_calculator = MedianTaxonomy()
         self._evalue = evalue
         self._min_orf_length = min_orf_length
         self._restrict_read_length = restrict_read_length
         self._filter_minimum_protein = filter_minimum_protein
         self._filter_minimum_nucleotide = filter_minimum_nucleotide
 
-        hmms = HmmDatabase(singlem_packages)
+        if hmms is None:
+            hmms = HmmDatabase(singlem_packages)
         if singlem_assignment_method == DIAMOND_EXAMPLE_BEST_HIT_ASSIGNMENT_METHOD:
             graftm_assignment_method = DIAMOND_ASSIGNMENT_METHOD
         else:
             graftm_assignment_method = singlem_assignment_method
 
+        # OTU sequences found in the taxonomy cache are not assigned taxonomy
+        # again, and newly assigned ones are added to it.
+        if taxonomy_cache is not None and assign_taxonomy:
+            self._taxonomy_cache = TaxonomyCache(
+                taxonomy_cache, taxonomy_cache_max_entries)
+        else:
+            self._taxonomy_cache = None
+        self._singlem_assignment_method = singlem_assignment_method
+
         analysing_pairs = reverse_read_files is not None
         if analysing_pairs:
             if len(forward_read_files) != len(reverse_read_files):
@@ -127,12 +253,21 @@ class SearchPipe:
             singlem_assignment_method = NO_ASSIGNMENT_METHOD
 
         using_temporary_working_directory = working_directory is None
+        self._shared_memory_budget = None
+        spill_tmp = None
         if using_temporary_working_directory:
             if working_directory_tmpdir is False:
                 shared_mem_directory = '/dev/shm'
                 if os.path.exists(shared_mem_directory):
                     logging.debug("Using shared memory as a base directory")
                     tmp = tempdir.TempDir(basedir=shared_mem_directory)
+                    if shm_budget is not None:
+                        # In the temporary directory in use before this run,
+                        # so that it is on disk
+                        spill_tmp = tempdir.TempDir(basedir=original_temporary_directory)
+                        logging.debug("Moving large intermediate files to %s when over the shared memory budget" % spill_tmp.name)
+                        self._shared_memory_budget = SharedMemoryBudget(
+                            tmp.name, spill_tmp.name, int(shm_budget * 1024**3))
                     tempfiles_path = os.path.join(tmp.name, 'tempfiles')
                     os.mkdir(tempfiles_path)
                     os.environ['TEMP'] = tempfiles_path
@@ -150,7 +285,9 @@ class SearchPipe:
         else:
             working_directory = working_directory
             if os.path.exists(working_directory):
-                if force:
+                if resume:
+                    logging.info("Resuming from previous run in working directory %s" % working_directory)
+                elif force:
                     logging.info("Overwriting directory %s" % working_directory)
                     shutil.rmtree(working_directory)
                     os.mkdir(working_directory)
@@ -158,50 +295,42 @@ class SearchPipe:
                     raise Exception("Working directory '%s' already exists, not continuing" % working_directory)
             else:
                 os.mkdir(working_directory)
+        if shm_budget is not None and self._shared_memory_budget is None:
+            logging.warning("The working directory is not in shared memory, so the shared memory budget is ignored")
         logging.debug("Using working directory %s" % working_directory)
         self._working_directory = working_directory
-        extracted_reads = None
+        if timing_report is None:
+            self._timing_report = None
+        else:
+            self._timing_report = TimingReport(working_directory)
         def return_cleanly():
+            if self._timing_report is not None:
+                self._timing_report.write(timing_report)
+            if self._taxonomy_cache is not None:
+                self._taxonomy_cache.evict()
+                self._taxonomy_cache.close()
             if using_temporary_working_directory: tmp.dissolve()
+            if spill_tmp is not None: spill_tmp.dissolve()
             logging.info("Finished")
         # Set a tempfile directory in the working directory so that temporary
         # files can be generated (with delete=False), and then immediately
         # closed so that the file exists but the stream is not open, to avoid
         # the "Too many open files" error.
         tempfile_directory = os.path.join(self._working_directory, 'tmp')
-        os.mkdir(tempfile_directory)
+        os.makedirs(tempfile_directory, exist_ok=resume)
         tempfile.tempdir = tempfile_directory
 
-        #### Search
         self._singlem_package_database = hmms
         logging.info("Using as input %i different sequence files e.g. %s" % (
             len(forward_read_files), forward_read_files[0]))
-        
+
         if diamond_prefilter:
-            logging.info("Filtering sequence files through DIAMOND blastx")
             for pkg in hmms:
                 if not pkg.is_protein_package():
                     raise Exception(
                         "DIAMOND prefilter cannot be used with nucleotide SingleM packages")
-                    
-            forward_read_files = self._prefilter(hmms, forward_read_files)
-            if reverse_read_files != None:
-                reverse_read_files = self._prefilter(hmms, reverse_read_files)
-            logging.info("Finished DIAMOND prefilter phase")
-                
-        search_result = self._search(hmms, forward_read_files, reverse_read_files)
-        sample_names = search_result.samples_with_hits()
-        if len(sample_names) == 0:
-            logging.info("No reads identified in any samples, stopping")
-            return_cleanly()
-            return None
-        logging.debug("Recovered %i samples with at least one hit e.g. '%s'"
-                     % (len(sample_names), sample_names[0]))
 
-        #### Alignment
-        align_result = self._align(search_result)
-
-        ### Extract reads that have already known taxonomy
+        ### Read in taxonomies that are already known
         if known_otu_tables:
             logging.info("Parsing known taxonomy OTU tables")
             known_taxes = KnownOtuTable()
@@ -217,48 +346,189 @@ class SearchPipe:
                 known_sequence_tax[seq_id] = '; '.join(tax)
             logging.info("Read in %i taxonomies from the GreenGenes format taxonomy file" % len(known_sequence_tax))
 
-        ### Extract other reads which do not have known taxonomy
-        extracted_reads = self._extract_relevant_reads(
-            align_result, include_inserts, known_taxes)
-        logging.info("Finished extracting aligned sequences")
-
-        #### Taxonomic assignment
-        if assign_taxonomy:
-            logging.info("Running taxonomic assignment with GraftM..")
-            assignment_result = self._assign_taxonomy(
-                extracted_reads, graftm_assignment_method)
-
-        #### Process taxonomically assigned reads
         otu_table_object = OtuTable()
-        package_to_taxonomy_bihash = {}
-        for readset in extracted_reads:
-            self._process_taxonomically_assigned_reads(
-                # inputs
-                readset,
-                analysing_pairs,
-                known_taxes,
-                known_sequence_taxonomy,
-                assign_taxonomy,
-                singlem_assignment_method,
-                assignment_result if assign_taxonomy else None,
-                output_jplace,
-                known_sequence_tax if known_sequence_taxonomy else None,
-                # outputs
-                otu_table_object,
-                package_to_taxonomy_bihash)
+        package_to_taxonomy_tree = {}
+
+        # Checkpoints are only recorded when the working directory is
+        # specified, since temporary working directories are removed anyway.
+        checkpoint_directory = None if using_temporary_working_directory else working_directory
+        def file_fingerprints(paths):
+            return [Checkpointer.file_fingerprint(p) for p in paths] if paths else None
+        run_fingerprint_parameters = {
+            'packages': hmms.packages_sha256(),
+            'known_otu_tables': file_fingerprints(known_otu_tables),
+            'known_sequence_taxonomy': file_fingerprints(
+                [known_sequence_taxonomy] if known_sequence_taxonomy else None),
+            'assignment_method': singlem_assignment_method,
+            'output_jplace': output_jplace,
+            'evalue': evalue,
+            'min_orf_length': min_orf_length,
+            'restrict_read_length': restrict_read_length,
+            'filter_minimum_protein': filter_minimum_protein,
+            'filter_minimum_nucleotide': filter_minimum_nucleotide,
+            'include_inserts': include_inserts,
+            'diamond_prefilter': diamond_prefilter,
+            'kmer_prefilter': kmer_prefilter,
+            'sample_batch_size': sample_batch_size,
+            'search_chunk_size': search_chunk_size,
+            'taxonomy_cache': taxonomy_cache,
+            'deduplicate_assignment': deduplicate_assignment,
+            'early_stop_hits': early_stop_hits,
+            'early_stop_convergence': early_stop_convergence,
+            'collect_read_names': self._collect_read_names}
+
+        def run_batch(forward_read_files, reverse_read_files, batch_name):
+            '''Run the search, alignment, extraction and assignment steps on
+            the given files, adding the results to otu_table_object. Return
+            True if any reads were identified, else False.'''
+            fingerprint_parameters = dict(run_fingerprint_parameters)
+            fingerprint_parameters['forward_read_files'] = file_fingerprints(forward_read_files)
+            fingerprint_parameters['reverse_read_files'] = file_fingerprints(reverse_read_files)
+            checkpointer = Checkpointer(
+                checkpoint_directory,
+                Checkpointer.fingerprint(fingerprint_parameters),
+                resume,
+                batch_name)
+            def run_stage(stage, function, output_paths=[]):
+                if self._timing_report is None:
+                    result = checkpointer.run_stage(stage, function, output_paths)
+                else:
+                    with self._timing_report.stage(stage, batch_name):
+                        result = checkpointer.run_stage(stage, function, output_paths)
+                if self._shared_memory_budget is not None:
+                    self._shared_memory_budget.stage_completed(stage, output_paths)
+                return result
+
+            #### Search
+            if diamond_prefilter:
+                def prefilter():
+                    logging.info("Filtering sequence files through DIAMOND blastx")
+                    filtered_forward = self._prefilter(hmms, forward_read_files)
+                    if reverse_read_files != None:
+                        filtered_reverse = self._prefilter(hmms, reverse_read_files)
+                    else:
+                        filtered_reverse = None
+                    logging.info("Finished DIAMOND prefilter phase")
+                    return filtered_forward, filtered_reverse
+                forward_read_files, reverse_read_files = run_stage(
+                    'prefilter', prefilter,
+                    [os.path.join(self._working_directory, 'prefilter')])
+            elif kmer_prefilter:
+                forward_read_files, reverse_read_files = run_stage(
+                    'prefilter',
+                    lambda: self._kmer_prefilter(hmms, forward_read_files, reverse_read_files),
+                    [os.path.join(self._working_directory, 'prefilter')])
+
+            search_result = run_stage(
+                'search',
+                lambda: self._search(hmms, forward_read_files, reverse_read_files),
+                [os.path.join(self._working_directory, 'graftm_protein_search'),
+                 os.path.join(self._working_directory, 'graftm_nucleotide_search'),
+                 os.path.join(self._working_directory, 'search_chunks')])
+            sample_names = search_result.samples_with_hits()
+            if len(sample_names) == 0:
+                return False
+            logging.debug("Recovered %i samples with at least one hit e.g. '%s'"
+                         % (len(sample_names), sample_names[0]))
+
+            #### Alignment
+            align_result = run_stage(
+                'align',
+                lambda: self._align(search_result),
+                [os.path.join(self._working_directory, 'graftm_separates')])
+
+            ### Extract reads which do not have known taxonomy
+            def extract():
+                extracted_reads = self._extract_relevant_reads(
+                    align_result, include_inserts, known_taxes)
+                logging.info("Finished extracting aligned sequences")
+                return extracted_reads
+            extracted_reads = run_stage('extract', extract)
+
+            #### Taxonomic assignment
+            if assign_taxonomy:
+                def assign():
+                    logging.info("Running taxonomic assignment with GraftM..")
+                    assignment_result = self._assign_taxonomy(
+                        extracted_reads, graftm_assignment_method)
+                    # The extracted reads are returned too since their tmpfile
+                    # basenames are set during assignment.
+                    return assignment_result, extracted_reads
+                assignment_result, extracted_reads = run_stage(
+                    'assign', assign,
+                    [os.path.join(self._working_directory, 'graftm_aligns')])
+
+            #### Process taxonomically assigned reads
+            def build_otu_table():
+                batch_otu_table = OtuTable()
+                self._assignment_file_cache = {}
+                for readset in extracted_reads:
+                    self._process_taxonomically_assigned_reads(
+                        # inputs
+                        readset,
+                        analysing_pairs,
+                        known_taxes,
+                        known_sequence_taxonomy,
+                        assign_taxonomy,
+                        singlem_assignment_method,
+                        assignment_result if assign_taxonomy else None,
+                        output_jplace,
+                        known_sequence_tax if known_sequence_taxonomy else None,
+                        # outputs
+                        batch_otu_table,
+                        package_to_taxonomy_tree)
+                if search_result.sample_to_fraction_read:
+                    self._extrapolate_coverage(
+                        batch_otu_table, search_result.sample_to_fraction_read)
+                return batch_otu_table.data
+            otu_table_object.data.extend(
+                run_stage('otu_table', build_otu_table))
+            return True
+
+        if sample_batch_size is None:
+            found_hits = run_batch(forward_read_files, reverse_read_files, None)
+        else:
+            # Stream samples through the pipeline a batch at a time, so that
+            # the intermediate files of at most sample_batch_size samples are
+            # in the working directory at once.
+            found_hits = False
+            num_batches = int(math.ceil(float(len(forward_read_files)) / sample_batch_size))
+            for batch_index in range(num_batches):
+                start = batch_index * sample_batch_size
+                end = start + sample_batch_size
+                logging.info("Processing sample batch %i of %i" % (
+                    batch_index+1, num_batches))
+                batch_name = 'sample_batch%i' % batch_index
+                batch_directory = os.path.join(working_directory, batch_name)
+                os.makedirs(batch_directory, exist_ok=resume)
+                self._working_directory = batch_directory
+                tempfile.tempdir = os.path.join(batch_directory, 'tmp')
+                os.makedirs(tempfile.tempdir, exist_ok=resume)
+                if run_batch(
+                        forward_read_files[start:end],
+                        reverse_read_files[start:end] if analysing_pairs else None,
+                        batch_name):
+                    found_hits = True
+                logging.debug("Removing intermediate files of sample batch %i" % (
+                    batch_index+1))
+                shutil.rmtree(batch_directory)
+                if self._shared_memory_budget is not None:
+                    self._shared_memory_budget.release(batch_directory)
+            self._working_directory = working_directory
+            tempfile.tempdir = tempfile_directory
+
+        if not found_hits:
+            logging.info("No reads identified in any samples, stopping")
+            return_cleanly()
+            return None
 
         return_cleanly()
         return otu_table_object
 
-    def _get_windowed_sequences(self, protein_sequences, nucleotide_sequence_file,
+    def _get_windowed_sequences(self, protein_alignment, nucleotide_sequences,
                                 singlem_package, include_inserts):
-        if not os.path.exists(nucleotide_sequence_file) or \
-            os.stat(nucleotide_sequence_file).st_size == 0: return []
-        nucleotide_sequences = SeqReader().read_nucleotide_sequences(nucleotide_sequence_file)
-        protein_alignment = self._align_proteins_to_hmm(
-            protein_sequences,
-            singlem_package.graftm_package().alignment_hmm_path())
-        return MetagenomeOtuFinder().find_windowed_sequences(
+        if len(nucleotide_sequences) == 0: return []
+        return MetagenomeOtuFinder().stream_windowed_sequences(
             protein_alignment,
             nucleotide_sequences,
             singlem_package.window_size(),
@@ -266,60 +536,80 @@ class SearchPipe:
             singlem_package.is_protein_package(),
             best_position=singlem_package.singlem_position())
 
+    def _extract_reads(self, sample_name, singlem_package, protein_alignment,
+                       nucleotide_sequence_fasta_file, include_inserts,
+                       read_direction, known_taxonomy):
+        '''Extract the reads from one sample, package and read direction,
+        returning an ExtractedReadSet.'''
+        if os.path.exists(nucleotide_sequence_fasta_file) and \
+           os.stat(nucleotide_sequence_fasta_file).st_size > 0:
+            nucleotide_sequences = SeqReader().read_nucleotide_sequences(
+                nucleotide_sequence_fasta_file)
+        else:
+            nucleotide_sequences = {}
+        aligned_seqs = self._get_windowed_sequences(
+            protein_alignment,
+            nucleotide_sequences,
+            singlem_package,
+            include_inserts)
+
+        known_sequences = []
+        unknown_sequences = []
+        for s in aligned_seqs:
+            if s.aligned_sequence in known_taxonomy:
+                known_sequences.append(s)
+            else:
+                unknown_sequences.append(s)
+
+        cached_sequences = []
+        cached_taxonomies = {}
+        if self._taxonomy_cache is not None and len(unknown_sequences) > 0:
+            cached_taxonomies = self._taxonomy_cache.lookup(
+                singlem_package,
+                self._singlem_assignment_method,
+                [s.aligned_sequence for s in unknown_sequences])
+            if len(cached_taxonomies) > 0:
+                cached_sequences = [s for s in unknown_sequences
+                                    if s.aligned_sequence in cached_taxonomies]
+                unknown_sequences = [s for s in unknown_sequences
+                                     if s.aligned_sequence not in cached_taxonomies]
+        logging.debug("For sample {} ({}), spkg {}, found {} known, {} cached and {} unknown OTU sequences".format(
+            sample_name,
+            read_direction,
+            singlem_package.base_directory(),
+            len(known_sequences),
+            len(cached_sequences),
+            len(unknown_sequences)))
+
+        if len(unknown_sequences) > 0:
+            extractor = singlem_sequence_extractor.SequenceExtractor()
+            logging.debug("Extracting reads for {} from {} ..".format(
+                singlem_package.base_directory(), nucleotide_sequence_fasta_file
+            ))
+            seqs = extractor.extract_from_sequences(
+                [s.name for s in unknown_sequences],
+                nucleotide_sequences)
+        else:
+            seqs = []
+        return ExtractedReadSet(
+            sample_name, singlem_package,
+            seqs, known_sequences, unknown_sequences,
+            cached_sequences, cached_taxonomies)
+
     def _extract_relevant_reads(self, alignment_result, include_inserts, known_taxonomy):
         '''Given a SingleMPipeAlignSearchResult, extract reads that will be used as
         part of the singlem choppage process.
 
+        Each sample, package and read direction is extracted independently, in
+        a pool of self._num_threads processes. The results are added to the
+        returned ExtractedReads in the same order regardless of the number of
+        processes.
+
         Returns
         -------
         ExtractedReads object
         '''
-
-        def extract_reads(
-                singlem_package,
-                prealigned_protein_sequences,
-                nucleotide_sequence_fasta_file,
-                include_inserts,
-                known_taxonomy,
-                read_direction):
-
-            aligned_seqs = self._get_windowed_sequences(
-                prealigned_protein_sequences,
-                nucleotide_sequence_fasta_file,
-                singlem_package,
-                include_inserts)
-
-            known_sequences = []
-            unknown_sequences = []
-            for s in aligned_seqs:
-                if s.aligned_sequence in known_taxonomy:
-                    known_sequences.append(s)
-                else:
-                    unknown_sequences.append(s)
-            logging.debug("For sample {} ({}), spkg {}, found {} known and {} unknown OTU sequences".format(
-                sample_name,
-                read_direction,
-                singlem_package.base_directory(),
-                len(known_sequences),
-                len(unknown_sequences)))
-
-            if len(unknown_sequences) > 0:
-                extractor = singlem_sequence_extractor.SequenceExtractor()
-                logging.debug("Extracting reads for {} from {} ..".format(
-                    singlem_package.base_directory(), nucleotide_sequence_fasta_file
-                ))
-                seqs = extractor.extract_and_read(
-                    [s.name for s in unknown_sequences],
-                    nucleotide_sequence_fasta_file)
-            else:
-                seqs = []
-            readset = ExtractedReadSet(
-                sample_name, singlem_package,
-                seqs, known_sequences, unknown_sequences)
-            return readset
-
-        extracted_reads = ExtractedReads(alignment_result.analysing_pairs)
-
+        tasks = []
         for sample_name in alignment_result.sample_names():
             for singlem_package in self._singlem_package_database:
                 for prealigned_file in alignment_result.prealigned_sequence_files(
@@ -332,62 +622,144 @@ class SearchPipe:
                         nucleotide_sequence_fasta_file = prealigned_file
 
                     if alignment_result.analysing_pairs:
-                        logging.debug("Extracting forward reads")
-                        if os.path.exists(prealigned_file[0]):
-                            prots = SeqReader().readfq(open(prealigned_file[0]))
-                        else:
-                            prots = []
-                        readset1 = extract_reads(
-                            singlem_package,
-                            prots,
-                            nucleotide_sequence_fasta_file[0],
-                            include_inserts,
-                            known_taxonomy,
-                            'forward')
-                        logging.debug("Extracting reverse reads")
-                        if os.path.exists(prealigned_file[1]):
-                            prots = SeqReader().readfq(open(prealigned_file[1]))
-                        else:
-                            prots = []
-                        readset2 = extract_reads(
-                            singlem_package,
-                            prots,
-                            nucleotide_sequence_fasta_file[1],
-                            include_inserts,
-                            known_taxonomy,
-                            'reverse')
-                        extracted_reads.add([readset1, readset2])
+                        tasks.append((
+                            sample_name, singlem_package, prealigned_file[0],
+                            nucleotide_sequence_fasta_file[0], include_inserts,
+                            'forward'))
+                        tasks.append((
+                            sample_name, singlem_package, prealigned_file[1],
+                            nucleotide_sequence_fasta_file[1], include_inserts,
+                            'reverse'))
                     else:
-                        if os.path.exists(prealigned_file):
-                            prots = SeqReader().readfq(open(prealigned_file))
-                        else:
-                            prots = []
-                        readset = extract_reads(
-                            singlem_package,
-                            prots,
-                            nucleotide_sequence_fasta_file,
-                            include_inserts,
-                            known_taxonomy,
-                            'forward')
-                        extracted_reads.add(readset)
+                        tasks.append((
+                            sample_name, singlem_package, prealigned_file,
+                            nucleotide_sequence_fasta_file, include_inserts,
+                            'forward'))
+
+        # Tasks are grouped by package, so that hmmalign is run once per
+        # package across all samples and read directions. Tasks which would
+        # yield no windowed sequences anyway are not aligned.
+        package_to_indexed_tasks = {}
+        readsets = [None] * len(tasks)
+        for i, task in enumerate(tasks):
+            singlem_package = task[1]
+            prealigned_file = task[2]
+            nucleotide_sequence_fasta_file = task[3]
+            if os.path.exists(prealigned_file) and \
+               os.path.exists(nucleotide_sequence_fasta_file) and \
+               os.stat(nucleotide_sequence_fasta_file).st_size > 0:
+                package_to_indexed_tasks.setdefault(
+                    singlem_package.base_directory(), []).append((i, task))
+            else:
+                readsets[i] = self._extract_reads(
+                    task[0], task[1], [], *task[3:], known_taxonomy)
+        jobs = list(package_to_indexed_tasks.values())
+
+        num_processes = min(self._num_threads, len(jobs))
+        if num_processes > 1:
+            logging.debug("Aligning and extracting reads for {} packages using {} processes".format(
+                len(jobs), num_processes))
+            if self._taxonomy_cache is not None:
+                # Each process opens its own connection to the cache.
+                self._taxonomy_cache.close()
+            with multiprocessing.Pool(
+                    num_processes,
+                    initializer=_initialise_extract_reads_worker,
+                    initargs=(self, known_taxonomy)) as pool:
+                indexed_readsets = itertools.chain.from_iterable(pool.imap_unordered(
+                    _align_and_extract_reads_worker, jobs, chunksize=1))
+                # Results are put back in the order of the tasks, so the output
+                # is deterministic.
+                for i, readset in indexed_readsets:
+                    readsets[i] = readset
+        else:
+            for indexed_tasks in jobs:
+                for i, readset in self._align_and_extract_reads(indexed_tasks, known_taxonomy):
+                    readsets[i] = readset
 
+        extracted_reads = ExtractedReads(alignment_result.analysing_pairs)
+        if alignment_result.analysing_pairs:
+            for i in range(0, len(readsets), 2):
+                extracted_reads.add([readsets[i], readsets[i+1]])
+        else:
+            for readset in readsets:
+                extracted_reads.add(readset)
         return extracted_reads
 
-    def _align_proteins_to_hmm(self, protein_sequences, hmm_file):
+    def _align_and_extract_reads(self, indexed_tasks, known_taxonomy):
+        '''Align the sequences of read extraction tasks of the same package to
+        its HMM with a single run of hmmalign, extracting the reads of each
+        task as its part of the alignment is read, so that the alignment is
+        never held in memory in full.
+
+        Parameters
+        ----------
+        indexed_tasks: list of (int, tuple)
+            index of each task and the task as generated in
+            _extract_relevant_reads
+        known_taxonomy: dict-like
+            as for _extract_reads
+
+        Returns
+        -------
+        list of (int, ExtractedReadSet) tuples, the index of each task and
+        its extracted reads
+        '''
+        singlem_package = indexed_tasks[0][1][1]
+        index_to_task = dict(indexed_tasks)
+        logging.debug("Aligning sequences from {} sample/direction combinations to {}".format(
+            len(indexed_tasks), singlem_package.base_directory()))
+
+        def tagged_sequences():
+            # Prefix each name with the task index so the alignment can be
+            # split back up as it is read.
+            for i, task in indexed_tasks:
+                with open(task[2]) as f:
+                    for (name, seq, _) in SeqReader().readfq(f):
+                        yield ('%i_%s' % (i, name), seq)
+
+        def untagged_alignment():
+            # Insert gaps are kept as '.', so that each sequence's window can
+            # be found from that sequence alone.
+            for aligned_sequence in self._stream_aligned_proteins(
+                    tagged_sequences(),
+                    singlem_package.graftm_package().alignment_hmm_path(),
+                    keep_insert_gaps=True):
+                index, _, name = aligned_sequence.name.partition('_')
+                aligned_sequence.name = name
+                yield int(index), aligned_sequence
+
+        # hmmalign outputs sequences in the order they were input, so the
+        # sequences of each task are together.
+        indexed_readsets = []
+        for i, group in itertools.groupby(untagged_alignment(), lambda x: x[0]):
+            if i not in index_to_task:
+                raise Exception(
+                    "Unexpected order of sequences in hmmalign output")
+            task = index_to_task.pop(i)
+            indexed_readsets.append((i, self._extract_reads(
+                task[0], task[1], (aligned_sequence for _, aligned_sequence in group),
+                *task[3:], known_taxonomy)))
+        # Tasks none of whose sequences were aligned
+        for i, task in index_to_task.items():
+            indexed_readsets.append((i, self._extract_reads(
+                task[0], task[1], [], *task[3:], known_taxonomy)))
+        return indexed_readsets
+
+    def _align_proteins_to_hmm(self, protein_sequences, hmm_file, keep_insert_gaps=False):
         '''hmmalign proteins to hmm, and return an alignment object
 
         Parameters
         ----------
         protein_sequences: generator / list of tuple(name,sequence) objects
         from SeqReader().
+        keep_insert_gaps: boolean
+            if True, leave gaps in insert columns as '.' rather than converting
+            them to '-'.
 
         '''
-        cmd = "hmmalign '{}' /dev/stdin".format(hmm_file)
-        output = extern.run(cmd, stdin=''.join([
-            ">{}\n{}\n".format(s[0], s[1]) for s in protein_sequences]))
-        protein_alignment = []
-        for record in SeqIO.parse(StringIO(output), 'stockholm'):
-            protein_alignment.append(AlignedProteinSequence(record.name, str(record.seq)))
+        protein_alignment = list(self._stream_aligned_proteins(
+            protein_sequences, hmm_file, keep_insert_gaps))
         if len(protein_alignment) > 0:
             logging.debug("Read in %i aligned sequences e.g. %s %s" % (
                 len(protein_alignment),
@@ -397,6 +769,71 @@ class SearchPipe:
             logging.debug("No aligned sequences found for this HMM")
         return protein_alignment
 
+    def _stream_aligned_proteins(self, protein_sequences, hmm_file, keep_insert_gaps=False):
+        '''hmmalign proteins to hmm, yielding an AlignedProteinSequence for
+        each as hmmalign's output is read. Arguments are as for
+        _align_proteins_to_hmm.'''
+        protein_sequences = iter(protein_sequences)
+        first_sequence = next(protein_sequences, None)
+        if first_sequence is None:
+            return
+
+        cmd = "hmmalign --outformat Pfam '{}' /dev/stdin".format(hmm_file)
+        logging.debug("Running cmd: %s" % cmd)
+        with tempfile.TemporaryFile() as stderr:
+            process = subprocess.Popen(
+                ["bash", "-c", cmd],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr,
+                universal_newlines=True)
+
+            # Write stdin in a separate thread so that neither process blocks
+            # on a full pipe.
+            write_errors = []
+            def write_sequences():
+                try:
+                    for s in itertools.chain([first_sequence], protein_sequences):
+                        process.stdin.write(">{}\n{}\n".format(s[0], s[1]))
+                    process.stdin.close()
+                except BrokenPipeError:
+                    # hmmalign exited early, which is reported below.
+                    pass
+                except Exception as e:
+                    write_errors.append(e)
+                    process.kill()
+            writer = threading.Thread(target=write_sequences)
+            writer.start()
+
+            finished = False
+            try:
+                # Pfam format is Stockholm with one line per sequence. As per
+                # Biopython's Stockholm parser, '.' gaps are converted to '-'
+                # unless they are to be kept.
+                for line in process.stdout:
+                    if line[0] in '#/\n': continue
+                    name, seq = line.split()
+                    if not keep_insert_gaps:
+                        seq = seq.replace('.', '-')
+                    yield AlignedProteinSequence(name, seq)
+                finished = True
+            finally:
+                # If the alignment was not read to the end, e.g. because
+                # extraction failed, stop hmmalign rather than waiting for it.
+                if not finished:
+                    process.kill()
+                # Closing the output stops anything still writing to it, so
+                # the writer thread is not left blocked.
+                process.stdout.close()
+                writer.join()
+                returncode = process.wait()
+            if len(write_errors) > 0:
+                raise write_errors[0]
+            if returncode != 0:
+                stderr.seek(0)
+                raise extern.ExternCalledProcessError(
+                    subprocess.CompletedProcess(
+                        cmd, returncode, '', stderr.read().decode()),
+                    cmd)
+
     def _process_taxonomically_assigned_reads(
             self,
             # inputs
@@ -411,7 +848,7 @@ class SearchPipe:
             known_sequence_tax,
             # outputs
             otu_table_object,
-            package_to_taxonomy_bihash):
+            package_to_taxonomy_tree):
 
         # To deal with paired reads, process each. Then exclude second reads
         # from pairs where both match.
@@ -422,58 +859,80 @@ class SearchPipe:
         sample_name = readset_example.sample_name
         singlem_package = readset_example.singlem_package
         
-        def add_info(infos, otu_table_object, known_tax):
-            for info in infos:
+        def add_info(aggregator, otu_taxonomies, otu_table_object, known_tax):
+            counts = aggregator.counts()
+            coverages = aggregator.coverages()
+            for i, seq in enumerate(aggregator.sequences):
                 to_print = [
                     singlem_package.graftm_package_basename(),
                     sample_name,
-                    info.seq,
-                    info.count,
-                    info.coverage,
-                    info.taxonomy,
-                    list(sorted(info.names)),
-                    info.aligned_lengths,
+                    seq,
+                    int(counts[i]),
+                    float(coverages[i]),
+                    otu_taxonomies[i],
+                    list(sorted(aggregator.names[i])) if aggregator.names is not None else [],
+                    aggregator.aligned_lengths[i] if aggregator.names is not None else [],
                     known_tax]
                 otu_table_object.data.append(to_print)
 
         def extract_placement_parser(
-                sample_name, singlem_package, tmpbase, taxonomy_bihash):
+                sample_name, singlem_package, tmpbase, taxonomy_tree):
             base_dir = assignment_result._base_dir(
                 sample_name, singlem_package, tmpbase)
             jplace_file = os.path.join(base_dir, "placements.jplace")
             logging.debug("Attempting to read jplace output from {}".format(
                 jplace_file))
             placement_threshold = 0.5
+            if not analysing_pairs and jplace_file in self._assignment_file_cache:
+                return self._assignment_file_cache[jplace_file]
             if os.path.exists(jplace_file):
                 with open(jplace_file) as f:
-                    jplace_json = json.loads(f.read())
-                if analysing_pairs:
-                    placement_parser = PlacementParser(
-                        jplace_json, taxonomy_bihash, placement_threshold)
-                else:
-                    placement_parser = PlacementParser(
-                        jplace_json, taxonomy_bihash, placement_threshold)
+                    placement_parser = PlacementParser.parse_jplace(
+                        f, taxonomy_tree, placement_threshold)
             else:
                 # Sometimes alignments are filtered out.
                 placement_parser = None
+            if not analysing_pairs and self._deduplicate_assignment:
+                # All samples share the one placement file.
+                self._assignment_file_cache[jplace_file] = placement_parser
             return placement_parser
 
         def process_readset(readset, analysing_pairs):
-            known_infos = self._seqs_to_counts_and_taxonomy(
+            known_aggregator, known_otu_taxonomies = self._seqs_to_counts_and_taxonomy(
                 readset.known_sequences if not analysing_pairs else itertools.chain(
                     readset[0].known_sequences, readset[1].known_sequences),
                 NO_ASSIGNMENT_METHOD,
                 known_taxes,
                 known_sequence_taxonomy,
                 None)
-            add_info(known_infos, otu_table_object, True)
+            add_info(known_aggregator, known_otu_taxonomies, otu_table_object, True)
+
+            # Sequences with taxonomy from the taxonomy cache
+            if analysing_pairs:
+                cached_sequences = list(itertools.chain(
+                    readset[0].cached_sequences, readset[1].cached_sequences))
+                cached_taxonomies = dict(readset[0].cached_taxonomies)
+                cached_taxonomies.update(readset[1].cached_taxonomies)
+            else:
+                cached_sequences = readset.cached_sequences
+                cached_taxonomies = readset.cached_taxonomies
+            if len(cached_sequences) > 0:
+                cached_aggregator, _ = self._seqs_to_counts_and_taxonomy(
+                    cached_sequences, NO_ASSIGNMENT_METHOD, {}, None, None)
+                cached_otu_taxonomies = [
+                    cached_taxonomies[seq] for seq in cached_aggregator.sequences]
+                add_info(cached_aggregator, cached_otu_taxonomies, otu_table_object, False)
+                # Mark the cached sequences as recently used
+                self._taxonomy_cache.store(
+                    singlem_package, singlem_assignment_method,
+                    dict(zip(cached_aggregator.sequences, cached_otu_taxonomies)))
 
             if not analysing_pairs and len(readset.unknown_sequences) == 0:
-                return []
+                return
             elif analysing_pairs and \
                  len(readset[0].unknown_sequences) == 0 and \
                  len(readset[1].unknown_sequences) == 0:
-                return []
+                return
             else: # if any sequences were aligned (not just already known)
                 if assign_taxonomy:
                     if analysing_pairs:
@@ -498,7 +957,8 @@ class SearchPipe:
                         else:
                             tax_file = assignment_result.diamond_assignment_file(
                                 sample_name, singlem_package, readset.tmpfile_basename)
-                            taxonomies = DiamondResultParser(tax_file)
+                            taxonomies = self._read_assignment_file(
+                                tax_file, DiamondResultParser)
 
                     elif singlem_assignment_method == DIAMOND_ASSIGNMENT_METHOD:
                         def process_taxonomy_file(taxonomy_file_path, is_forward):
@@ -540,41 +1000,38 @@ class SearchPipe:
                                 taxonomies.merge(taxonomy2)
 
                         else:
-                            taxonomies = process_taxonomy_file(
+                            taxonomies = self._read_assignment_file(
                                 assignment_result.read_tax_file(
                                     sample_name, singlem_package, readset.tmpfile_basename),
-                                None)
+                                lambda path: process_taxonomy_file(path, None))
                             if taxonomies is None:
                                 taxonomies = {}
 
                     elif singlem_assignment_method == PPLACER_ASSIGNMENT_METHOD:
-                        bihash_key = singlem_package.base_directory()
-                        if bihash_key in package_to_taxonomy_bihash:
-                            taxonomy_bihash = package_to_taxonomy_bihash[bihash_key]
+                        tree_key = singlem_package.base_directory()
+                        if tree_key in package_to_taxonomy_tree:
+                            taxonomy_tree = package_to_taxonomy_tree[tree_key]
                         else:
-                            taxtastic_taxonomy = singlem_package.graftm_package().taxtastic_taxonomy_path()
-                            logging.debug("Reading taxtastic taxonomy from %s" % taxtastic_taxonomy)
-                            with open(taxtastic_taxonomy) as f:
-                                taxonomy_bihash = TaxonomyBihash.parse_taxtastic_taxonomy(f)
-                            package_to_taxonomy_bihash[bihash_key] = taxonomy_bihash
+                            taxonomy_tree = TaxonomyTree.acquire(singlem_package)
+                            package_to_taxonomy_tree[tree_key] = taxonomy_tree
 
                         if analysing_pairs:
                             placement_parser1 = extract_placement_parser(
                                 sample_name, singlem_package, readset[0].tmpfile_basename,
-                                taxonomy_bihash)
+                                taxonomy_tree)
                             placement_parser2 = extract_placement_parser(
                                 sample_name, singlem_package, readset[1].tmpfile_basename,
-                                taxonomy_bihash)
+                                taxonomy_tree)
                             if placement_parser1 is None:
                                 placement_parser = placement_parser2
                             else:
                                 if placement_parser2 is not None:
-                                    placement_parser1.merge(placement_parser2)
+                                    placement_parser1.merge_reverse(placement_parser2)
                                 placement_parser = placement_parser1
                         else:
                             placement_parser = extract_placement_parser(
                                 sample_name, singlem_package, readset.tmpfile_basename,
-                                taxonomy_bihash)
+                                taxonomy_tree)
                         taxonomies = {}
                     elif singlem_assignment_method == NO_ASSIGNMENT_METHOD:
                         taxonomies = {}
@@ -588,11 +1045,24 @@ class SearchPipe:
                     else:
                         taxonomies = {}
 
-                new_infos = list(self._seqs_to_counts_and_taxonomy(
+                new_aggregator, new_otu_taxonomies = self._seqs_to_counts_and_taxonomy(
                     aligned_seqs, singlem_assignment_method,
                     known_sequence_tax if known_sequence_taxonomy else {},
                     taxonomies,
-                    placement_parser if singlem_assignment_method == PPLACER_ASSIGNMENT_METHOD else None))
+                    placement_parser if singlem_assignment_method == PPLACER_ASSIGNMENT_METHOD else None,
+                    readset.window_representatives if assign_taxonomy and not analysing_pairs else None)
+
+                if assign_taxonomy and self._taxonomy_cache is not None:
+                    if analysing_pairs:
+                        unknown_sequences = set(s.aligned_sequence for s in itertools.chain(
+                            readset[0].unknown_sequences, readset[1].unknown_sequences))
+                    else:
+                        unknown_sequences = set(s.aligned_sequence for s in readset.unknown_sequences)
+                    self._taxonomy_cache.store(
+                        singlem_package, singlem_assignment_method,
+                        dict((seq, tax) for seq, tax in
+                             zip(new_aggregator.sequences, new_otu_taxonomies)
+                             if seq in unknown_sequences and tax != ''))
 
                 if output_jplace:
                     if analysing_pairs:
@@ -608,40 +1078,56 @@ class SearchPipe:
                             input_jplace_file, output_jplace_file))
                         with open(output_jplace_file, 'w') as output_jplace_io:
                             with open(input_jplace_file) as input_jplace_io:
-                                self._write_jplace_from_infos(
-                                    input_jplace_io, new_infos, output_jplace_io)
+                                self._write_jplace_from_aggregator(
+                                    input_jplace_io, new_aggregator, output_jplace_io)
 
-                return new_infos
+                add_info(new_aggregator, new_otu_taxonomies, otu_table_object,
+                         not assign_taxonomy)
 
         if analysing_pairs:
-            forward_names = set([u.name for u in maybe_paired_readset[0].unknown_sequences])
+            forward_names = set([u.name for u in itertools.chain(
+                maybe_paired_readset[0].unknown_sequences,
+                maybe_paired_readset[0].cached_sequences)])
             # Remove sequences from the second set when they occur in the first set
-            indices_to_remove = []
-            for i, u in enumerate(maybe_paired_readset[1].unknown_sequences):
-                if u.name in forward_names:
-                    logging.debug("Removing sequence '{}' from the set of aligned reverse reads".format(
-                        u.name))
-                    indices_to_remove.append(i)
-            for i in reversed(indices_to_remove):
-                del maybe_paired_readset[1].unknown_sequences[i]
+            num_removed = 0
+            for reverse_sequences in (maybe_paired_readset[1].unknown_sequences,
+                                      maybe_paired_readset[1].cached_sequences):
+                indices_to_remove = []
+                for i, u in enumerate(reverse_sequences):
+                    if u.name in forward_names:
+                        logging.debug("Removing sequence '{}' from the set of aligned reverse reads".format(
+                            u.name))
+                        indices_to_remove.append(i)
+                for i in reversed(indices_to_remove):
+                    del reverse_sequences[i]
+                num_removed += len(indices_to_remove)
             logging.debug(
                 "Removed {} sequences from reverse read set as the forward read was also detected".format(
-                    len(indices_to_remove)))
+                    num_removed))
 
-        new_infos = process_readset(maybe_paired_readset, analysing_pairs)
-        add_info(new_infos, otu_table_object, not assign_taxonomy)
+        process_readset(maybe_paired_readset, analysing_pairs)
 
 
 
+    def _read_assignment_file(self, path, parse):
+        '''Return parse(path). When taxonomic assignment is deduplicated, each
+        package's assignment file is shared by all samples, so it is only
+        parsed once.'''
+        if not self._deduplicate_assignment:
+            return parse(path)
+        if path not in self._assignment_file_cache:
+            self._assignment_file_cache[path] = parse(path)
+        return self._assignment_file_cache[path]
+
     def _seqs_to_counts_and_taxonomy(self, sequences,
                                      assignment_method,
                                      otu_sequence_assigned_taxonomies,
                                      per_read_taxonomies,
-                                     placement_parser):
+                                     placement_parser,
+                                     window_representatives=None):
         '''Given an array of UnalignedAlignedNucleotideSequence objects, and taxonomic
-        assignment-related results, yield over 'Info' objects that contain e.g.
-        the counts of the aggregated sequences and corresponding median
-        taxonomies.
+        assignment-related results, aggregate the sequences by OTU sequence and
+        work out the taxonomy of each, e.g. the median taxonomy of its reads.
 
         Parameters
         ----------
@@ -653,64 +1139,52 @@ class SearchPipe:
         per_read_taxonomies: dict-like of read name to taxonomy
         placement_parser: PlacementParser
             Used only if assignment_method is PPLACER_ASSIGNMENT_METHOD.
+        window_representatives: dict of str to (str, str) or None
+            If taxonomy was assigned to one representative read per OTU
+            sequence, a dict of OTU sequence to the representative's read
+            name and ORF name, which are used to look up the taxonomy of each
+            sequence.
+
+        Returns
+        -------
+        (SequenceAggregator, list of str) tuple of the aggregated sequences and
+        the taxonomy of each distinct sequence, in the same order
         '''
-        class CollectedInfo:
-            def __init__(self):
-                self.count = 0
-                self.taxonomies = []
-                self.names = []
-                self.coverage = 0.0
-                self.aligned_lengths = []
-                self.orf_names = []
-                self.known_sequence_taxonomies = []
-
-        seq_to_collected_info = {}
+        collect_taxonomies = bool(per_read_taxonomies) and \
+            assignment_method != PPLACER_ASSIGNMENT_METHOD
+        collect_orf_names = assignment_method == PPLACER_ASSIGNMENT_METHOD and \
+            placement_parser is not None
+        aggregator = SequenceAggregator(
+            self._collect_read_names, collect_taxonomies, collect_orf_names)
         for s in sequences:
-            if s.aligned_sequence in otu_sequence_assigned_taxonomies or \
-               per_read_taxonomies is None:
-                tax = None
+            if window_representatives is not None and \
+               s.aligned_sequence in window_representatives:
+                assigned_name, assigned_orf_name = window_representatives[s.aligned_sequence]
             else:
+                assigned_name = s.name
+                assigned_orf_name = s.orf_name
+            tax = None
+            if collect_taxonomies and \
+               s.aligned_sequence not in otu_sequence_assigned_taxonomies:
                 try:
-                    tax = per_read_taxonomies[s.name]
+                    tax = per_read_taxonomies[assigned_name]
                 except KeyError:
-                    if assignment_method != NO_ASSIGNMENT_METHOD and \
-                       assignment_method != PPLACER_ASSIGNMENT_METHOD:
-                        # happens sometimes when HMMER picks up something where
-                        # diamond does not, or when --no_assign_taxonomy is specified.
-                        logging.debug("Did not find any taxonomy information for %s" % s.name)
-                        tax = ''
+                    # happens sometimes when HMMER picks up something where
+                    # diamond does not, or when --no_assign_taxonomy is specified.
+                    logging.debug("Did not find any taxonomy information for %s" % assigned_name)
+                    tax = ''
+            aggregator.add(s, tax, assigned_orf_name)
 
-            try:
-                collected_info = seq_to_collected_info[s.aligned_sequence]
-            except KeyError:
-                collected_info = CollectedInfo()
-                seq_to_collected_info[s.aligned_sequence] = collected_info
-
-            collected_info.count += 1
-            if per_read_taxonomies: collected_info.taxonomies.append(tax)
-            collected_info.names.append(s.name)
-            collected_info.coverage += s.coverage_increment()
-            collected_info.aligned_lengths.append(s.aligned_length)
-            collected_info.orf_names.append(s.orf_name)
-
-        class Info:
-            def __init__(self, seq, count, taxonomy, names, coverage, aligned_lengths):
-                self.seq = seq
-                self.count = count
-                self.taxonomy = taxonomy
-                self.names = names
-                self.coverage = coverage
-                self.aligned_lengths = aligned_lengths
-
-        for seq, collected_info in seq_to_collected_info.items():
-            if s.aligned_sequence in otu_sequence_assigned_taxonomies:
-                tax = otu_sequence_assigned_taxonomies[s.aligned_sequence].taxonomy
+        otu_taxonomies = []
+        for i, seq in enumerate(aggregator.sequences):
+            if seq in otu_sequence_assigned_taxonomies:
+                tax = otu_sequence_assigned_taxonomies[seq].taxonomy
             elif assignment_method == DIAMOND_EXAMPLE_BEST_HIT_ASSIGNMENT_METHOD:
-                tax = collected_info.taxonomies[0]
+                tax = aggregator.taxonomies[i][0] if collect_taxonomies else None
                 if tax is None: tax = ''
             elif assignment_method == PPLACER_ASSIGNMENT_METHOD and placement_parser is not None:
                 placed_tax = placement_parser.otu_placement(
-                    collected_info.orf_names)
+                    aggregator.orf_names[i])
                 if placed_tax is None:
                     tax = ''
                 else:
@@ -718,53 +1192,26 @@ class SearchPipe:
             elif per_read_taxonomies is None:
                 tax = ''
             else:
-                tax = self._median_taxonomy(collected_info.taxonomies)
-
-            yield Info(seq,
-                       collected_info.count,
-                       tax,
-                       collected_info.names,
-                       collected_info.coverage,
-                       collected_info.aligned_lengths)
+                tax = self._median_taxonomy(
+                    aggregator.taxonomies[i] if collect_taxonomies else [])
+            otu_taxonomies.append(tax)
+        return aggregator, otu_taxonomies
 
 
 
     def _median_taxonomy(self, taxonomies):
-        levels_to_counts = []
-        for tax_string in taxonomies:
-            for i, tax in enumerate(tax_string.split(';')):
-                tax = tax.strip()
-                if i >= len(levels_to_counts):
-                    levels_to_counts.append({})
-                try:
-                    levels_to_counts[i][tax] += 1
-                except KeyError:
-                    levels_to_counts[i][tax] = 1
-
-        median_tax = []
-        for level_counts in levels_to_counts:
-            max_count = 0
-            max_tax = None
-            for tax, count in level_counts.items():
-                if count > max_count:
-                    max_count = count
-                    max_tax = tax
-            if float(max_count) / len(taxonomies) > 0.5:
-                median_tax.append(max_tax)
-            else:
-                break
-        return '; '.join(median_tax)
+        return self._median_taxonomy_calculator.median(taxonomies)
 
-    def _write_jplace_from_infos(self, input_jplace_io, infos, output_jplace_io):
+    def _write_jplace_from_aggregator(self, input_jplace_io, aggregator, output_jplace_io):
 
         jplace = json.load(input_jplace_io)
         if jplace['version'] != 3:
             raise Exception("SingleM currently only works with jplace version 3 files, sorry")
 
-        name_to_info = {}
-        for info in infos:
-            for name in info.names:
-                name_to_info[name] = info
+        name_to_index = {}
+        for i, names in enumerate(aggregator.names):
+            for name in names:
+                name_to_index[name] = i
 
         # rewrite placements to be OTU-wise instead of sequence-wise
         orfm_utils = OrfMUtils()
@@ -780,15 +1227,15 @@ class SearchPipe:
                     raise Exception("Unexpected jplace format detected in nm %s" % name_and_count)
                 name, count = name_and_count
                 real_name = another_regex.sub('', orfm_utils.un_orfm_name(name))
-                info = name_to_info[real_name]
-                sequence = info.seq
+                i = name_to_index[real_name]
+                sequence = aggregator.sequences[i]
 
                 try:
                     sequence_to_count[sequence] += count
                 except KeyError:
                     sequence_to_count[sequence] = count
 
-                if real_name == info.names[0] and \
+                if real_name == aggregator.names[i][0] and \
                    sequence not in sequence_to_example_p: # For determinism:
                     sequence_to_example_p[sequence] = placement['p']
 
@@ -818,6 +1265,23 @@ class SearchPipe:
 
         return cmd+' '
     
+    def _run_command(self, command):
+        '''Run a command with extern.run(), recording its resource usage in
+        the timing report if one is being made.'''
+        if self._timing_report is None:
+            return extern.run(command)
+        else:
+            return self._timing_report.run(command)
+
+    def _run_commands(self, commands, num_threads):
+        '''As _run_command() but run several commands, num_threads at a
+        time.'''
+        if self._timing_report is None:
+            return extern.run_many(commands, num_threads=num_threads)
+        else:
+            with multiprocessing.pool.ThreadPool(num_threads) as pool:
+                return pool.map(self._timing_report.run, commands)
+
     def _prefilter(self, singlem_package_database, read_files):
         '''Find all reads that match the DIAMOND database in the 
         singlem_package database.
@@ -861,11 +1325,57 @@ class SearchPipe:
                       self._num_threads,
                       dmnd,
                       fasta_path)
-            extern.run(cmd)
+            self._run_command(cmd)
             filtered_reads.append(fasta_path)
             
         return filtered_reads
 
+    def _kmer_prefilter(self, singlem_package_database, forward_read_files, reverse_read_files):
+        '''Find all reads that share a k-mer with the sequences of any package
+        in the singlem_package_database. Reads pairs are kept if either read
+        matches.
+        Parameters
+        ----------
+        singlem_package_database: HmmDatabase
+            packages to search the reads for
+        forward_read_files: list of str
+            paths to the sequences to be searched
+        reverse_read_files: list of str or None
+            paths to the reverse sequences to be searched, or None
+        Returns
+        -------
+        paths to fasta files of filtered forward reads, and of filtered
+        reverse reads or None
+        '''
+        logging.info("Filtering sequence files by k-mers shared with the SingleM packages")
+        prefilter = KmerPrefilter(list(singlem_package_database))
+
+        prefilter_dir = os.path.join(self._working_directory, 'prefilter')
+        os.mkdir(prefilter_dir)
+        def output_path(file, suffix):
+            fasta_path = os.path.join(prefilter_dir, os.path.basename(file))
+            if fasta_path[-3:] == '.gz':
+                fasta_path = fasta_path[:-3] # remove .gz for destination files
+            return os.path.splitext(fasta_path)[0] + suffix + '.fna'
+
+        filtered_forward = []
+        filtered_reverse = None if reverse_read_files is None else []
+        for i, file in enumerate(forward_read_files):
+            forward_output = output_path(file, '')
+            filtered_forward.append(forward_output)
+            if reverse_read_files is None:
+                num_reads, num_kept = prefilter.filter(file, forward_output)
+            else:
+                # Forward and reverse files may have the same base name
+                reverse_output = output_path(reverse_read_files[i], '_reverse')
+                filtered_reverse.append(reverse_output)
+                num_reads, num_kept = prefilter.filter(
+                    file, forward_output, reverse_read_files[i], reverse_output)
+            logging.info("Kept %i of %i reads from %s after k-mer prefiltering" % (
+                num_kept, num_reads, file))
+        logging.info("Finished k-mer prefilter phase")
+        return filtered_forward, filtered_reverse
+
     def _search(self, singlem_package_database, forward_read_files, reverse_read_files):
         '''Find all reads that match one or more of the search HMMs in the
         singlem_package_database.
@@ -888,35 +1398,18 @@ class SearchPipe:
         graftm_nucleotide_search_directory = os.path.join(
             self._working_directory, 'graftm_nucleotide_search')
 
-        def run(hmm_paths, output_directory, is_protein):
-            cmd = self._graftm_command_prefix(is_protein) + \
-                  "--threads %i "\
-                  "--forward %s "\
-                  "--search_only "\
-                  "--search_hmm_files %s "\
-                  "--output_directory %s "\
-                  "--aln_hmm_file %s " % (
-                      self._num_threads,
-                      ' '.join(forward_read_files),
-                      ' '.join(hmm_paths),
-                      output_directory,
-                      hmm_paths[0])
-            if reverse_read_files is not None:
-                cmd += "--reverse {} ".format(
-                    ' '.join(reverse_read_files))
-            extern.run(cmd)
-
+        searches = []
         num_singlem_packages = len(singlem_package_database.protein_packages())+\
                                len(singlem_package_database.nucleotide_packages())
         logging.info("Searching with %i SingleM package(s)" % num_singlem_packages)
-        
+
         # Run searches for proteins
         hmms = singlem_package_database.protein_search_hmm_paths()
         doing_proteins = False
         if len(hmms) > 0:
             doing_proteins = True
             logging.info("Searching for reads matching %i different protein HMM(s)" % len(hmms))
-            run(hmms, graftm_protein_search_directory, True)
+            searches.append((hmms, graftm_protein_search_directory, True))
 
         # Run searches for nucleotides
         hmms = singlem_package_database.nucleotide_search_hmm_paths()
@@ -924,7 +1417,17 @@ class SearchPipe:
         if len(hmms) > 0:
             doing_nucs = True
             logging.info("Searching for reads matching %i different nucleotide HMM(s)" % len(hmms))
-            run(hmms, graftm_nucleotide_search_directory, False)
+            searches.append((hmms, graftm_nucleotide_search_directory, False))
+
+        sample_to_fraction_read = {}
+        if self._search_chunk_size is None:
+            for (search_hmms, output_directory, is_protein) in searches:
+                self._run_command(self._graftm_search_command(
+                    search_hmms, output_directory, is_protein,
+                    forward_read_files, reverse_read_files, self._num_threads))
+        else:
+            sample_to_fraction_read = self._search_in_chunks(
+                searches, forward_read_files, reverse_read_files)
 
         logging.info("Finished search phase")
         analysing_pairs = reverse_read_files is not None
@@ -933,7 +1436,262 @@ class SearchPipe:
         nuc_graftm = GraftMResult(graftm_nucleotide_search_directory, analysing_pairs, search_hmm_files=hmms) if \
                      doing_nucs else None
         return SingleMPipeSearchResult(
-            protein_graftm, nuc_graftm, analysing_pairs)
+            protein_graftm, nuc_graftm, analysing_pairs, sample_to_fraction_read)
+
+    def _graftm_search_command(self, hmm_paths, output_directory, is_protein,
+                               forward_read_files, reverse_read_files, threads):
+        cmd = self._graftm_command_prefix(is_protein) + \
+              "--threads %i "\
+              "--forward %s "\
+              "--search_only "\
+              "--search_hmm_files %s "\
+              "--output_directory %s "\
+              "--aln_hmm_file %s " % (
+                  threads,
+                  ' '.join(forward_read_files),
+                  ' '.join(hmm_paths),
+                  output_directory,
+                  hmm_paths[0])
+        if reverse_read_files is not None:
+            cmd += "--reverse {} ".format(
+                ' '.join(reverse_read_files))
+        return cmd
+
+    def _search_in_chunks(self, searches, forward_read_files, reverse_read_files):
+        '''Search input files in chunks of self._search_chunk_size sequences,
+        searching self._num_threads chunks at a time with a single thread each.
+        Files with fewer sequences than that are searched together afterwards
+        with all threads. The results of each search are then merged into its
+        output directory as if the files had been searched whole.
+
+        When stopping early, no more chunks of a file are read once the
+        criteria of an EarlyStopper are met by the chunks searched so far.
+        Since the EarlyStopper evaluates chunks in the order they were read,
+        only the results of the chunks it used are kept, so the fraction of
+        each file read does not depend on the order the searches finish in.
+
+        Parameters
+        ----------
+        searches: list of (hmm_paths, output_directory, is_protein) tuples
+        forward_read_files: list of str
+        reverse_read_files: list of str or None
+
+        Returns
+        -------
+        dict of sample name to the approximate fraction of its file that was
+        read, for those samples not read in full
+        '''
+        chunk_directory_base = os.path.join(self._working_directory, 'search_chunks')
+        if self._shared_memory_budget is None:
+            os.mkdir(chunk_directory_base)
+        else:
+            # The budget is otherwise only checked once the search stage has
+            # finished, so the chunks and their search results, expected to be
+            # no larger than the input files, are put on disk now if they
+            # would not fit.
+            self._shared_memory_budget.make_directory(
+                chunk_directory_base,
+                sum(os.path.getsize(f) for f in
+                    forward_read_files + (reverse_read_files or [])))
+        chunker = SequenceChunker(self._search_chunk_size)
+        # For each sample chunked, (forward file, EarlyStopper or None, list
+        # of (chunk directory, sequences read, fraction read) for each chunk
+        # in the order read, whether reading was stopped early)
+        chunked_samples = []
+
+        def search_chunk(forward_chunk, reverse_chunk, chunk_directory,
+                         early_stopper, chunk_index, num_sequences):
+            try:
+                for (hmms, output_directory, is_protein) in searches:
+                    self._run_command(self._graftm_search_command(
+                        hmms,
+                        os.path.join(chunk_directory, os.path.basename(output_directory)),
+                        is_protein,
+                        [forward_chunk],
+                        None if reverse_chunk is None else [reverse_chunk],
+                        1))
+                if early_stopper is not None:
+                    early_stopper.add_chunk(
+                        chunk_index, num_sequences,
+                        self._count_search_hits(searches, chunk_directory, forward_chunk))
+                # Remove the chunk now to limit the space used in the working
+                # directory.
+                os.remove(forward_chunk)
+                if reverse_chunk is not None:
+                    os.remove(reverse_chunk)
+            except Exception:
+                search_failed.set()
+                raise
+            finally:
+                free_slots.release()
+
+        # Only write as many chunks as can be searched at once, plus one so
+        # that the next chunk is ready when a search finishes.
+        free_slots = threading.BoundedSemaphore(self._num_threads + 1)
+        # Set when the search of a chunk fails, so no more chunks are written.
+        search_failed = threading.Event()
+        unchunked_forward = []
+        unchunked_reverse = []
+        futures = []
+        with concurrent.futures.ThreadPoolExecutor(self._num_threads) as executor:
+            for i, forward in enumerate(forward_read_files):
+                if search_failed.is_set():
+                    break
+                reverse = None if reverse_read_files is None else reverse_read_files[i]
+                sample_directory = os.path.join(chunk_directory_base, str(i))
+                chunks = chunker.chunks(forward, reverse, sample_directory)
+                sequences_read = 0
+                sample_chunks = []
+                stopped_early = False
+                early_stopper = None
+                if self._early_stopping:
+                    early_stopper = EarlyStopper(
+                        [pkg.graftm_package_basename() for pkg in self._singlem_package_database],
+                        self._early_stop_hits,
+                        self._early_stop_convergence)
+                while True:
+                    free_slots.acquire()
+                    if search_failed.is_set():
+                        free_slots.release()
+                        chunks.close()
+                        break
+                    if early_stopper is not None and early_stopper.is_complete():
+                        free_slots.release()
+                        # Closing the generator closes the input file
+                        chunks.close()
+                        stopped_early = True
+                        break
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        free_slots.release()
+                        break
+                    num_sequences = chunker.sequences_read - sequences_read
+                    sequences_read = chunker.sequences_read
+                    forward_chunk, reverse_chunk = chunk
+                    if forward_chunk == forward:
+                        unchunked_forward.append(forward)
+                        if reverse is not None:
+                            unchunked_reverse.append(reverse)
+                        free_slots.release()
+                    else:
+                        chunk_directory = os.path.dirname(forward_chunk)
+                        logging.debug("Searching chunk {}".format(forward_chunk))
+                        futures.append(executor.submit(
+                            search_chunk, forward_chunk, reverse_chunk, chunk_directory,
+                            early_stopper, len(sample_chunks), num_sequences))
+                        sample_chunks.append((
+                            chunk_directory, chunker.sequences_read,
+                            chunker.fraction_read))
+                if len(sample_chunks) > 0:
+                    chunked_samples.append(
+                        (forward, early_stopper, sample_chunks, stopped_early))
+            if search_failed.is_set():
+                # Chunks that have not started being searched are abandoned,
+                # and the failure raised below.
+                for future in futures:
+                    future.cancel()
+            for future in futures:
+                if not future.cancelled():
+                    future.result()
+        logging.info("Searched {} chunks of large input files".format(len(futures)))
+
+        sample_to_fraction_read = {}
+        result_directories = []
+        for (forward, early_stopper, sample_chunks, stopped_early) in chunked_samples:
+            if early_stopper is None or not early_stopper.is_complete() or \
+               (not stopped_early and early_stopper.num_chunks == len(sample_chunks)):
+                result_directories.extend(d for (d, _, _) in sample_chunks)
+                continue
+            # Chunks after those the early stopper used may have been searched
+            # too, but are discarded.
+            sample_chunks = sample_chunks[:early_stopper.num_chunks]
+            result_directories.extend(d for (d, _, _) in sample_chunks)
+            _, sequences_read, fraction_read = sample_chunks[-1]
+            hits_description = ', '.join(
+                '%s: %i' % (name, hits) for name, hits in
+                sorted(early_stopper.package_to_hits.items()))
+            if fraction_read is None:
+                logging.warning(
+                    "Stopped reading %s after %i sequences with hits per package %s, but the fraction of the file read is unknown so coverage will not be extrapolated" % (
+                        forward, sequences_read, hits_description))
+                continue
+            logging.info(
+                "Stopped reading %s after %i sequences, approximately %.1f%% of the file, with hits per package %s" % (
+                    forward, sequences_read, fraction_read * 100, hits_description))
+            if fraction_read < 1.0:
+                sample_to_fraction_read[UnpackRawReads(forward).basename()] = fraction_read
+
+        if len(unchunked_forward) > 0:
+            chunk_directory = os.path.join(chunk_directory_base, 'unchunked')
+            os.mkdir(chunk_directory)
+            for (hmms, output_directory, is_protein) in searches:
+                self._run_command(self._graftm_search_command(
+                    hmms,
+                    os.path.join(chunk_directory, os.path.basename(output_directory)),
+                    is_protein,
+                    unchunked_forward,
+                    None if reverse_read_files is None else unchunked_reverse,
+                    self._num_threads))
+            result_directories.insert(0, chunk_directory)
+
+        for (_, output_directory, _) in searches:
+            self._merge_search_directories(
+                [os.path.join(d, os.path.basename(output_directory))
+                 for d in result_directories],
+                output_directory)
+        if self._shared_memory_budget is None:
+            shutil.rmtree(chunk_directory_base)
+        else:
+            self._shared_memory_budget.remove_directory(chunk_directory_base)
+        return sample_to_fraction_read
+
+    def _count_search_hits(self, searches, chunk_directory, forward_chunk):
+        '''Return a dict of package name to the number of distinct reads hit by
+        that package's search HMMs when searching a chunk.'''
+        hmm_to_package_name = {}
+        for pkg in self._singlem_package_database:
+            for hmm in pkg.graftm_package().search_hmm_paths():
+                hmm_to_package_name[hmm] = pkg.graftm_package_basename()
+        sample_name = UnpackRawReads(forward_chunk).basename()
+        orfm_utils = OrfMUtils()
+
+        package_to_reads = {}
+        for (hmms, output_directory, _) in searches:
+            result = GraftMResult(
+                os.path.join(chunk_directory, os.path.basename(output_directory)),
+                False,
+                search_hmm_files=hmms)
+            for hmm, hmmout in zip(hmms, result.hmmout_paths_from_sample_name(sample_name)):
+                reads = package_to_reads.setdefault(hmm_to_package_name[hmm], set())
+                if not os.path.exists(hmmout): continue
+                with open(hmmout) as f:
+                    for line in f:
+                        if line.startswith('#'): continue
+                        reads.add(orfm_utils.un_orfm_name(line.split(None, 1)[0]))
+        return dict((name, len(reads)) for name, reads in package_to_reads.items())
+
+    def _extrapolate_coverage(self, otu_table, sample_to_fraction_read):
+        '''Divide the coverage of OTUs of samples which were only partly read by
+        the fraction of their input that was read.'''
+        for row in otu_table.data:
+            fraction_read = sample_to_fraction_read.get(row[1])
+            if fraction_read is not None:
+                row[4] = row[4] / fraction_read
+
+    def _merge_search_directories(self, directories, output_directory):
+        '''Concatenate each file in the given GraftM search output directories
+        into the file with the same relative path in output_directory, in the
+        order of the directories.'''
+        os.makedirs(output_directory)
+        for directory in directories:
+            for (root, _, files) in os.walk(directory):
+                merged_directory = os.path.join(
+                    output_directory, os.path.relpath(root, directory))
+                os.makedirs(merged_directory, exist_ok=True)
+                for f in files:
+                    with open(os.path.join(root, f), 'rb') as source:
+                        with open(os.path.join(merged_directory, f), 'ab') as merged:
+                            shutil.copyfileobj(source, merged)
 
     def _align(self, search_result):
         graftm_separate_directory_base = os.path.join(self._working_directory, 'graftm_separates')
@@ -977,7 +1735,7 @@ class SearchPipe:
                 False,
                 analysing_pairs))
 
-        extern.run_many(commands, num_threads=self._num_threads)
+        self._run_commands(commands, self._num_threads)
         return SingleMPipeAlignSearchResult(
             graftm_separate_directory_base,
             search_result.samples_with_hits(),
@@ -999,6 +1757,36 @@ class SearchPipe:
             readset.tmpfile_basename = tmpbase
             return tmp
 
+        def write_deduplicated_readsets(readsets):
+            # Write one representative read for each distinct OTU sequence
+            # across all samples. Representatives are renamed so that names
+            # are unique across samples.
+            representatives = {}
+            tmp = None
+            for readset in readsets:
+                readset.window_representatives = representatives
+                if len(readset.unknown_sequences) == 0: continue
+                name_to_sequence = dict((s.name, s.seq) for s in readset.sequences)
+                for u in readset.unknown_sequences:
+                    if u.aligned_sequence in representatives: continue
+                    if tmp is None:
+                        tmp = generate_tempfile_for_readset(readset)
+                    name = 'otu%i' % len(representatives)
+                    # ORF names are the read name plus a suffix
+                    representatives[u.aligned_sequence] = (
+                        name, name + u.orf_name[len(u.name):])
+                    tmp.write(">{}\n{}\n".format(name, name_to_sequence[u.name]))
+            if tmp is None:
+                return []
+            tmp.close()
+            # All samples share the one assignment
+            tmpfile_basename = os.path.basename(tmp.name[:-6])
+            for readset in readsets:
+                readset.tmpfile_basename = tmpfile_basename
+            logging.debug("Assigning taxonomy to {} distinct OTU sequences for {}".format(
+                len(representatives), readsets[0].singlem_package.base_directory()))
+            return [tmp]
+
         # Run each one at a time serially so that the number of threads is
         # respected, to save RAM as one DB needs to be loaded at once, and so
         # fewer open files are needed, so that the open file count limit is
@@ -1006,63 +1794,63 @@ class SearchPipe:
         seqio = SequenceIO()
         for singlem_package, readsets in extracted_reads.each_package_wise():
             tmp_files = []
-            for readset in readsets:
-                if extracted_reads.analysing_pairs:
-                    if len(readset[0].sequences + readset[1].sequences) > 0:
-                        # Some pairs will only have one side of the pair
-                        # aligned, some pairs both. Fill in the forward and
-                        # reverse files with dummy data as necessary
-                        #
-                        # The dummy sequence must have an ORF with
-                        # >min_orf_length bases because otherwise if there are
-                        # >no sequences, hmmsearch inside graftm croaks.
-                        dummy_sequence = 'ATG'+''.join(['A']*self._min_orf_length)
-                        forward_tmp = generate_tempfile_for_readset(readset[0])
-                        reverse_tmp = generate_tempfile_for_readset(readset[1])
-
-                        forward_seq_names = {}
-                        for (i, s) in enumerate(readset[0].sequences):
-                            forward_seq_names[s.name] = i
-                            seqio.write_fasta([s], forward_tmp)
-                        reverse_name_to_seq = {}
-                        for s in readset[1].sequences:
-                            reverse_name_to_seq[s.name] = s
-                        for name, forward_i in forward_seq_names.items():
-                            if name in reverse_name_to_seq:
-                                # Write corresponding reverse and delete it
-                                # from dict.
-                                seqio.write_fasta(
-                                    [reverse_name_to_seq.pop(name)], reverse_tmp)
-                            else:
-                                # Forward read matched only
-                                reverse_tmp.write(">{}\n{}\n".format(
+            if self._deduplicate_assignment:
+                tmp_files = write_deduplicated_readsets(readsets)
+            else:
+                for readset in readsets:
+                    if extracted_reads.analysing_pairs:
+                        if len(readset[0].sequences + readset[1].sequences) > 0:
+                            # Some pairs will only have one side of the pair
+                            # aligned, some pairs both. Fill in the forward and
+                            # reverse files with dummy data as necessary
+                            #
+                            # The dummy sequence must have an ORF with
+                            # >min_orf_length bases because otherwise if there are
+                            # >no sequences, hmmsearch inside graftm croaks.
+                            dummy_sequence = 'ATG'+''.join(['A']*self._min_orf_length)
+                            forward_tmp = generate_tempfile_for_readset(readset[0])
+                            reverse_tmp = generate_tempfile_for_readset(readset[1])
+
+                            forward_seq_names = {}
+                            for (i, s) in enumerate(readset[0].sequences):
+                                forward_seq_names[s.name] = i
+                                seqio.write_fasta([s], forward_tmp)
+                            reverse_name_to_seq = {}
+                            for s in readset[1].sequences:
+                                reverse_name_to_seq[s.name] = s
+                            for name, forward_i in forward_seq_names.items():
+                                if name in reverse_name_to_seq:
+                                    # Write corresponding reverse and delete it
+                                    # from dict.
+                                    seqio.write_fasta(
+                                        [reverse_name_to_seq.pop(name)], reverse_tmp)
+                                else:
+                                    # Forward read matched only
+                                    reverse_tmp.write(">{}\n{}\n".format(
+                                        name, dummy_sequence))
+                            for name, seq in reverse_name_to_seq.items():
+                                # Reverse read matched only
+                                forward_tmp.write(">{}\n{}\n".format(
                                     name, dummy_sequence))
-                        for name, seq in reverse_name_to_seq.items():
-                            # Reverse read matched only
-                            forward_tmp.write(">{}\n{}\n".format(
-                                name, dummy_sequence))
-                            seqio.write_fasta([seq], reverse_tmp)
-
-                        # Close immediately to avoid the "too many open files" error.
-                        forward_tmp.close()
-                        reverse_tmp.close()
-                        tmp_files.append([forward_tmp, reverse_tmp])
-                else:
-                    if len(readset.sequences) > 0:
-                        tmp = generate_tempfile_for_readset(readset)
-                        seqio.write_fasta(readset.sequences, tmp)
-                        tmp_files.append(tmp)
-                        # Close immediately to avoid the "too many open files" error.
-                        tmp.close()
+                                seqio.write_fasta([seq], reverse_tmp)
+
+                            # Close immediately to avoid the "too many open files" error.
+                            forward_tmp.close()
+                            reverse_tmp.close()
+                            tmp_files.append([forward_tmp, reverse_tmp])
+                    else:
+                        if len(readset.sequences) > 0:
+                            tmp = generate_tempfile_for_readset(readset)
+                            seqio.write_fasta(readset.sequences, tmp)
+                            tmp_files.append(tmp)
+                            # Close immediately to avoid the "too many open files" error.
+                            tmp.close()
 
             if len(tmp_files) > 0:
-                cmd = "%s "\
-                      "--threads %i "\
-                      "--graftm_package %s "\
+                # --threads is added when the command is run.
+                cmd = "--graftm_package %s "\
                       "--max_samples_for_krona 0 "\
                       "--assignment_method %s " % (
-                          self._graftm_command_prefix(singlem_package.is_protein_package()),
-                          self._num_threads,
                           singlem_package.graftm_package_path(),
                           assignment_method)
                 if extracted_reads.analysing_pairs:
@@ -1073,7 +1861,7 @@ class SearchPipe:
                         cmd += " --forward {} --reverse {}".format(
                             ' '.join(t[0].name for t in tmp_files),
                             ' '.join(t[1].name for t in tmp_files))
-                        commands.append(cmd)
+                        commands.append((singlem_package, cmd))
                     elif assignment_method == DIAMOND_ASSIGNMENT_METHOD:
                         # GraftM ignores reverse reads with diamond assignment
                         # method, so run forward and reverse individually.
@@ -1085,8 +1873,8 @@ class SearchPipe:
                             ' '.join(t[1].name for t in tmp_files),
                             self._diamond_assign_taxonomy_paired_output_directory(
                                 graftm_align_directory_base, singlem_package, False))
-                        commands.append(cmd1)
-                        commands.append(cmd2)
+                        commands.append((singlem_package, cmd1))
+                        commands.append((singlem_package, cmd2))
                 else:
                     cmd += "--output_directory {}/{} ".format(
                         graftm_align_directory_base,
@@ -1094,12 +1882,69 @@ class SearchPipe:
                     tmpnames = list([tg.name for tg in tmp_files])
                     cmd += " --forward {} ".format(
                         ' '.join(tmpnames))
-                    commands.append(cmd)
+                    commands.append((singlem_package, cmd))
 
-        extern.run_many(commands, num_threads=1)
+        self._run_assignment_commands(commands, assignment_method)
         logging.info("Finished running taxonomic assignment with GraftM")
         return SingleMPipeTaxonomicAssignmentResult(graftm_align_directory_base)
 
+    def _run_assignment_commands(self, commands, assignment_method):
+        '''Run graftM taxonomic assignment commands.
+
+        Parameters
+        ----------
+        commands: list of (SingleMPackage, str) tuples
+            the package and graftM arguments of each command, excluding the
+            command prefix and --threads.
+        assignment_method: str
+            graftM assignment method
+        '''
+        def full_command(singlem_package, cmd, threads):
+            return "%s --threads %i %s" % (
+                self._graftm_command_prefix(singlem_package.is_protein_package()),
+                threads,
+                cmd)
+
+        if self._max_memory is None:
+            # Run each one at a time serially so that the number of threads is
+            # respected, to save RAM as one DB needs to be loaded at once.
+            self._run_commands(
+                [full_command(singlem_package, cmd, self._num_threads)
+                 for singlem_package, cmd in commands],
+                1)
+        else:
+            jobs = []
+            for singlem_package, cmd in commands:
+                memory = self._estimate_assignment_memory(
+                    singlem_package, assignment_method)
+                logging.debug("Estimated taxonomic assignment with {} to require {:.2f}GB of memory".format(
+                    singlem_package.base_directory(), memory / 1024**3))
+                jobs.append((memory, lambda threads, p=singlem_package, c=cmd:
+                             self._run_command(full_command(p, c, threads))))
+            MemoryScheduler(self._max_memory, self._num_threads).run(jobs)
+
+    def _estimate_assignment_memory(self, singlem_package, assignment_method):
+        '''Return an estimate in bytes of the memory required to assign taxonomy
+        using the given package.'''
+        graftm_package = singlem_package.graftm_package()
+        if assignment_method == PPLACER_ASSIGNMENT_METHOD:
+            num_sequences = 0
+            alignment_length = 0
+            with open(graftm_package.alignment_fasta_path()) as f:
+                for _, seq, _ in SeqReader().readfq(f):
+                    num_sequences += 1
+                    alignment_length = len(seq)
+            num_states = 20 if singlem_package.is_protein_package() else 4
+            # pplacer keeps a pair of likelihood vectors for each edge in the
+            # tree (about twice the number of leaves) of doubles for each site,
+            # state and each of 4 rate categories.
+            return 2 * 2 * num_sequences * alignment_length * num_states * 4 * 8
+        else:
+            diamond_database = graftm_package.diamond_database_path()
+            if diamond_database is None or not os.path.exists(diamond_database):
+                return 0
+            return os.path.getsize(diamond_database)
+
     def _diamond_assign_taxonomy_paired_output_directory(
             self, graftm_align_directory_base, singlem_package, is_forward):
         return "{}/{}_{}".format(
@@ -1108,10 +1953,14 @@ class SearchPipe:
             "read1" if is_forward else "read2")
 
 class SingleMPipeSearchResult:
-    def __init__(self, graftm_protein_result, graftm_nucleotide_result, analysing_pairs):
+    def __init__(self, graftm_protein_result, graftm_nucleotide_result, analysing_pairs,
+                 sample_to_fraction_read=None):
         self._protein_result = graftm_protein_result
         self._nucleotide_result = graftm_nucleotide_result
         self.analysing_pairs = analysing_pairs
+        # Samples of which only this fraction of the input was searched
+        self.sample_to_fraction_read = {} if sample_to_fraction_read is None \
+            else sample_to_fraction_read
 
     def protein_hit_paths(self):
         '''Return a dict of sample name to corresponding '_hits.fa' files generated in
@@ -1369,12 +2218,20 @@ class ExtractedReads:
 
 class ExtractedReadSet:
     def __init__(self, sample_name, singlem_package, sequences,
-                 known_sequences, unknown_sequences):
+                 known_sequences, unknown_sequences,
+                 cached_sequences=None, cached_taxonomies=None):
         self.sample_name = sample_name
         self.singlem_package = singlem_package
         self.sequences = sequences
         self.known_sequences = known_sequences
         self.unknown_sequences = unknown_sequences
+        # Sequences with taxonomy in the taxonomy cache, and a dict of OTU
+        # sequence to that taxonomy.
+        self.cached_sequences = [] if cached_sequences is None else cached_sequences
+        self.cached_taxonomies = {} if cached_taxonomies is None else cached_taxonomies
         self.tmpfile_basename = None # Used as part of pipe, making this object
                                      # not suitable for use outside that
                                      # setting.
+        # When taxonomy is assigned to one read per OTU sequence, a dict of
+        # OTU sequence to the (read name, ORF name) it was assigned under.
+        self.window_representatives = None
@@ -0,0 +1,306 @@
+import io
+import os
+import json
+import tempfile
+import logging
+import threading
+import multiprocessing
+import socketserver
+import http.server
+import concurrent.futures
+
+from .pipe import SearchPipe, PPLACER_ASSIGNMENT_METHOD
+from .singlem import HmmDatabase
+from .otu_table import OtuTable
+
+# Packages loaded once by the server, and inherited by each forked worker
+# process.
+_server_hmm_database = None
+# The temporary directory of the server, which each job starts from since
+# worker processes are reused.
+_server_temporary_directory = None
+
+def _initialise_server_worker(hmm_database):
+    global _server_hmm_database, _server_temporary_directory
+    _server_hmm_database = hmm_database
+    _server_temporary_directory = (tempfile.tempdir, os.environ.get('TEMP'))
+
+def _run_server_job(pipe_kwargs):
+    pipe_kwargs = dict(pipe_kwargs)
+    pipe_kwargs['hmm_database'] = _server_hmm_database
+    original_tempdir, original_temp = _server_temporary_directory
+    tempfile.tempdir = original_tempdir
+    if original_temp is None:
+        os.environ.pop('TEMP', None)
+    else:
+        os.environ['TEMP'] = original_temp
+    otu_table_object = SearchPipe().run_to_otu_table(**pipe_kwargs)
+    if otu_table_object is None:
+        return []
+    return otu_table_object.data
+
+
+class InvalidJobException(Exception):
+    pass
+
+
+class ThreadBudget:
+    '''Count threads in use so that no more than a fixed number are used by
+    concurrent jobs.'''
+    def __init__(self, num_threads):
+        self.num_threads = num_threads
+        self.threads_in_use = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, num_threads):
+        with self._condition:
+            while self.threads_in_use + num_threads > self.num_threads:
+                self._condition.wait()
+            self.threads_in_use += num_threads
+
+    def release(self, num_threads):
+        with self._condition:
+            self.threads_in_use -= num_threads
+            self._condition.notify_all()
+
+
+class PipeServer:
+    '''Run pipe jobs submitted over HTTP on a Unix socket or a local port,
+    keeping the SingleM packages loaded between jobs.
+
+    A job is POSTed to /pipe as a JSON object of the options in JOB_OPTIONS,
+    at least 'sequences', plus optionally 'output_extras' and 'archive' to
+    choose the output format. The OTU table is sent back as the
+    response. GET /status returns the server's packages and thread usage.
+    For example:
+
+    curl --unix-socket singlem.sock http://localhost/pipe \\
+        -d '{"sequences": ["reads.fa"], "threads": 2}'
+    '''
+
+    # Arguments of jobs which are not specified
+    JOB_DEFAULTS = {
+        'reverse_read_files': None,
+        'threads': 1,
+        'known_otu_tables': None,
+        'assignment_method': PPLACER_ASSIGNMENT_METHOD,
+        'output_jplace': None,
+        'evalue': None,
+        'min_orf_length': SearchPipe.DEFAULT_MIN_ORF_LENGTH,
+        'restrict_read_length': None,
+        'filter_minimum_protein': SearchPipe.DEFAULT_FILTER_MINIMUM_PROTEIN,
+        'filter_minimum_nucleotide': SearchPipe.DEFAULT_FILTER_MINIMUM_NUCLEOTIDE,
+        'include_inserts': False,
+        'assign_taxonomy': True,
+        'known_sequence_taxonomy': None,
+        'diamond_prefilter': False,
+        'working_directory_tmpdir': False}
+
+    # Options which jobs may specify, and the SearchPipe.run_to_otu_table
+    # argument each sets. Arguments set by the server and those giving paths
+    # to write to are not options, so that jobs cannot write files.
+    JOB_OPTIONS = {
+        'sequences': 'sequences',
+        'reverse': 'reverse_read_files',
+        'threads': 'threads',
+        'known_otu_tables': 'known_otu_tables',
+        'assignment_method': 'assignment_method',
+        'evalue': 'evalue',
+        'min_orf_length': 'min_orf_length',
+        'restrict_read_length': 'restrict_read_length',
+        'filter_minimum_protein': 'filter_minimum_protein',
+        'filter_minimum_nucleotide': 'filter_minimum_nucleotide',
+        'include_inserts': 'include_inserts',
+        'assign_taxonomy': 'assign_taxonomy',
+        'known_sequence_taxonomy': 'known_sequence_taxonomy',
+        'diamond_prefilter': 'diamond_prefilter',
+        'kmer_prefilter': 'kmer_prefilter',
+        'search_chunk_size': 'search_chunk_size',
+        'max_memory': 'max_memory',
+        'deduplicate_assignment': 'deduplicate_assignment',
+        'early_stop_hits': 'early_stop_hits',
+        'early_stop_convergence': 'early_stop_convergence',
+        'working_directory_tmpdir': 'working_directory_tmpdir'}
+
+    # Options which choose the output format rather than being passed to the
+    # pipe
+    OUTPUT_OPTIONS = ['output_extras', 'archive']
+
+    def __init__(self, singlem_packages=None, num_threads=1, diamond_prefilter=False):
+        '''
+        Parameters
+        ----------
+        singlem_packages: list of str or None
+            paths to SingleM packages, or None for the default set
+        num_threads: int
+            total number of threads to be used by concurrent jobs
+        diamond_prefilter: boolean
+            whether jobs use the DIAMOND prefilter unless they specify
+            otherwise. The DIAMOND database is built when the server starts.
+        '''
+        self._singlem_packages = singlem_packages
+        self._hmms = HmmDatabase(singlem_packages)
+        for pkg in self._hmms:
+            pkg.graftm_package()
+        self._job_defaults = dict(PipeServer.JOB_DEFAULTS)
+        self._job_defaults['diamond_prefilter'] = diamond_prefilter
+        if diamond_prefilter:
+            self._hmms.get_dmnd()
+        self._thread_budget = ThreadBudget(num_threads)
+        self._executor = None
+
+    def job_kwargs(self, job):
+        '''Return the arguments to SearchPipe.run_to_otu_table for a job given
+        as a dict, raising InvalidJobException if it is not valid.'''
+        if not isinstance(job, dict):
+            raise InvalidJobException("A job must be a JSON object")
+        if not isinstance(job.get('sequences', None), list) or len(job['sequences']) == 0:
+            raise InvalidJobException("A job must specify 'sequences' as a list of paths")
+        pipe_kwargs = dict(self._job_defaults)
+        for key, value in job.items():
+            if key in PipeServer.OUTPUT_OPTIONS:
+                continue
+            if key not in PipeServer.JOB_OPTIONS:
+                raise InvalidJobException("Jobs cannot specify '%s'" % key)
+            pipe_kwargs[PipeServer.JOB_OPTIONS[key]] = value
+        if not isinstance(pipe_kwargs['threads'], int) or pipe_kwargs['threads'] < 1:
+            raise InvalidJobException("'threads' must be a positive integer")
+        pipe_kwargs['threads'] = min(pipe_kwargs['threads'], self._thread_budget.num_threads)
+        pipe_kwargs['collect_read_names'] = \
+            bool(job.get('output_extras', False)) or bool(job.get('archive', False))
+        pipe_kwargs['singlem_packages'] = self._singlem_packages
+        pipe_kwargs['working_directory'] = None
+        pipe_kwargs['force'] = False
+        return pipe_kwargs
+
+    def run_job(self, job):
+        '''Run a job given as a dict, once enough threads are free. Return its
+        OtuTable, and the fields of it to be output.'''
+        pipe_kwargs = self.job_kwargs(job)
+        output_extras = job.get('output_extras', False)
+
+        num_threads = pipe_kwargs['threads']
+        self._thread_budget.acquire(num_threads)
+        try:
+            data = self._executor.submit(_run_server_job, pipe_kwargs).result()
+        finally:
+            self._thread_budget.release(num_threads)
+
+        otu_table_object = OtuTable()
+        otu_table_object.data = data
+        regular_output_fields = str.split('gene sample sequence num_hits coverage taxonomy')
+        otu_table_object.fields = regular_output_fields + \
+            str.split('read_names nucleotides_aligned taxonomy_by_known?')
+        return otu_table_object, \
+            otu_table_object.fields if output_extras else regular_output_fields
+
+    def status(self):
+        return {
+            'singlem_packages': [pkg.base_directory() for pkg in self._hmms],
+            'threads': self._thread_budget.num_threads,
+            'threads_in_use': self._thread_budget.threads_in_use}
+
+    def write_job_output(self, job, otu_table_object, fields, output_io):
+        if job.get('archive', False):
+            otu_table_object.archive(self._hmms).write_to(output_io)
+        else:
+            otu_table_object.write_to(output_io, fields)
+
+    def serve(self, socket_path=None, host='127.0.0.1', port=None):
+        '''Serve jobs on the Unix socket socket_path if given, otherwise on the
+        given host and port, until interrupted.'''
+        server = self.create_http_server(socket_path, host, port)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logging.info("Stopping server")
+        finally:
+            self.shutdown(server, socket_path)
+
+    def create_http_server(self, socket_path=None, host='127.0.0.1', port=None):
+        # Start all worker processes now, before any request handling threads
+        # exist, since forking a multi-threaded process is unsafe.
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self._thread_budget.num_threads,
+            mp_context=multiprocessing.get_context('fork'),
+            initializer=_initialise_server_worker,
+            initargs=(self._hmms,))
+        self._executor.submit(os.getpid).result()
+
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                raise Exception("Socket %s already exists, not continuing" % socket_path)
+            server = _UnixHTTPServer(socket_path, _PipeRequestHandler)
+            logging.info("Listening for pipe jobs on socket %s" % socket_path)
+        else:
+            if port is None:
+                raise Exception("Either a socket path or port must be specified")
+            server = _TCPHTTPServer((host, port), _PipeRequestHandler)
+            logging.info("Listening for pipe jobs on http://%s:%i" % server.server_address[:2])
+        server.pipe_server = self
+        return server
+
+    def shutdown(self, server, socket_path=None):
+        server.server_close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+        self._executor.shutdown()
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class _TCPHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class _PipeRequestHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        # The default writes to stderr including the client address, which
+        # Unix sockets do not have.
+        logging.debug("Request: %s" % (format % args))
+
+    def send_text(self, code, text, content_type='text/plain'):
+        body = text.encode()
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/status':
+            self.send_text(200, json.dumps(self.server.pipe_server.status()), 'application/json')
+        else:
+            self.send_text(404, "Unknown path %s\n" % self.path)
+
+    def do_POST(self):
+        if self.path != '/pipe':
+            self.send_text(404, "Unknown path %s\n" % self.path)
+            return
+        pipe_server = self.server.pipe_server
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            job = json.loads(self.rfile.read(length).decode())
+            pipe_server.job_kwargs(job)
+        except (ValueError, InvalidJobException) as e:
+            self.send_text(400, "Invalid job: %s\n" % e)
+            return
+        try:
+            otu_table_object, fields = pipe_server.run_job(job)
+        except Exception as e:
+            logging.exception("Job failed")
+            self.send_text(500, "Job failed: %s\n" % e)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type',
+            'application/json' if job.get('archive', False) else 'text/tab-separated-values')
+        self.end_headers()
+        # Stream the table rather than building it in memory first
+        output_io = io.TextIOWrapper(self.wfile, encoding='utf-8', write_through=True)
+        try:
+            pipe_server.write_job_output(job, otu_table_object, fields, output_io)
+            output_io.flush()
+        finally:
+            output_io.detach()
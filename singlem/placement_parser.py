@@ -1,14 +1,66 @@
+import json
 import logging
+
+import numpy as np
+
 from .singlem import OrfMUtils
 
 
 class PlacementParser:
-    def __init__(self, json, taxonomy_bihash, probability_threshold):
-        self._json = json
-        self._taxonomy_bihash = taxonomy_bihash
+    def __init__(self, json, taxonomy_tree, probability_threshold):
+        self._taxonomy_tree = taxonomy_tree
         self._orf_name_to_placement = {}
         self._probability_threshold = probability_threshold
-        for placement in json['placements']:
+        if json is not None:
+            self._add_placements(json['placements'], json['fields'])
+
+    @staticmethod
+    def parse_jplace(jplace_io, taxonomy_tree, probability_threshold):
+        '''Return a PlacementParser of the placements in a jplace file, given
+        an open, seekable IO object to it. The file is parsed incrementally, so
+        that neither the whole document nor the full placements are held in
+        memory, only the classification and probability of each.
+
+        pplacer writes 'fields' after 'placements', in which case the
+        placements are skipped over without being decoded until 'fields' is
+        found, and the file then read again from the start to add them. Each
+        placement is decoded only once either way.'''
+        parser = PlacementParser(None, taxonomy_tree, probability_threshold)
+        fields = None
+        placements_skipped = False
+        reader = _JplaceReader(jplace_io)
+        for key in reader.keys():
+            if key == 'fields':
+                fields = reader.value()
+            elif key == 'placements' and fields is not None:
+                for placement in reader.placements():
+                    parser._add_placements([placement], fields)
+            else:
+                if key == 'placements':
+                    placements_skipped = True
+                reader.skip_value()
+        if fields is None:
+            raise Exception("No 'fields' were found in jplace file")
+
+        if placements_skipped:
+            jplace_io.seek(0)
+            reader = _JplaceReader(jplace_io)
+            for key in reader.keys():
+                if key == 'placements':
+                    for placement in reader.placements():
+                        parser._add_placements([placement], fields)
+                else:
+                    reader.skip_value()
+        return parser
+
+    def _add_placements(self, placements, fields):
+        classification_index = fields.index('classification')
+        likelihood_index = fields.index('like_weight_ratio')
+        for placement in placements:
+            # Only the classification and probability of each placement are
+            # kept.
+            compact_placement = [
+                (p[classification_index], p[likelihood_index]) for p in placement['p']]
             for nm in placement['nm']:
                 if nm[1] != 1:
                     raise Exception(
@@ -18,29 +70,25 @@ class PlacementParser:
                     raise Exception(
                         "There appears to be duplicate names amongst placed "
                         "sequences e.g. '{}'".format(orf_name))
-                self._orf_name_to_placement[orf_name] = placement
+                self._orf_name_to_placement[orf_name] = compact_placement
 
     def merge_reverse(self, another_placement_parser):
         '''Given this is an object storing the placements of the first read, add the
         placements of the second reads. All sequences that have names not
         already stored list of names are added.
         '''
-        for placement in another_placement_parser._json['placements']:
-            for nm in placement['nm']:
-                if nm[1] != 1:
-                    raise Exception("Cannot handle jplace files with nm counts != 1")
-                orf_name = nm[0]
-                if orf_name in self._orf_name_to_placement:
-                    logging.error(
-                        "There appears to be a clash in ORF names between the "
-                        "forward and reverse reads aligned against one GraftM "
-                        "package. This code was written under the assumption "
-                        "this situation is so rare it isn't worth worrying "
-                        "about, so ignoring the reverse read (both are called "
-                        "'{}'), ignoring the placement of the reverse read".format(
-                            orf_name))
-                else:
-                    self._orf_name_to_placement[orf_name] = placement
+        for orf_name, placement in another_placement_parser._orf_name_to_placement.items():
+            if orf_name in self._orf_name_to_placement:
+                logging.error(
+                    "There appears to be a clash in ORF names between the "
+                    "forward and reverse reads aligned against one GraftM "
+                    "package. This code was written under the assumption "
+                    "this situation is so rare it isn't worth worrying "
+                    "about, so ignoring the reverse read (both are called "
+                    "'{}'), ignoring the placement of the reverse read".format(
+                        orf_name))
+            else:
+                self._orf_name_to_placement[orf_name] = placement
 
     def otu_placement(self, orf_names):
         '''Return the most fully resolved taxonomy of the set of reads, pooling the
@@ -51,73 +99,224 @@ class PlacementParser:
         Sequences not in the jplace are ignored. If a group is made up
         exclusively of sequences not in the jplace, None is returned.
 
+        The taxonomy is worked out on the node ids of the taxonomy tree. Every
+        node from the root down to the lowest common ancestor of the placed
+        nodes has the probability of all placements, so only the nodes below
+        that are considered one by one.
         '''
+        tree = self._taxonomy_tree
+        parents = tree.parents
+        depths = tree.depths
 
-        observed_parent_to_children = {}
-        tax_probabilities = {}
-
-        j = self._json
-        classification_index = j['fields'].index('classification')
-        likelihood_index = j['fields'].index('like_weight_ratio')
-        root_tax = None
-
-        # For each placement for each sequence
+        # (node id, probability) of each placement of each sequence
+        placements = []
+        lca_id = None
+        placed_ids = set()
         for name in orf_names:
-            if name in self._orf_name_to_placement:
-                for p in self._orf_name_to_placement[name]['p']:
-                    # Get list of taxonomies from placed to root of tree
-                    prob = p[likelihood_index]
-                    tax = p[classification_index]
-                    full_tax = []
-                    while tax is not None:
-                        full_tax.append(tax)
-                        tax = self._taxonomy_bihash.child_to_parent[tax]
-                    # Add that probability in the total hash
-                    last_parent = None
-                    for i, tax in enumerate(reversed(full_tax)):
-                        if i == 0:
-                            if root_tax is None:
-                                root_tax = tax
-                            elif tax != root_tax:
-                                raise Exception(
-                                    "Programming error - seem to have encountered 2 different roots")
-                        if tax in tax_probabilities:
-                            tax_probabilities[tax] += prob
-                        else:
-                            tax_probabilities[tax] = prob
-                        if i != 0:
-                            if last_parent in observed_parent_to_children:
-                                if tax not in observed_parent_to_children[last_parent]:
-                                    observed_parent_to_children[last_parent].append(tax)
-                            else:
-                                observed_parent_to_children[last_parent] = [tax]
-                        last_parent = tax
-            else:
+            placement = self._orf_name_to_placement.get(name)
+            if placement is None:
                 logging.debug(
                     "Skipping ORF {} as it does not seem to have been placed".format(name))
+                continue
+            for placed_tax, prob in placement:
+                node_id = tree.node_id(placed_tax)
+                if node_id not in placed_ids:
+                    placed_ids.add(node_id)
+                    if lca_id is None:
+                        lca_id = node_id
+                    else:
+                        lca_id = tree.lca_id(lca_id, node_id)
+                        if lca_id is None:
+                            raise Exception(
+                                "Programming error - seem to have encountered 2 different roots")
+                placements.append((node_id, prob))
 
-        if root_tax is None:
+        if lca_id is None:
             return None
 
+        threshold = self._probability_threshold * len(orf_names)
+        lca_probability = 0.0
+        for _, prob in placements:
+            lca_probability += prob
+        if not lca_probability > threshold:
+            return []
+        final_ids = list(tree.ancestor_ids(lca_id))
+
+        # Sum the probabilities of the nodes below the lowest common ancestor,
+        # recording the children of each node in the order they were
+        # observed, as the keys of a dict.
+        probabilities = {}
+        observed_parent_to_children = {}
+        lca_depth = depths[lca_id]
+        for node_id, prob in placements:
+            while depths[node_id] > lca_depth:
+                probabilities[node_id] = probabilities.get(node_id, 0.0) + prob
+                parent_id = int(parents[node_id])
+                observed_parent_to_children.setdefault(parent_id, {})[node_id] = None
+                node_id = parent_id
+
         # Descend down the tree, picking the highest probability amongst the
         # children, or break if the probability is not greater than the
         # threshold.
-        next_children = [root_tax]
-        final_tax = []
-        threshold = self._probability_threshold
-        while True:
-            # Find the max child and it's probability
-            def get_prob(tax): return tax_probabilities[tax]
-            max_child = max(next_children, key=get_prob)
-            # Add it to the final tax if it is above the threshold
-            if tax_probabilities[max_child] > threshold * len(orf_names):
-                final_tax.append(max_child)
-                if max_child in observed_parent_to_children:
-                    next_children = observed_parent_to_children[max_child]
-                else:
-                    break # If there is no children, break
+        node_id = lca_id
+        while node_id in observed_parent_to_children:
+            max_child = max(observed_parent_to_children[node_id], key=probabilities.get)
+            if probabilities[max_child] > threshold:
+                final_ids.append(max_child)
+                node_id = max_child
             else:
-                break # If below the threshold, break
+                break
 
         # Return the taxonomic placement
-        return final_tax
+        names = tree.names
+        return [names[i] for i in final_ids]
+
+
+class _JplaceReader:
+    '''Read the top-level entries of a jplace document from an IO object a
+    chunk at a time, decoding each placement separately rather than the whole
+    list of placements, and skipping over values that are not needed without
+    decoding them.'''
+
+    _CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, jplace_io):
+        self._io = jplace_io
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._position = 0
+        self._eof = False
+
+    def keys(self):
+        '''Yield the key of each top-level entry. Before the next key is
+        yielded, its value must be read with value(), placements() or
+        skip_value().'''
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, str):
+                raise Exception("Unexpected key in jplace file: {}".format(key))
+            self._expect(':')
+            yield key
+            if self._expect_one_of(',}') == '}':
+                return
+
+    def placements(self):
+        '''Yield each placement in the list of placements that is the value
+        of the current entry.'''
+        self._expect('[')
+        if self._peek() == ']':
+            self._position += 1
+            return
+        while True:
+            yield self.value()
+            if self._expect_one_of(',]') == ']':
+                return
+
+    def value(self):
+        '''Decode and return the next value.'''
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._position)
+                # A number at the end of the buffer, or ending where the
+                # buffer was split within it, may continue past it
+                if self._eof or (end < len(self._buffer) and
+                                 self._buffer[end] not in '0123456789.eE+-'):
+                    self._position = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            self._read()
+
+    def skip_value(self):
+        '''Move past the next value without decoding it, by finding the end of
+        the string, list or object it starts.'''
+        if self._peek() not in '"[{':
+            # Other values are short, so are simply decoded.
+            self.value()
+            return
+        depth = 0
+        in_string = False
+        while True:
+            # Strings in jplace files rarely contain escapes, so the buffer up
+            # to the next backslash is scanned all at once.
+            escape = self._buffer.find('\\', self._position)
+            if escape < 0:
+                escape = len(self._buffer)
+            end, depth, in_string = self._scan(
+                self._buffer[self._position:escape], depth, in_string)
+            if end is not None:
+                self._position += end
+                return
+            if escape + 1 < len(self._buffer):
+                # Skip the backslash and the character it escapes
+                self._position = escape + 2
+                continue
+            # Keep any backslash so the character it escapes is skipped once
+            # it has been read.
+            self._position = escape
+            if not self._read():
+                raise Exception("Unexpected end of jplace file")
+
+    @staticmethod
+    def _scan(text, depth, in_string):
+        '''Scan text containing no backslashes that continues a value, given
+        the depth of nesting of lists and objects and whether a string is open
+        at its start. Return the index just past the end of the value, or None
+        if it does not end within text, and the depth and whether a string is
+        open at the end of the text.'''
+        if len(text) == 0:
+            return None, depth, in_string
+        codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+        # Whether a string is open after each character
+        in_strings = (np.cumsum(codes == ord('"')) + in_string) % 2 == 1
+        changes = ((codes == ord('[')) | (codes == ord('{'))).astype(np.int64) - \
+            ((codes == ord(']')) | (codes == ord('}')))
+        changes[in_strings] = 0
+        depths = depth + np.cumsum(changes)
+        ends = np.flatnonzero((depths == 0) & ~in_strings)
+        if len(ends) > 0:
+            return int(ends[0]) + 1, 0, False
+        return None, int(depths[-1]), bool(in_strings[-1])
+
+    def _read(self):
+        '''Read more of the file into the buffer, discarding what has already
+        been parsed. Return False at the end of the file.'''
+        if self._eof:
+            return False
+        self._buffer = self._buffer[self._position:]
+        self._position = 0
+        # Read at least as much as is buffered, so that long values are not
+        # decoded many times.
+        chunk = self._io.read(max(self._CHUNK_SIZE, len(self._buffer)))
+        if chunk == '':
+            self._eof = True
+            return False
+        self._buffer += chunk
+        return True
+
+    def _peek(self):
+        '''Return the next non-whitespace character without consuming it.'''
+        while True:
+            while self._position < len(self._buffer) and \
+                  self._buffer[self._position] in ' \t\n\r':
+                self._position += 1
+            if self._position < len(self._buffer):
+                return self._buffer[self._position]
+            if not self._read():
+                raise Exception("Unexpected end of jplace file")
+
+    def _expect_one_of(self, characters):
+        character = self._peek()
+        if character not in characters:
+            raise Exception("Unexpected character '{}' in jplace file, expected one of '{}'".format(
+                character, characters))
+        self._position += 1
+        return character
+
+    def _expect(self, character):
+        self._expect_one_of(character)
@@ -0,0 +1,79 @@
+from array import array
+
+import numpy as np
+
+
+class SequenceAggregator:
+    '''Aggregate aligned reads by their OTU (window) sequence, storing the
+    count and coverage of each distinct sequence in arrays rather than an
+    object per sequence. Per-read details are only kept when asked for.'''
+
+    def __init__(self, collect_names=True, collect_taxonomies=False, collect_orf_names=False):
+        '''
+        Parameters
+        ----------
+        collect_names: boolean
+            keep the name and aligned length of each read
+        collect_taxonomies: boolean
+            keep the taxonomy given for each read
+        collect_orf_names: boolean
+            keep the ORF name given for each read
+        '''
+        # Distinct sequences in the order they were first seen
+        self.sequences = []
+        self._sequence_to_index = {}
+        # For each read, the index of its sequence, and its unaligned and
+        # aligned lengths, from which its coverage is calculated
+        self._indices = array('l')
+        self._unaligned_lengths = array('l')
+        self._aligned_lengths = array('l')
+        self.names = [] if collect_names else None
+        self.aligned_lengths = [] if collect_names else None
+        self.taxonomies = [] if collect_taxonomies else None
+        self.orf_names = [] if collect_orf_names else None
+
+    def add(self, sequence, taxonomy=None, orf_name=None):
+        '''Add an UnalignedAlignedNucleotideSequence, with the taxonomy and ORF
+        name to record for it if these are being collected.'''
+        aligned_sequence = sequence.aligned_sequence
+        index = self._sequence_to_index.get(aligned_sequence)
+        if index is None:
+            index = len(self.sequences)
+            self._sequence_to_index[aligned_sequence] = index
+            self.sequences.append(aligned_sequence)
+            if self.names is not None:
+                self.names.append([])
+                self.aligned_lengths.append([])
+            if self.taxonomies is not None:
+                self.taxonomies.append([])
+            if self.orf_names is not None:
+                self.orf_names.append([])
+        self._indices.append(index)
+        self._unaligned_lengths.append(len(sequence.unaligned_sequence))
+        self._aligned_lengths.append(sequence.aligned_length)
+        if self.names is not None:
+            self.names[index].append(sequence.name)
+            self.aligned_lengths[index].append(sequence.aligned_length)
+        if self.taxonomies is not None:
+            self.taxonomies[index].append(taxonomy)
+        if self.orf_names is not None:
+            self.orf_names[index].append(orf_name)
+
+    def __len__(self):
+        return len(self.sequences)
+
+    def counts(self):
+        '''Return an array of the number of reads of each distinct sequence.'''
+        return np.bincount(
+            np.asarray(self._indices), minlength=len(self.sequences))
+
+    def coverages(self):
+        '''Return an array of the coverage of each distinct sequence, the sum
+        over its reads of the coverage indicated by each, as in
+        UnalignedAlignedNucleotideSequence.coverage_increment().'''
+        unaligned_lengths = np.asarray(self._unaligned_lengths, dtype=np.float64)
+        aligned_lengths = np.asarray(self._aligned_lengths, dtype=np.float64)
+        return np.bincount(
+            np.asarray(self._indices),
+            weights=unaligned_lengths / (unaligned_lengths - aligned_lengths + 1),
+            minlength=len(self.sequences))
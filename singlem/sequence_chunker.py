@@ -0,0 +1,148 @@
+import os
+import shutil
+import logging
+import itertools
+
+from graftm.unpack_sequences import UnpackRawReads
+
+from .sequence_classes import SeqReader
+
+class SequenceChunker:
+    '''Split sequence files into chunks with a fixed number of records each,
+    so that they can be searched in parallel. Each chunk is named so that
+    GraftM gives it the same sample name as the file it came from.'''
+
+    def __init__(self, chunk_size):
+        '''
+        Parameters
+        ----------
+        chunk_size: int
+            number of sequences in each chunk
+        '''
+        if chunk_size < 1:
+            raise Exception("The chunk size must be at least 1")
+        self._chunk_size = chunk_size
+
+    def chunks(self, forward_path, reverse_path, output_directory):
+        '''Generator which splits the given file (or pair of files) into chunks,
+        yielding a (forward_chunk_path, reverse_chunk_path) tuple once each
+        chunk has been written. reverse_chunk_path is None when reverse_path is
+        None. Paired files are split in lockstep so each chunk pair contains
+        the same reads.
+
+        If the file has no more than chunk_size sequences, then it is not
+        split and the original (forward_path, reverse_path) is yielded.
+
+        Chunks are written to output_directory/<chunk_index>/, with reverse
+        chunks in a 'reverse' subdirectory of that. The caller may remove
+        each chunk once it has been yielded.
+
+        FASTA and FASTQ input is accepted, optionally gzip-compressed. Chunks
+        are written uncompressed in the same format, but only the first word of
+        each header line is kept.
+
+        When each chunk is yielded, self.sequences_read is the number of
+        sequences (or pairs) written to chunks of this file so far, and
+        self.fraction_read is the approximate fraction of the (forward) file
+        read so far, or None if it cannot be determined. fraction_read is the
+        position reached in the file on disk, so it is slightly more than the
+        fraction of the sequences written to chunks: it includes the first
+        record of the next chunk and the read-ahead buffers of the file
+        (compressed bytes for gzip files). For chunks of many sequences the
+        difference is negligible.
+        '''
+        self.sequences_read = 0
+        self.fraction_read = None
+        forward_name = UnpackRawReads(forward_path).basename()
+        reverse_name = None if reverse_path is None else \
+                       UnpackRawReads(reverse_path).basename()
+
+        with SeqReader().open(forward_path) as forward_file:
+            forward_records = SeqReader().readfq(forward_file)
+            if reverse_path is None:
+                records = ((r, None) for r in forward_records)
+                reverse_file = None
+            else:
+                reverse_file = SeqReader().open(reverse_path)
+                records = self._paired_records(
+                    forward_records, SeqReader().readfq(reverse_file))
+            try:
+                chunk_index = 0
+                record = next(records, None)
+                while record is not None:
+                    directory = os.path.join(output_directory, str(chunk_index))
+                    forward_chunk, reverse_chunk, num_sequences = self._write_chunk(
+                        itertools.chain(
+                            [record], itertools.islice(records, self._chunk_size-1)),
+                        record,
+                        directory,
+                        forward_name,
+                        reverse_name)
+                    record = next(records, None)
+                    self.sequences_read += num_sequences
+                    self.fraction_read = self._fraction_read(forward_file)
+                    if chunk_index == 0 and record is None:
+                        # Small enough to be searched unchanged
+                        shutil.rmtree(directory)
+                        self.fraction_read = 1.0
+                        yield (forward_path, reverse_path)
+                        break
+                    yield (forward_chunk, reverse_chunk)
+                    chunk_index += 1
+                logging.debug("Split {} into {} chunk(s)".format(
+                    forward_path, max(chunk_index, 1)))
+            finally:
+                if reverse_file is not None:
+                    reverse_file.close()
+
+    def _paired_records(self, forward_records, reverse_records):
+        for forward, reverse in itertools.zip_longest(forward_records, reverse_records):
+            if forward is None or reverse is None:
+                raise Exception("Forward and reverse read files contain different numbers of sequences")
+            yield (forward, reverse)
+
+    def _write_chunk(self, records, first_record, directory, forward_name, reverse_name):
+        os.makedirs(directory)
+        forward_chunk = self._chunk_path(directory, forward_name, first_record[0])
+        if reverse_name is None:
+            reverse_chunk = None
+        else:
+            os.mkdir(os.path.join(directory, 'reverse'))
+            reverse_chunk = self._chunk_path(
+                os.path.join(directory, 'reverse'), reverse_name, first_record[1])
+        num_sequences = 0
+        with open(forward_chunk, 'w') as forward_file:
+            reverse_file = None if reverse_chunk is None else open(reverse_chunk, 'w')
+            try:
+                for (forward, reverse) in records:
+                    self._write_record(forward, forward_file)
+                    if reverse_file is not None:
+                        self._write_record(reverse, reverse_file)
+                    num_sequences += 1
+            finally:
+                if reverse_file is not None:
+                    reverse_file.close()
+        return (forward_chunk, reverse_chunk, num_sequences)
+
+    def _fraction_read(self, f):
+        # The position in the underlying (possibly compressed) file, which
+        # is ahead of the records read by the size of the read buffers, so
+        # this overstates the fraction of the file consumed. See chunks().
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return None
+            return min(1.0, float(os.lseek(f.fileno(), 0, os.SEEK_CUR)) / size)
+        except OSError:
+            return None
+
+    def _chunk_path(self, directory, name, example_record):
+        is_fastq = example_record[2] is not None
+        return os.path.join(directory, name + ('.fq' if is_fastq else '.fa'))
+
+    def _write_record(self, record, f):
+        (read_name, seq, qual) = record
+        if qual is None:
+            f.write(">{}\n{}\n".format(read_name, seq))
+        else:
+            f.write("@{}\n{}\n+\n{}\n".format(read_name, seq, qual))
@@ -1,8 +1,8 @@
 from Bio.Seq import Seq
+import gzip
 import logging
-import re
 
-from .singlem import OrfMUtils
+from .singlem import OrfMUtils, parse_orfm_name
 
 
 class Sequence:
@@ -19,18 +19,20 @@ class AlignedProteinSequence(Sequence):
         return OrfMUtils().un_orfm_name(self.name)
 
     def orfm_nucleotides(self, nucleotide_sequence):
-        m = re.search('_(\d+)_(\d+)_\d+$', self.name)
-        start = int(m.groups(0)[0])-1
+        orfm_name = parse_orfm_name(self.name)
+        if orfm_name is None:
+            raise Exception("Unexpected ORF name format: {}".format(self.name))
+        start = orfm_name.start-1
         translated_seq = nucleotide_sequence[start:(start+3*self.unaligned_length())]
-        logging.debug("Returning orfm nucleotides %s" % translated_seq)
-        if int(m.groups(0)[1]) > 3:
+        logging.debug("Returning orfm nucleotides %s", translated_seq)
+        if orfm_name.is_reverse_frame():
             # revcomp type frame
             return(str(Seq(translated_seq).reverse_complement()))
         else:
             return(translated_seq)
 
     def unaligned_length(self):
-        return len(re.sub('-','',self.seq))
+        return len(self.seq) - self.seq.count('-')
 
 class UnalignedAlignedNucleotideSequence:
     '''Represent a nucleotide sequence (aligned in protein space or nucleotide
@@ -69,6 +71,16 @@ class UnalignedAlignedNucleotideSequence:
 
 
 class SeqReader:
+    def open(self, path):
+        '''Open a sequence file for reading as text, decompressing it if it
+        is gzip-compressed.'''
+        with open(path, 'rb') as f:
+            is_gzipped = f.read(2) == b'\x1f\x8b'
+        if is_gzipped:
+            return gzip.open(path, 'rt')
+        else:
+            return open(path)
+
     # Stolen from https://github.com/lh3/readfq/blob/master/readfq.py
     def readfq(self, fp): # this is a generator function
         last = None # this is a buffer keeping the last unprocessed line
@@ -1,9 +1,6 @@
-import subprocess
-import string
-from io import StringIO
-import extern
+from graftm.sequence_io import Sequence
 
-from graftm.sequence_io import Sequence, SequenceIO
+from .sequence_classes import SeqReader
 
 class SequenceExtractor:
     '''Similar to graftm.SequenceExtractor except extracted sequences are read into
@@ -17,18 +14,37 @@ Python-land rather than output as a file.'''
         reads_to_extract: Iterable of str
             IDs of reads to be extracted
         database_fasta_file: str
-            path the fasta file that containing the reads
+            path the fasta file that containing the reads, which may be
+            gzip-compressed
 
         Returns
         -------
-        An array of graftm.sequence_io.Sequence objects'''
-        cmd = "mfqe --output-uncompressed --fasta-read-name-lists /dev/stdin --input-fasta '{}' --output-fasta-files /dev/stdout".format(
-            database_fasta_file)
-
-        # Retrieve each sequence exactly once so mfqe does not croak
-        output = extern.run(cmd, stdin='\n'.join(set(reads_to_extract)))
-
+        An array of graftm.sequence_io.Sequence objects, in the order they
+        appear in the database_fasta_file'''
+        reads_to_extract = set(reads_to_extract)
         seqs = []
-        for name, seq, _ in SequenceIO().each(StringIO(output)):
-            seqs.append(Sequence(name, seq))
+        with SeqReader().open(database_fasta_file) as f:
+            for name, seq, _ in SeqReader().readfq(f):
+                if name in reads_to_extract:
+                    seqs.append(Sequence(name, seq))
         return seqs
+
+    def extract_from_sequences(self, reads_to_extract, name_to_sequence):
+        '''Like extract_and_read, except extract from sequences which have
+        already been read in, so the file does not need to be read again.
+
+        Parameters
+        ----------
+        reads_to_extract: Iterable of str
+            IDs of reads to be extracted
+        name_to_sequence: dict of str to str
+            read name to sequence, as from SeqReader().read_nucleotide_sequences
+
+        Returns
+        -------
+        An array of graftm.sequence_io.Sequence objects, in the order of
+        name_to_sequence'''
+        reads_to_extract = set(reads_to_extract)
+        return [Sequence(name, seq) for name, seq in name_to_sequence.items()
+                if name in reads_to_extract]
+
@@ -0,0 +1,121 @@
+import os
+import shutil
+import logging
+
+
+class SharedMemoryBudget:
+    '''Keep a working directory in shared memory (/dev/shm) within a budget,
+    by moving the largest intermediate directories to a directory on disk
+    once the budget is exceeded, or making directories on disk in the first
+    place when they are expected to exceed it. A symbolic link is left in place of each
+    moved directory so that paths to it remain valid, while small files stay
+    in shared memory.'''
+
+    def __init__(self, working_directory, spill_directory, budget):
+        '''
+        Parameters
+        ----------
+        working_directory: str
+            directory in shared memory
+        spill_directory: str
+            directory on disk to move intermediate directories to
+        budget: int
+            maximum number of bytes to keep in working_directory
+        '''
+        self._working_directory = working_directory
+        self._spill_directory = spill_directory
+        self._budget = budget
+        self._spillable_paths = []
+        self._spilled_paths = {}
+        self._num_spilled = 0
+        self._bytes_used = 0
+
+    def stage_completed(self, stage, output_paths):
+        '''Record the directories written by a stage, and if the working
+        directory is over budget, move the largest directories written by this
+        and earlier stages to disk.'''
+        for path in output_paths:
+            if os.path.isdir(path) and not os.path.islink(path) and \
+               path not in self._spillable_paths:
+                self._spillable_paths.append(path)
+
+        bytes_used = self._directory_bytes(self._working_directory)
+        logging.debug("Stage '%s' changed shared memory usage by %.3fGB to %.3fGB" % (
+            stage, (bytes_used - self._bytes_used) / 1024**3, bytes_used / 1024**3))
+        if bytes_used > self._budget:
+            candidates = sorted(
+                [(self._directory_bytes(p), p) for p in self._spillable_paths
+                 if os.path.isdir(p) and not os.path.islink(p)],
+                reverse=True)
+            for size, path in candidates:
+                if bytes_used <= self._budget: break
+                if size == 0: break
+                self._spill(path, size)
+                bytes_used -= size
+            if bytes_used > self._budget:
+                logging.warning(
+                    "Shared memory usage of %.3fGB remains over the budget of %.3fGB" % (
+                        bytes_used / 1024**3, self._budget / 1024**3))
+        self._bytes_used = bytes_used
+
+    def make_directory(self, path, expected_bytes):
+        '''Make a directory that is expected to have about expected_bytes
+        written to it. If that would take the working directory over budget,
+        the directory is made on disk instead, with a symbolic link to it left
+        at path.'''
+        bytes_used = self._directory_bytes(self._working_directory)
+        if bytes_used + expected_bytes > self._budget:
+            destination = self._spill_destination(path)
+            logging.info("Using %s on disk for %s, since the expected %.3fGB would take shared memory usage over the budget of %.3fGB" % (
+                destination, path, expected_bytes / 1024**3, self._budget / 1024**3))
+            os.mkdir(destination)
+            os.symlink(destination, path)
+            self._spilled_paths[path] = destination
+        else:
+            os.mkdir(path)
+
+    def remove_directory(self, path):
+        '''Remove a directory, whether or not it has been moved to disk.'''
+        if path in self._spilled_paths:
+            os.remove(path)
+            shutil.rmtree(self._spilled_paths.pop(path))
+        else:
+            shutil.rmtree(path)
+        self.release(path)
+
+    def release(self, directory):
+        '''Remove the spilled copies of directories that were inside the given
+        directory, after it has been removed.'''
+        prefix = os.path.join(directory, '')
+        for path in list(self._spilled_paths.keys()):
+            if path.startswith(prefix):
+                shutil.rmtree(self._spilled_paths.pop(path))
+        self._spillable_paths = [
+            p for p in self._spillable_paths if not p.startswith(prefix)]
+
+    def _spill_destination(self, path):
+        destination = os.path.join(
+            self._spill_directory, '%i_%s' % (
+                self._num_spilled, os.path.basename(path)))
+        self._num_spilled += 1
+        return destination
+
+    def _spill(self, path, size):
+        destination = self._spill_destination(path)
+        logging.info("Moving %.3fGB in %s from shared memory to %s" % (
+            size / 1024**3, path, destination))
+        shutil.move(path, destination)
+        os.symlink(destination, path)
+        self._spilled_paths[path] = destination
+
+    def _directory_bytes(self, directory):
+        # Symbolic links are not followed, so spilled directories are not
+        # counted.
+        total = 0
+        for root, _, files in os.walk(directory):
+            for f in files:
+                try:
+                    total += os.lstat(os.path.join(root, f)).st_size
+                except FileNotFoundError:
+                    pass
+        return total
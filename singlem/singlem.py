@@ -1,4 +1,3 @@
-import re
 import os
 import csv
 import logging
@@ -6,13 +5,61 @@ import itertools
 import pkg_resources
 import extern
 import tempfile
+import hashlib
+import fcntl
 
 from .singlem_package import SingleMPackage
 
 
+def singlem_cache_directory():
+    '''Return the base directory under which SingleM caches data that can be
+    shared between runs, which is $SINGLEM_CACHE_DIRECTORY if set, otherwise a
+    'singlem' directory in the XDG cache directory (usually ~/.cache).'''
+    if 'SINGLEM_CACHE_DIRECTORY' in os.environ:
+        return os.environ['SINGLEM_CACHE_DIRECTORY']
+    xdg_cache = os.environ.get('XDG_CACHE_HOME',
+                               os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(xdg_cache, 'singlem')
+
+
+class OrfMName:
+    '''The parts of the name OrfM gives an ORF, which is
+    <read name>_<start>_<frame>_<ORF number>. The start is 1-based, and frames
+    4 to 6 are on the reverse strand.'''
+    __slots__ = ('read_name', 'start', 'frame', 'orf_number')
+
+    def __init__(self, read_name, start, frame, orf_number):
+        self.read_name = read_name
+        self.start = start
+        self.frame = frame
+        self.orf_number = orf_number
+
+    def is_reverse_frame(self):
+        return self.frame > 3
+
+
+def _split_orfm_name(name):
+    '''Return the read name, start, frame and ORF number of an ORF name as a
+    list of strings, or None if the name is not of the form given by OrfM.'''
+    parts = name.rsplit('_', 3)
+    if len(parts) == 4 and parts[1].isdecimal() and parts[2].isdecimal() and \
+       parts[3].isdecimal():
+        return parts
+    return None
+
+def parse_orfm_name(name):
+    '''Return an OrfMName of the parts of an ORF name, or None if the name is
+    not of the form given by OrfM.'''
+    parts = _split_orfm_name(name)
+    if parts is None:
+        return None
+    return OrfMName(parts[0], int(parts[1]), int(parts[2]), int(parts[3]))
+
+
 class OrfMUtils:
     def un_orfm_name(self, name):
-        return re.sub('_\d+_\d+_\d+$', '', name)
+        parts = _split_orfm_name(name)
+        return name if parts is None else parts[0]
 
 
 class TaxonomyFile:
@@ -59,19 +106,79 @@ class HmmDatabase:
 
         for pkg in self.singlem_packages:
             self._hmms_and_positions[pkg.base_directory()] = pkg
-
-    def get_dmnd(self):
-        ''' Create temporary DIAMOND file for search method '''
+        self._cache_directory_to_dmnd = {}
+
+    def packages_sha256(self):
+        '''Return a sha256 identifying the set of packages in this database,
+        independent of the order in which they were specified.'''
+        package_hashes = [
+            pkg.recorded_or_calculated_singlem_package_sha256()
+            for pkg in self.singlem_packages]
+        return hashlib.sha256(
+            '\n'.join(sorted(package_hashes)).encode()).hexdigest()
+
+    def get_dmnd(self, cache_directory=None):
+        '''Return the path to a DIAMOND database of the unaligned sequences of
+        all packages. The database is cached in cache_directory (by default
+        'diamond_prefilter' in the SingleM cache directory), keyed on the
+        sha256 of the packages, so it is only built once for each set of
+        packages. A lock is taken while building so that concurrent runs can
+        share the cache safely.'''
+        if cache_directory is None:
+            cache_directory = os.path.join(singlem_cache_directory(), 'diamond_prefilter')
+        if cache_directory not in self._cache_directory_to_dmnd:
+            self._cache_directory_to_dmnd[cache_directory] = \
+                self._get_dmnd(cache_directory)
+        return self._cache_directory_to_dmnd[cache_directory]
+
+    def _get_dmnd(self, cache_directory):
+        try:
+            os.makedirs(cache_directory, exist_ok=True)
+        except OSError as e:
+            logging.warning(
+                "Unable to create DIAMOND database cache directory %s (%s), "
+                "building an uncached database instead" % (cache_directory, e))
+            temp_dmnd = tempfile.NamedTemporaryFile(
+                mode="w", prefix='singlem-diamond-prefilter', suffix='.dmnd',
+                delete=False).name
+            self._make_dmnd(temp_dmnd)
+            return temp_dmnd
+
+        key = self.packages_sha256()
+        dmnd = os.path.join(cache_directory, '%s.dmnd' % key)
+        if os.path.exists(dmnd):
+            logging.debug("Using cached DIAMOND prefilter database %s" % dmnd)
+            return dmnd
+
+        with open(os.path.join(cache_directory, '%s.lock' % key), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                # Another process may have built the database while we were
+                # waiting for the lock.
+                if os.path.exists(dmnd):
+                    logging.debug("Using cached DIAMOND prefilter database %s" % dmnd)
+                else:
+                    logging.info("Building DIAMOND prefilter database %s" % dmnd)
+                    # Build to a separate file and move it into place so
+                    # that a partially built database is never used.
+                    partial_dmnd = os.path.join(
+                        cache_directory, '%s.%i.partial.dmnd' % (key, os.getpid()))
+                    try:
+                        self._make_dmnd(partial_dmnd)
+                        os.rename(partial_dmnd, dmnd)
+                    finally:
+                        if os.path.exists(partial_dmnd):
+                            os.remove(partial_dmnd)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return dmnd
+
+    def _make_dmnd(self, output_dmnd):
         fasta_paths = [pkg.graftm_package().unaligned_sequence_database_path() for pkg in self.singlem_packages]
-        temp_dmnd = tempfile.NamedTemporaryFile(mode="w", prefix='singlem-diamond-prefilter', 
-                                                suffix='.dmnd', delete=False).name
         cmd = 'cat %s | '\
-            'diamond makedb --in - --db %s' % (' '.join(fasta_paths), temp_dmnd)
-        
+            'diamond makedb --in - --db %s' % (' '.join(fasta_paths), output_dmnd)
         extern.run(cmd)
-        
-        return temp_dmnd
-    
+
     def protein_packages(self):
         return [pkg for pkg in self._hmms_and_positions.values() if pkg.is_protein_package()]
 
@@ -133,6 +133,14 @@ class SingleMPackageVersion1(SingleMPackage):
     def singlem_package_sha256(self):
         return self._contents_hash[SingleMPackage.SINGLEM_PACKAGE_SHA256_KEY]
 
+    def recorded_or_calculated_singlem_package_sha256(self):
+        '''Return the sha256 recorded in the package contents, or calculate it
+        for old packages which do not have it recorded.'''
+        try:
+            return self.singlem_package_sha256()
+        except KeyError:
+            return self.calculate_singlem_package_sha256()
+
     def hmm_path(self):
         return self.graftm_package().alignment_hmm_path()
 
@@ -0,0 +1,126 @@
+import os
+import time
+import sqlite3
+import logging
+
+
+class TaxonomyCache:
+    '''A persistent store of the taxonomy assigned to OTU window sequences,
+    so that later runs using the same package and assignment method do not
+    need to assign them again.
+
+    The cache is an SQLite database, which may be shared between concurrent
+    runs. Once there are more than max_entries entries, those least recently
+    used are removed by evict().
+    '''
+
+    DEFAULT_MAX_ENTRIES = 10000000
+
+    # Number of sequences to query at once, below the SQLite limit on the
+    # number of parameters in a statement.
+    _QUERY_BATCH_SIZE = 500
+
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES):
+        '''
+        Parameters
+        ----------
+        path: str
+            path to the SQLite database, which is created if it does not exist
+        max_entries: int
+            maximum number of entries to keep
+        '''
+        if max_entries < 1:
+            raise Exception("The maximum number of taxonomy cache entries must be at least 1")
+        self._path = path
+        self._max_entries = max_entries
+        self._connection = None
+        self._connection_pid = None
+        self._package_keys = {}
+
+    def __getstate__(self):
+        # Connections cannot be shared with other processes, so each opens
+        # its own.
+        state = dict(self.__dict__)
+        state['_connection'] = None
+        state['_connection_pid'] = None
+        return state
+
+    def _connect(self):
+        if self._connection is None or self._connection_pid != os.getpid():
+            # A long timeout since other runs may be writing at the same time.
+            connection = sqlite3.connect(self._path, timeout=600)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS taxonomy ('
+                'package TEXT NOT NULL, '
+                'assignment_method TEXT NOT NULL, '
+                'sequence TEXT NOT NULL, '
+                'taxonomy TEXT NOT NULL, '
+                'last_used REAL NOT NULL, '
+                'PRIMARY KEY (package, assignment_method, sequence))')
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS taxonomy_last_used ON taxonomy (last_used)')
+            connection.commit()
+            self._connection = connection
+            self._connection_pid = os.getpid()
+        return self._connection
+
+    def package_key(self, singlem_package):
+        '''Return the str identifying the given package in the cache.'''
+        base_directory = singlem_package.base_directory()
+        if base_directory not in self._package_keys:
+            self._package_keys[base_directory] = \
+                singlem_package.recorded_or_calculated_singlem_package_sha256()
+        return self._package_keys[base_directory]
+
+    def lookup(self, singlem_package, assignment_method, sequences):
+        '''Return a dict of sequence to taxonomy for those of the given
+        sequences which are in the cache.'''
+        package = self.package_key(singlem_package)
+        sequences = list(set(sequences))
+        connection = self._connect()
+        found = {}
+        for i in range(0, len(sequences), self._QUERY_BATCH_SIZE):
+            batch = sequences[i:(i+self._QUERY_BATCH_SIZE)]
+            for (sequence, taxonomy) in connection.execute(
+                    'SELECT sequence, taxonomy FROM taxonomy '
+                    'WHERE package = ? AND assignment_method = ? AND sequence IN (%s)' % \
+                    ','.join(['?']*len(batch)),
+                    [package, assignment_method] + batch):
+                found[sequence] = taxonomy
+        return found
+
+    def store(self, singlem_package, assignment_method, sequence_to_taxonomy):
+        '''Add the given sequences and their taxonomy to the cache, or mark
+        them as recently used if they are already there.'''
+        if len(sequence_to_taxonomy) == 0: return
+        package = self.package_key(singlem_package)
+        now = time.time()
+        connection = self._connect()
+        with connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO taxonomy '
+                '(package, assignment_method, sequence, taxonomy, last_used) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [(package, assignment_method, sequence, taxonomy, now)
+                 for sequence, taxonomy in sequence_to_taxonomy.items()])
+
+    def evict(self):
+        '''Remove the least recently used entries so that no more than
+        max_entries remain.'''
+        connection = self._connect()
+        with connection:
+            num_entries = connection.execute('SELECT COUNT(*) FROM taxonomy').fetchone()[0]
+            if num_entries > self._max_entries:
+                logging.info("Removing %i least recently used entries from the taxonomy cache" % (
+                    num_entries - self._max_entries))
+                connection.execute(
+                    'DELETE FROM taxonomy WHERE rowid IN '
+                    '(SELECT rowid FROM taxonomy ORDER BY last_used LIMIT ?)',
+                    (num_entries - self._max_entries,))
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+            self._connection_pid = None
@@ -0,0 +1,169 @@
+import os
+import csv
+import logging
+
+import numpy as np
+
+from .singlem import singlem_cache_directory
+
+
+class TaxonomyTree:
+    '''A taxonomy stored compactly as arrays indexed by integer node id: the
+    id of each node's parent (-1 for roots), the depth of each node (0 for
+    roots) and a table of node names.
+
+    Trees of SingleM packages are cached on disk, keyed on the package's
+    sha256, so that the taxtastic taxonomy does not need to be parsed again
+    by later runs.'''
+
+    CACHE_DIRECTORY_NAME = 'taxonomy_tree'
+
+    def __init__(self, names, parents, depths):
+        '''
+        Parameters
+        ----------
+        names: list of str
+            name of each node
+        parents: numpy array of int32
+            id of the parent of each node, or -1 for a root
+        depths: numpy array of int32
+            number of ancestors of each node
+        '''
+        self.names = names
+        self.parents = parents
+        self.depths = depths
+        self._name_to_id = dict((name, i) for i, name in enumerate(names))
+        self._ancestor_ids = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def node_id(self, name):
+        return self._name_to_id[name]
+
+    def ancestor_ids(self, node_id):
+        '''Return a tuple of the ids from the root down to the given node id,
+        inclusive. Results are cached, so each is only calculated once.'''
+        try:
+            return self._ancestor_ids[node_id]
+        except KeyError:
+            parent_id = int(self.parents[node_id])
+            if parent_id < 0:
+                ancestors = (node_id,)
+            else:
+                ancestors = self.ancestor_ids(parent_id) + (node_id,)
+            self._ancestor_ids[node_id] = ancestors
+            return ancestors
+
+    def lca_id(self, node_id1, node_id2):
+        '''Return the id of the lowest common ancestor of two node ids, or
+        None if they are in different trees.'''
+        parents = self.parents
+        depths = self.depths
+        while depths[node_id1] > depths[node_id2]:
+            node_id1 = parents[node_id1]
+        while depths[node_id2] > depths[node_id1]:
+            node_id2 = parents[node_id2]
+        while node_id1 != node_id2:
+            node_id1 = parents[node_id1]
+            node_id2 = parents[node_id2]
+        return None if node_id1 < 0 else int(node_id1)
+
+    @staticmethod
+    def parse_taxtastic_taxonomy(taxtastic_taxonomy_io):
+        '''Read a taxtastic style taxonomy in, given an open IO object to e.g. the
+        file'''
+        names = []
+        parent_names = []
+        name_to_id = {}
+        csv_reader = csv.reader(taxtastic_taxonomy_io, delimiter=',')
+        next(csv_reader, None) # Skip the header
+        for row in csv_reader:
+            tax_id = row[0]
+            if tax_id in name_to_id:
+                raise Exception(
+                    "Found duplicate parents for child ID %s when parsing taxonomy file" %
+                    tax_id)
+            name_to_id[tax_id] = len(names)
+            names.append(tax_id)
+            parent_names.append(None if tax_id == 'Root' else row[1])
+
+        parents = [-1 if p is None else name_to_id[p] for p in parent_names]
+        # Parents usually precede their children, but this is not required.
+        depths = [-1] * len(names)
+        for node_id in range(len(names)):
+            lineage = []
+            while node_id >= 0 and depths[node_id] < 0:
+                lineage.append(node_id)
+                node_id = parents[node_id]
+                if len(lineage) > len(names):
+                    raise Exception("Found a cycle when parsing taxonomy file")
+            depth = -1 if node_id < 0 else depths[node_id]
+            for lineage_node_id in reversed(lineage):
+                depth += 1
+                depths[lineage_node_id] = depth
+        return TaxonomyTree(
+            names, np.array(parents, dtype=np.int32), np.array(depths, dtype=np.int32))
+
+    def write(self, path):
+        '''Write the tree to a numpy .npz file'''
+        with open(path, 'wb') as f:
+            np.savez(f,
+                     names=np.array(self.names, dtype=str),
+                     parents=self.parents,
+                     depths=self.depths)
+
+    @staticmethod
+    def read(path):
+        '''Read a tree written by write()'''
+        with np.load(path, allow_pickle=False) as data:
+            return TaxonomyTree(
+                data['names'].tolist(), data['parents'], data['depths'])
+
+    @staticmethod
+    def acquire(singlem_package, cache_directory=None):
+        '''Return the tree of the taxtastic taxonomy of a SingleM package,
+        reading it from the cache if possible.
+
+        Parameters
+        ----------
+        singlem_package: SingleMPackage
+            package whose taxonomy to read
+        cache_directory: str or None
+            directory to cache trees in, by default 'taxonomy_tree' in the
+            SingleM cache directory
+        '''
+        taxtastic_taxonomy = singlem_package.graftm_package().taxtastic_taxonomy_path()
+        try:
+            sha256 = singlem_package.singlem_package_sha256()
+        except KeyError:
+            # Old packages may not have the sha256 recorded, and calculating
+            # it is slower than parsing the taxonomy.
+            sha256 = None
+        if sha256 is None:
+            cache_path = None
+        else:
+            if cache_directory is None:
+                cache_directory = os.path.join(
+                    singlem_cache_directory(), TaxonomyTree.CACHE_DIRECTORY_NAME)
+            cache_path = os.path.join(cache_directory, '%s.npz' % sha256)
+            if os.path.exists(cache_path):
+                logging.debug("Using cached taxonomy tree %s" % cache_path)
+                return TaxonomyTree.read(cache_path)
+
+        logging.debug("Reading taxtastic taxonomy from %s" % taxtastic_taxonomy)
+        with open(taxtastic_taxonomy) as f:
+            tree = TaxonomyTree.parse_taxtastic_taxonomy(f)
+
+        if cache_path is not None:
+            try:
+                os.makedirs(cache_directory, exist_ok=True)
+                # Write to a separate file and move it into place so that a
+                # partially written cache file is never read.
+                partial_path = '%s.%i.partial' % (cache_path, os.getpid())
+                tree.write(partial_path)
+                os.rename(partial_path, cache_path)
+            except OSError as e:
+                logging.warning("Unable to cache taxonomy tree in %s (%s)" % (
+                    cache_directory, e))
+        return tree
@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import logging
+import resource
+import threading
+import subprocess
+import contextlib
+
+import extern
+
+
+class TimingReport:
+    '''Record the wall time, CPU time, peak memory and working directory usage
+    of each stage of a pipe run, and the resource usage of each external
+    command run during it, to be written out as a JSON report.'''
+
+    def __init__(self, working_directory=None):
+        '''
+        Parameters
+        ----------
+        working_directory: str or None
+            directory whose size is recorded after each stage, or None to not
+            record it
+        '''
+        self._working_directory = working_directory
+        self._start_time = time.time()
+        self._stages = []
+        self._commands = []
+        self._current_stage = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Locks cannot be pickled
+        state = dict(self.__dict__)
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, stage, batch=None):
+        '''Context manager recording the resources used while running the
+        given stage. External commands run with run() during the stage are
+        attributed to it.'''
+        self._reset_peak_rss()
+        start_directory_bytes = self._working_directory_bytes()
+        start_self = resource.getrusage(resource.RUSAGE_SELF)
+        start_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start_time = time.time()
+        self._current_stage = stage
+        try:
+            yield
+        finally:
+            self._current_stage = None
+            end_time = time.time()
+            end_self = resource.getrusage(resource.RUSAGE_SELF)
+            end_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            end_directory_bytes = self._working_directory_bytes()
+            record = {
+                'stage': stage,
+                'batch': batch,
+                'wall_seconds': end_time - start_time,
+                'user_cpu_seconds': end_self.ru_utime - start_self.ru_utime,
+                'system_cpu_seconds': end_self.ru_stime - start_self.ru_stime,
+                # Child processes are only included once they have finished.
+                'children_user_cpu_seconds': end_children.ru_utime - start_children.ru_utime,
+                'children_system_cpu_seconds': end_children.ru_stime - start_children.ru_stime,
+                'peak_rss_bytes': self._peak_rss(end_self),
+                'working_directory_bytes': end_directory_bytes,
+                'working_directory_bytes_added': None \
+                    if start_directory_bytes is None or end_directory_bytes is None \
+                    else end_directory_bytes - start_directory_bytes}
+            self._stages.append(record)
+            logging.debug("Stage '%s' took %.1f seconds" % (stage, record['wall_seconds']))
+
+    def run(self, command):
+        '''Run a command as extern.run() does, recording its resource usage.
+        Returns the standard output of the command, and raises
+        extern.ExternCalledProcessError if it fails.'''
+        logging.debug("Running extern cmd: %s" % command)
+        start_time = time.time()
+        process = subprocess.Popen(
+            ["bash", '-o', 'pipefail', "-c", command],
+            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # Read output in other threads so that the process can be waited on
+        # directly, to get the resource usage of it and its descendants.
+        outputs = {}
+        def read(name, stream):
+            outputs[name] = stream.read()
+            stream.close()
+        readers = [
+            threading.Thread(target=read, args=('stdout', process.stdout)),
+            threading.Thread(target=read, args=('stderr', process.stderr))]
+        for reader in readers: reader.start()
+        for reader in readers: reader.join()
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        end_time = time.time()
+
+        with self._lock:
+            self._commands.append({
+                'stage': self._current_stage,
+                'command': command,
+                'exit_status': process.returncode,
+                'wall_seconds': end_time - start_time,
+                'user_cpu_seconds': usage.ru_utime,
+                'system_cpu_seconds': usage.ru_stime,
+                'peak_rss_bytes': usage.ru_maxrss * 1024})
+
+        if process.returncode != 0:
+            raise extern.ExternCalledProcessError(
+                subprocess.CompletedProcess(
+                    process.args, process.returncode, outputs['stdout'], outputs['stderr']),
+                command)
+        return outputs['stdout'].decode('UTF-8')
+
+    def report(self):
+        '''Return the report as a JSON-serialisable dict.'''
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return {
+            'wall_seconds': time.time() - self._start_time,
+            'user_cpu_seconds': usage.ru_utime,
+            'system_cpu_seconds': usage.ru_stime,
+            'children_user_cpu_seconds': children_usage.ru_utime,
+            'children_system_cpu_seconds': children_usage.ru_stime,
+            'peak_rss_bytes': usage.ru_maxrss * 1024,
+            'children_peak_rss_bytes': children_usage.ru_maxrss * 1024,
+            'stages': self._stages,
+            'commands': self._commands}
+
+    def write(self, path):
+        logging.info("Writing timing report to %s" % path)
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+    def _working_directory_bytes(self):
+        if self._working_directory is None or \
+           not os.path.isdir(self._working_directory):
+            return None
+        total = 0
+        for root, _, files in os.walk(self._working_directory):
+            for f in files:
+                try:
+                    total += os.lstat(os.path.join(root, f)).st_size
+                except FileNotFoundError:
+                    # Removed while walking
+                    pass
+        return total
+
+    def _reset_peak_rss(self):
+        # Reset the peak resident set size so that each stage's peak can be
+        # measured, which is possible on Linux only.
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+        except OSError:
+            pass
+
+    def _peak_rss(self, usage):
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        # Peak over the whole run
+        return usage.ru_maxrss * 1024
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import unittest
+import os.path
+import sys
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from singlem.alignment_columns import AlignmentColumns, alignment_matrix
+from singlem.sequence_classes import Sequence
+
+class Tests(unittest.TestCase):
+    def test_from_alignment(self):
+        alignment = [
+            Sequence('1', 'aAC-Dg'),
+            Sequence('2', '-ACtD-'),
+            Sequence('3', '-A--D-')]
+        columns = AlignmentColumns.from_alignment(alignment)
+        self.assertEqual([0, 3, 5], columns.insert_columns().tolist())
+        self.assertEqual([1, 2, 4], columns.match_columns.tolist())
+        self.assertEqual(6, len(columns))
+        self.assertEqual([2, 4], columns.window(1, 2).tolist())
+        with self.assertRaises(Exception):
+            columns.window(2, 2)
+
+    def test_from_alignment_blocks(self):
+        alignment = [Sequence(str(i), 'A-C') for i in range(25)]
+        alignment[17] = Sequence('17', 'AcC')
+        original_block_size = AlignmentColumns.BLOCK_SIZE
+        AlignmentColumns.BLOCK_SIZE = 4
+        try:
+            columns = AlignmentColumns.from_alignment(alignment)
+        finally:
+            AlignmentColumns.BLOCK_SIZE = original_block_size
+        self.assertEqual([1], columns.insert_columns().tolist())
+
+    def test_from_hmmalign_sequence(self):
+        columns = AlignmentColumns.from_hmmalign_sequence('..AC-.Dg-')
+        self.assertEqual([2, 3, 4, 6, 8], columns.match_columns.tolist())
+        self.assertEqual(9, len(columns))
+        self.assertEqual([3, 4, 6], columns.window(1, 3).tolist())
+        with self.assertRaises(Exception):
+            columns.window(3, 3)
+
+    def test_alignment_matrix(self):
+        self.assertEqual(
+            [[65, 45], [97, 67]],
+            alignment_matrix([Sequence('1', 'A-'), Sequence('2', 'aC')]).tolist())
+        with self.assertRaises(Exception):
+            alignment_matrix([Sequence('1', 'A-'), Sequence('2', 'aCG')])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import unittest
+import os.path
+import sys
+import tempdir
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from singlem.checkpointer import Checkpointer
+
+class Tests(unittest.TestCase):
+    def test_resume_skips_completed_stages(self):
+        with tempdir.TempDir() as d:
+            calls = []
+            c = Checkpointer(d, 'abc', False)
+            self.assertEqual(1, c.run_stage('search', lambda: calls.append('search') or 1))
+            self.assertEqual(2, c.run_stage('align', lambda: calls.append('align') or 2))
+            self.assertEqual(['search','align'], calls)
+
+            c = Checkpointer(d, 'abc', True)
+            self.assertEqual(1, c.run_stage('search', lambda: calls.append('search2') or 10))
+            self.assertEqual(2, c.run_stage('align', lambda: calls.append('align2') or 20))
+            self.assertEqual(30, c.run_stage('assign', lambda: calls.append('assign2') or 30))
+            self.assertEqual(['search','align','assign2'], calls)
+
+    def test_changed_fingerprint_reruns(self):
+        with tempdir.TempDir() as d:
+            Checkpointer(d, 'abc', False).run_stage('search', lambda: 1)
+            c = Checkpointer(d, 'def', True)
+            self.assertFalse(c.is_complete('search'))
+            self.assertEqual(5, c.run_stage('search', lambda: 5))
+            self.assertTrue(c.is_complete('search'))
+
+    def test_stages_after_rerun_stage_are_rerun(self):
+        with tempdir.TempDir() as d:
+            c = Checkpointer(d, 'abc', False)
+            c.run_stage('align', lambda: 2)
+            # search not completed, so align must be re-run even though it
+            # was completed previously
+            c = Checkpointer(d, 'abc', True)
+            self.assertEqual(1, c.run_stage('search', lambda: 1))
+            self.assertEqual(3, c.run_stage('align', lambda: 3))
+
+    def test_output_paths_removed(self):
+        with tempdir.TempDir() as d:
+            out = os.path.join(d, 'graftm_separates')
+            os.mkdir(out)
+            c = Checkpointer(d, 'abc', True)
+            c.run_stage('align', lambda: os.path.exists(out), [out])
+            self.assertFalse(os.path.exists(out))
+
+    def test_stage_prefix(self):
+        with tempdir.TempDir() as d:
+            Checkpointer(d, 'abc', False, 'sample_batch0').run_stage('search', lambda: 1)
+            self.assertTrue(Checkpointer(d, 'abc', True, 'sample_batch0').is_complete('search'))
+            self.assertFalse(Checkpointer(d, 'abc', True, 'sample_batch1').is_complete('search'))
+
+    def test_disabled(self):
+        c = Checkpointer(None, 'abc', True)
+        self.assertEqual(1, c.run_stage('search', lambda: 1))
+        self.assertFalse(c.is_complete('search'))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import unittest
+import os.path
+import sys
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from singlem.early_stopper import EarlyStopper
+
+class Tests(unittest.TestCase):
+    def test_min_hits(self):
+        stopper = EarlyStopper(['a', 'b'], min_hits=10)
+        stopper.add_chunk(0, 100, {'a': 8, 'b': 12})
+        self.assertFalse(stopper.is_complete())
+        stopper.add_chunk(1, 100, {'a': 3, 'b': 0})
+        self.assertTrue(stopper.is_complete())
+        self.assertEqual({'a': 11, 'b': 12}, stopper.package_to_hits)
+        self.assertEqual(200, stopper.num_sequences)
+
+    def test_convergence(self):
+        stopper = EarlyStopper(['a', 'b'], convergence=0.1)
+        stopper.add_chunk(0, 100, {'a': 10, 'b': 4})
+        # At least two chunks are required to measure convergence
+        self.assertFalse(stopper.is_complete())
+        stopper.add_chunk(1, 100, {'a': 5, 'b': 4})
+        self.assertFalse(stopper.is_complete())
+        stopper.add_chunk(2, 100, {'a': 7, 'b': 4})
+        self.assertTrue(stopper.is_complete())
+
+    def test_package_without_hits_is_not_converged(self):
+        stopper = EarlyStopper(['a', 'b'], convergence=0.1)
+        for i in range(5):
+            stopper.add_chunk(i, 100, {'a': 10, 'b': 0})
+        self.assertFalse(stopper.is_complete())
+
+    def test_package_appearing_later_is_not_converged(self):
+        stopper = EarlyStopper(['a', 'b'], convergence=0.1)
+        stopper.add_chunk(0, 100, {'a': 10, 'b': 0})
+        stopper.add_chunk(1, 100, {'a': 10, 'b': 1})
+        self.assertFalse(stopper.is_complete())
+
+    def test_either_criterion(self):
+        stopper = EarlyStopper(['a'], min_hits=5, convergence=0.0)
+        stopper.add_chunk(0, 100, {'a': 5})
+        self.assertTrue(stopper.is_complete())
+
+    def test_chunks_evaluated_in_order(self):
+        stopper = EarlyStopper(['a'], min_hits=10)
+        # The chunk read last finishes first, but is not used until those
+        # before it are added
+        stopper.add_chunk(2, 100, {'a': 10})
+        self.assertFalse(stopper.is_complete())
+        stopper.add_chunk(0, 100, {'a': 4})
+        self.assertFalse(stopper.is_complete())
+        stopper.add_chunk(1, 100, {'a': 6})
+        self.assertTrue(stopper.is_complete())
+        self.assertEqual(2, stopper.num_chunks)
+        self.assertEqual({'a': 10}, stopper.package_to_hits)
+        self.assertEqual(200, stopper.num_sequences)
+
+    def test_chunks_after_complete_are_ignored(self):
+        stopper = EarlyStopper(['a'], min_hits=10)
+        stopper.add_chunk(0, 100, {'a': 10})
+        stopper.add_chunk(1, 100, {'a': 3})
+        self.assertTrue(stopper.is_complete())
+        self.assertEqual(1, stopper.num_chunks)
+        self.assertEqual({'a': 10}, stopper.package_to_hits)
+        self.assertEqual(100, stopper.num_sequences)
+
+if __name__ == "__main__":
+    unittest.main()
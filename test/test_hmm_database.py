@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import unittest
+import os.path
+import sys
+import tempdir
+
+path_to_data = os.path.join(os.path.dirname(os.path.realpath(__file__)),'data')
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from singlem.singlem import HmmDatabase
+
+class Tests(unittest.TestCase):
+    pkg1 = os.path.join(path_to_data, '4.11.22seqs.gpkg.spkg')
+    pkg2 = os.path.join(path_to_data, '4.12.22seqs.spkg')
+
+    def test_packages_sha256_order_independent(self):
+        self.assertEqual(
+            HmmDatabase([self.pkg1, self.pkg2]).packages_sha256(),
+            HmmDatabase([self.pkg2, self.pkg1]).packages_sha256())
+        self.assertNotEqual(
+            HmmDatabase([self.pkg1]).packages_sha256(),
+            HmmDatabase([self.pkg1, self.pkg2]).packages_sha256())
+
+    def test_get_dmnd_cached(self):
+        hmms = HmmDatabase([self.pkg1, self.pkg2])
+        with tempdir.TempDir() as d:
+            cached = os.path.join(d, '%s.dmnd' % hmms.packages_sha256())
+            with open(cached, 'w') as f:
+                f.write('not really a dmnd')
+            # diamond is not run when the database is already cached
+            self.assertEqual(cached, hmms.get_dmnd(cache_directory=d))
+
+if __name__ == "__main__":
+    unittest.main()
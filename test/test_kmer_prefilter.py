@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import unittest
+import os.path
+import sys
+import tempdir
+from Bio.Seq import Seq
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+path_to_data = os.path.join(os.path.dirname(os.path.realpath(__file__)),'data')
+
+from singlem.singlem import HmmDatabase
+from singlem.kmer_prefilter import KmerPrefilter
+from singlem.sequence_classes import SeqReader
+
+class Tests(unittest.TestCase):
+    protein_package = os.path.join(path_to_data, '4.11.22seqs.gpkg.spkg')
+    nucleotide_package = os.path.join(path_to_data, '61_otus.v3.gpkg.spkg')
+
+    def package_sequences(self, package_path):
+        pkg = list(HmmDatabase([package_path]))[0]
+        with open(pkg.graftm_package().unaligned_sequence_database_path()) as f:
+            return [seq for _, seq, _ in SeqReader().readfq(f)]
+
+    def back_translate(self, protein):
+        codons = {'A':'GCT','R':'CGT','N':'AAT','D':'GAT','C':'TGT','Q':'CAA',
+                  'E':'GAA','G':'GGT','H':'CAT','I':'ATT','L':'CTT','K':'AAA',
+                  'M':'ATG','F':'TTT','P':'CCT','S':'TCT','T':'ACT','W':'TGG',
+                  'Y':'TAT','V':'GTT'}
+        return ''.join(codons[aa] for aa in protein)
+
+    def test_protein_package(self):
+        protein = self.package_sequences(self.protein_package)[0]
+        read = self.back_translate(protein[10:40])
+        reverse = str(Seq(read).reverse_complement())
+        with tempdir.TempDir() as cache:
+            prefilter = KmerPrefilter(
+                HmmDatabase([self.protein_package]), cache_directory=cache)
+            self.assertEqual(
+                [False, True, True, True, True, True, False, False],
+                list(prefilter.matching_reads([
+                    'ACGT'*20, read, 'G'+read, 'GG'+read, reverse, reverse+'A',
+                    '', read[:30]])))
+
+    def test_nucleotide_package(self):
+        sequence = self.package_sequences(self.nucleotide_package)[0]
+        read = sequence[20:60]
+        reverse = str(Seq(read).reverse_complement())
+        with tempdir.TempDir() as cache:
+            prefilter = KmerPrefilter(
+                HmmDatabase([self.nucleotide_package]), cache_directory=cache)
+            self.assertEqual(
+                [True, True, False, False],
+                list(prefilter.matching_reads([
+                    read, reverse, read[:15], 'A'*40])))
+
+    def test_cache(self):
+        with tempdir.TempDir() as cache:
+            KmerPrefilter(HmmDatabase([self.protein_package]), cache_directory=cache)
+            cached = os.listdir(cache)
+            self.assertEqual(1, len(cached))
+            self.assertTrue(cached[0].endswith('.protein11.npy'))
+            # Reading the cached k-mers gives the same result
+            prefilter = KmerPrefilter(
+                HmmDatabase([self.protein_package]), cache_directory=cache)
+            protein = self.package_sequences(self.protein_package)[0]
+            self.assertEqual(
+                [True], list(prefilter.matching_reads([self.back_translate(protein[:20])])))
+
+    def test_filter_pairs(self):
+        protein = self.package_sequences(self.protein_package)[0]
+        read = self.back_translate(protein[10:40])
+        with tempdir.TempDir() as d:
+            forward = os.path.join(d, 'forward.fq')
+            reverse = os.path.join(d, 'reverse.fa')
+            with open(forward, 'w') as f:
+                f.write('@r1 comment\n%s\n+\n%s\n' % (read, 'I'*len(read)))
+                f.write('@r2\n%s\n+\n%s\n' % ('A'*90, 'I'*90))
+                f.write('@r3\n%s\n+\n%s\n' % ('C'*90, 'I'*90))
+            with open(reverse, 'w') as f:
+                f.write('>r1\n%s\n>r2\n%s\n>r3\n%s\n' % ('T'*90, read, 'G'*90))
+            prefilter = KmerPrefilter(
+                HmmDatabase([self.protein_package]), cache_directory=os.path.join(d, 'cache'))
+            self.assertEqual((3, 2), prefilter.filter(
+                forward, os.path.join(d, 'out1.fna'), reverse, os.path.join(d, 'out2.fna')))
+            with open(os.path.join(d, 'out1.fna')) as f:
+                self.assertEqual('>r1\n%s\n>r2\n%s\n' % (read, 'A'*90), f.read())
+            with open(os.path.join(d, 'out2.fna')) as f:
+                self.assertEqual('>r1\n%s\n>r2\n%s\n' % ('T'*90, read), f.read())
+
+            # Pairs must not be silently dropped when the files differ in length
+            with open(reverse, 'w') as f:
+                f.write('>r1\n%s\n>r2\n%s\n' % ('T'*90, read))
+            with self.assertRaises(Exception):
+                prefilter.filter(
+                    forward, os.path.join(d, 'out1.fna'), reverse, os.path.join(d, 'out2.fna'))
+
+if __name__ == "__main__":
+    unittest.main()
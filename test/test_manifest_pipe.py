@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import unittest
+import os.path
+import sys
+import tempfile
+import tempdir
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from singlem.manifest_pipe import ManifestPipe
+from singlem.pipe import SearchPipe
+
+path_to_data = os.path.join(os.path.dirname(os.path.realpath(__file__)),'data')
+
+class Tests(unittest.TestCase):
+    def read_manifest(self, contents):
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.tsv') as f:
+            f.write(contents)
+            f.flush()
+            return ManifestPipe.read_manifest(f.name)
+
+    def test_read_manifest(self):
+        samples = self.read_manifest(
+            "# sample\tforward\treverse\toutput\n"
+            "s1\ts1.fa\n"
+            "\n"
+            "s2\ts2.fa\t\ts2.otu_table.csv\n")
+        self.assertEqual(
+            [('s1','s1.fa',None,None), ('s2','s2.fa',None,'s2.otu_table.csv')],
+            [(s.name, s.forward, s.reverse, s.output) for s in samples])
+
+    def test_read_manifest_paired(self):
+        samples = self.read_manifest(
+            "s1\ts1_1.fq\ts1_2.fq\n"
+            "s2\ts2_1.fq\ts2_2.fq\tout.csv\n")
+        self.assertEqual(
+            [('s1','s1_1.fq','s1_2.fq',None), ('s2','s2_1.fq','s2_2.fq','out.csv')],
+            [(s.name, s.forward, s.reverse, s.output) for s in samples])
+
+    def test_duplicate_sample_name(self):
+        with self.assertRaises(Exception):
+            self.read_manifest("s1\ta.fa\ns1\tb.fa\n")
+
+    def test_mixed_paired_and_unpaired(self):
+        with self.assertRaises(Exception):
+            self.read_manifest("s1\ta.fa\ns2\tb_1.fa\tb_2.fa\n")
+
+    def test_too_few_columns(self):
+        with self.assertRaises(Exception):
+            self.read_manifest("s1\n")
+
+    def test_two_samples_in_one_process_with_tmpdir(self):
+        class NoHits:
+            def samples_with_hits(self):
+                return []
+        original_search = SearchPipe._search
+        SearchPipe._search = lambda self, *args: NoHits()
+        original_tempdir = tempfile.tempdir
+        original_temp = os.environ.get('TEMP')
+        try:
+            with tempdir.TempDir() as d:
+                for name in ['s1', 's2']:
+                    with open(os.path.join(d, name + '.fa'), 'w') as f:
+                        f.write('>read\nATGC\n')
+                manifest = os.path.join(d, 'manifest.tsv')
+                with open(manifest, 'w') as f:
+                    f.write('s1\t%s\ns2\t%s\n' % (
+                        os.path.join(d, 's1.fa'), os.path.join(d, 's2.fa')))
+                # With one thread, samples run one after the other in this
+                # process, each with its own temporary working directory.
+                ManifestPipe(manifest).run(
+                    otu_table=os.path.join(d, 'otu_table.csv'),
+                    output_extras=False,
+                    threads=1,
+                    working_directory=None,
+                    working_directory_tmpdir=True,
+                    force=False,
+                    singlem_packages=[os.path.join(path_to_data, '4.11.22seqs.gpkg.spkg')],
+                    known_otu_tables=None,
+                    assignment_method='pplacer',
+                    output_jplace=None,
+                    evalue=None,
+                    min_orf_length=SearchPipe.DEFAULT_MIN_ORF_LENGTH,
+                    restrict_read_length=None,
+                    filter_minimum_protein=SearchPipe.DEFAULT_FILTER_MINIMUM_PROTEIN,
+                    filter_minimum_nucleotide=SearchPipe.DEFAULT_FILTER_MINIMUM_NUCLEOTIDE,
+                    include_inserts=False,
+                    assign_taxonomy=True,
+                    known_sequence_taxonomy=None,
+                    diamond_prefilter=False)
+                with open(os.path.join(d, 'otu_table.csv')) as f:
+                    self.assertEqual(
+                        'gene\tsample\tsequence\tnum_hits\tcoverage\ttaxonomy\n', f.read())
+            # The temporary directory is restored after each sample
+            self.assertEqual(original_tempdir, tempfile.tempdir)
+            self.assertEqual(original_temp, os.environ.get('TEMP'))
+        finally:
+            SearchPipe._search = original_search
+
+if __name__ == "__main__":
+    unittest.main()
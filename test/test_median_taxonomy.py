@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import unittest
+import os.path
+import sys
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from singlem.median_taxonomy import MedianTaxonomy
+
+class Tests(unittest.TestCase):
+    def test_majority_per_level(self):
+        median = MedianTaxonomy()
+        self.assertEqual('Root; d__Bacteria', median.median([
+            'Root; d__Bacteria; p__Firmicutes',
+            'Root; d__Bacteria; p__Proteobacteria',
+            'Root;d__Bacteria',
+            'Root; d__Archaea']))
+        self.assertEqual('Root; d__Bacteria; p__Firmicutes', median.median([
+            'Root; d__Bacteria; p__Firmicutes',
+            'Root; d__Bacteria; p__Firmicutes ',
+            'Root; d__Archaea']))
+
+    def test_no_majority(self):
+        median = MedianTaxonomy()
+        self.assertEqual('', median.median(['Root', 'Other']))
+        self.assertEqual('', median.median([]))
+
+    def test_identical(self):
+        median = MedianTaxonomy()
+        self.assertEqual('Root; d__Bacteria', median.median(['Root;d__Bacteria ']*3))
+        self.assertEqual('', median.median(['']))
+
+    def test_interning_and_cache(self):
+        median = MedianTaxonomy(max_cached=1)
+        self.assertEqual(median.lineage_id('Root; a'), median.lineage_id('Root; a'))
+        self.assertNotEqual(median.lineage_id('Root; a'), median.lineage_id('Root; b'))
+        for _ in range(2):
+            self.assertEqual('Root; a', median.median(['Root; a', 'Root; b', 'Root; a']))
+            # Order does not matter
+            self.assertEqual('Root; a', median.median(['Root; b', 'Root; a', 'Root; a']))
+            self.assertEqual('Root', median.median(['Root; a', 'Root; b']))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import unittest
+import os.path
+import sys
+import threading
+import time
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from singlem.memory_scheduler import MemoryScheduler
+
+class Tests(unittest.TestCase):
+    def test_threads_per_job(self):
+        s = MemoryScheduler(10, 8)
+        self.assertEqual(1, s.max_concurrent_jobs([20]))
+        self.assertEqual(8, s.threads_per_job([20, 20]))
+        self.assertEqual(2, s.max_concurrent_jobs([6, 4, 5]))
+        self.assertEqual(4, s.threads_per_job([6, 4, 5]))
+        self.assertEqual(8, s.max_concurrent_jobs([1]*20))
+        self.assertEqual(1, s.threads_per_job([1]*20))
+
+    def test_run_within_memory(self):
+        lock = threading.Lock()
+        state = {'memory': 0, 'max_memory': 0}
+        def job(memory, result):
+            def run(threads):
+                with lock:
+                    state['memory'] += memory
+                    state['max_memory'] = max(state['max_memory'], state['memory'])
+                time.sleep(0.05)
+                with lock:
+                    state['memory'] -= memory
+                return (result, threads)
+            return (memory, run)
+
+        results = MemoryScheduler(10, 4).run(
+            [job(6, 'a'), job(4, 'b'), job(5, 'c'), job(3, 'd')])
+        self.assertEqual([('a',2),('b',2),('c',2),('d',2)], results)
+        self.assertTrue(state['max_memory'] <= 10)
+        self.assertTrue(state['max_memory'] > 6)
+
+    def test_job_larger_than_budget(self):
+        results = MemoryScheduler(10, 2).run(
+            [(100, lambda threads: threads), (1, lambda threads: 'small')])
+        self.assertEqual([2, 'small'], results)
+
+    def test_error(self):
+        def fail(threads):
+            raise Exception("failed")
+        with self.assertRaises(Exception):
+            MemoryScheduler(10, 2).run([(1, fail), (1, lambda threads: 1)])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -43,6 +43,17 @@ class Tests(unittest.TestCase):
         self.assertEqual(('AAAtttGGG',9),\
             m._nucleotide_alignment(AlignedProteinSequence('name','AC-D'), 'AAATTTGGG', [0,3], True, include_inserts=True))
 
+    def test__nucleotide_alignment_window_of_long_sequence(self):
+        m = MetagenomeOtuFinder()
+        self.assertEqual(('TTTccc---GGG',9),\
+            m._nucleotide_alignment(AlignedProteinSequence('name','AC-D-CDAC'), 'AAATTTCCCGGGAAACCCTTT', [1,4,5], True, include_inserts=True))
+        with self.assertRaises(Exception):
+            m._nucleotide_alignment(AlignedProteinSequence('name','AC-D'), 'AAATTTGG', [0,1], True)
+        with self.assertRaises(Exception):
+            m._nucleotide_alignment(AlignedProteinSequence('name','AC-D'), 'AAATTTGGGC', [0,1], True)
+        with self.assertRaises(Exception):
+            m._nucleotide_alignment(AlignedProteinSequence('name','AC-D'), 'AAA---GGG', [0,1], True)
+
     def test__nucleotide_alignment_aligned_nucleotides(self):
         m = MetagenomeOtuFinder()
         self.assertEqual(('AAA-TG',6),\
@@ -84,6 +95,68 @@ class Tests(unittest.TestCase):
         self.assertEqual(['AAAAA','TATGG','TATGG','TATGG','TATGG'],
                          [o.aligned_sequence for o in obs])
 
+    def test_window_score_profiles(self):
+        m = MetagenomeOtuFinder()
+        seqs = [
+            'gaAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA',
+            'ga-------------TATGGAGGAACACCAGTGGCGAAGGCGACTTTCTGGTCTGtaACTGACGCTGATGTG',
+            'ca---------GAGATATGGAGGAACACCAGTGGCGAAGGCGACTTTCTGGTCTGtaACTGACGCTGA----',
+            'ga-------------TATGGAGGAACACCAGTGGCGAAGGCGACTTTCTGGTCTGtaACTGGGCTGATGTG-',
+            '-g----------AGATATGGA---------------------------------------------------']
+        s2 = [Sequence('seq%i' % i, seq) for i, seq in enumerate(seqs)]
+        profiles = m.window_score_profiles(s2, [5, 60], False)
+        self.assertEqual([5, 60], sorted(profiles.keys()))
+        self.assertEqual(
+            [5, 5, 5, 5, 5, 5, 5, 5, 5, 10, 15, 15, 15, 25, 25, 20, 20, 20, 20, 20],
+            profiles[5][:20].tolist())
+        self.assertEqual(64, len(profiles[5]))
+        self.assertEqual([60]*9, profiles[60].tolist())
+        self.assertEqual(13, m.find_best_window(s2, 5, False))
+
+        profiles = m.window_score_profiles(s2[1:3], [3, 6], True)
+        self.assertEqual([0]*9 + [1, 1, 1, 1, 2], profiles[3][:14].tolist())
+        self.assertEqual([0]*9 + [2, 2, 2, 2, 4], profiles[6][:14].tolist())
+        with self.assertRaises(Exception):
+            m.window_score_profiles(s2, [5], True)
+
+    def test_stream_windowed_sequences(self):
+        m = MetagenomeOtuFinder()
+        # As output by hmmalign, with '.' gaps in insert columns
+        seqs = [
+            'gaAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAaaAAAAAAAAAAAAAAA',
+            'ga-------------TATGGAGGAACACCAGTGGCGAAGGCGACTTTCTGGTCTGtaACTGACGCTGATGTG',
+            'ca---------GAGATATGGAGGAACACCAGTGGCGAAGGCGACTTTCTGGTCTGtaACTGACGCTGA----',
+            'ga-------------TATGGAGGAACACCAGTGGCGAAGGCGACTTTCTGGTCTG..ACTGGGCTGATGTG-',
+            '.g----------AGATATGGA---------------------------------------------------']
+        s2 = [Sequence('seq%i' % i, seq) for i, seq in enumerate(seqs)]
+        unaligned = {}
+        for i, seq in enumerate(seqs):
+            name = 'seq%i' % i
+            unaligned[name] = seq.replace('-','').replace('.','')
+
+        obs = list(m.stream_windowed_sequences(
+            iter(s2),
+            unaligned,
+            5,
+            False,
+            False,
+            14))
+        self.assertEqual(['AAAAA','ATGGA','ATGGA','ATGGA','ATGGA'],
+                         [o.aligned_sequence for o in obs])
+        self.assertEqual(['seq0','seq1','seq2','seq3','seq4'], [o.name for o in obs])
+
+        # Window across the insert columns
+        obs = list(m.stream_windowed_sequences(
+            iter(s2),
+            unaligned,
+            4,
+            True,
+            False,
+            51))
+        self.assertEqual(['AAaaAA','TGtaAC','TGtaAC','TGAC'],
+                         [o.aligned_sequence for o in obs])
+        self.assertEqual([6, 6, 6, 4], [o.aligned_length for o in obs])
+
 
 
 if __name__ == "__main__":
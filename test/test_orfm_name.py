@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import unittest
+import os.path
+import sys
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from singlem.singlem import OrfMUtils, parse_orfm_name
+from singlem.sequence_classes import AlignedProteinSequence
+
+class Tests(unittest.TestCase):
+    def test_parse_orfm_name(self):
+        orfm_name = parse_orfm_name('HWI-ST1243:156:D1K83ACXX:7:1105:19152:28331_12_4_2')
+        self.assertEqual('HWI-ST1243:156:D1K83ACXX:7:1105:19152:28331', orfm_name.read_name)
+        self.assertEqual(12, orfm_name.start)
+        self.assertEqual(4, orfm_name.frame)
+        self.assertEqual(2, orfm_name.orf_number)
+        self.assertTrue(orfm_name.is_reverse_frame())
+        self.assertFalse(parse_orfm_name('read_1_2_3').is_reverse_frame())
+        self.assertEqual('read_1', parse_orfm_name('read_1_2_3_4').read_name)
+        self.assertIsNone(parse_orfm_name('read_1_2'))
+        self.assertIsNone(parse_orfm_name('read'))
+
+    def test_un_orfm_name(self):
+        utils = OrfMUtils()
+        self.assertEqual('read', utils.un_orfm_name('read_1_2_3'))
+        self.assertEqual('read_1_2', utils.un_orfm_name('read_1_2'))
+        self.assertEqual('read_1_x_3', utils.un_orfm_name('read_1_x_3'))
+        self.assertEqual('read_1__3', utils.un_orfm_name('read_1__3'))
+        self.assertEqual('read_', utils.un_orfm_name('read__1_2_3'))
+        self.assertEqual('read_9', utils.un_orfm_name('read_9_10_4_1'))
+        self.assertEqual('read_x', AlignedProteinSequence('read_x_3_1_1', 'MK').un_orfm_name())
+
+    def test_orfm_nucleotides(self):
+        self.assertEqual(
+            'ATGAAA',
+            AlignedProteinSequence('read_3_1_1', 'M-K').orfm_nucleotides('CCATGAAATT'))
+        self.assertEqual(
+            'TTTCAT',
+            AlignedProteinSequence('read_3_4_1', 'KM').orfm_nucleotides('CCATGAAATT'))
+        with self.assertRaises(Exception):
+            AlignedProteinSequence('read', 'KM').orfm_nucleotides('CCATGAAATT')
+
+if __name__ == "__main__":
+    unittest.main()
@@ -36,7 +36,8 @@ path_to_data = os.path.join(os.path.dirname(os.path.realpath(__file__)),'data')
 
 sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
 from singlem.pipe import SearchPipe
-from singlem.sequence_classes import SeqReader
+from singlem.sequence_classes import SeqReader, UnalignedAlignedNucleotideSequence, AlignedProteinSequence
+from singlem.singlem_package import SingleMPackage
 
 class Tests(unittest.TestCase):
     headers = str.split('gene sample sequence num_hits coverage taxonomy')
@@ -474,6 +475,84 @@ ATTAACAGTAGCTGAAGTTACTGACTTACGTTCACAATTACGTGAAGCTGGTGTTGAGTATAAAGTATACAAAAACACTA
                              [(name, row[fields.index('gene')], row[fields.index('taxonomy')]) for row in data for name in row[fields.index('read_names')]]
                             )
 
+    def test_seqs_to_counts_and_taxonomy_known_otu_taxonomies(self):
+        class KnownTaxonomy:
+            def __init__(self, taxonomy):
+                self.taxonomy = taxonomy
+        sequences = [
+            UnalignedAlignedNucleotideSequence('read1', 'read1_1_1_1', 'AAA', 'AAAT', 3),
+            UnalignedAlignedNucleotideSequence('read2', 'read2_1_1_1', 'CCC', 'CCCT', 3),
+            UnalignedAlignedNucleotideSequence('read3', 'read3_1_1_1', 'AAA', 'AAAG', 3)]
+        known = {
+            'AAA': KnownTaxonomy('Root; d__Archaea'),
+            'CCC': KnownTaxonomy('Root; d__Bacteria')}
+        pipe = SearchPipe()
+        pipe._collect_read_names = True
+        aggregator, taxonomies = pipe._seqs_to_counts_and_taxonomy(
+            sequences, 'no_assign_taxonomy', known, None, None)
+        # Each OTU is given its own known taxonomy
+        self.assertEqual(
+            [('AAA', 2, 'Root; d__Archaea'), ('CCC', 1, 'Root; d__Bacteria')],
+            list(zip(aggregator.sequences, aggregator.counts(), taxonomies)))
+
+    def test_search_in_chunks_stops_after_failed_search(self):
+        commands = []
+        def failing_command(cmd):
+            commands.append(cmd)
+            raise Exception("search failed")
+        with tempdir.TempDir() as d:
+            sequences = os.path.join(d, 'reads.fa')
+            with open(sequences, 'w') as f:
+                for i in range(40):
+                    f.write('>read%i\nATGCATGCATGC\n' % i)
+            os.mkdir(os.path.join(d, 'working'))
+            pipe = SearchPipe()
+            pipe._working_directory = os.path.join(d, 'working')
+            pipe._search_chunk_size = 2
+            pipe._num_threads = 2
+            pipe._early_stopping = False
+            pipe._shared_memory_budget = None
+            pipe._graftm_search_command = lambda *args: 'graftM graft'
+            pipe._run_command = failing_command
+            with self.assertRaises(Exception):
+                pipe._search_in_chunks(
+                    [(['search.hmm'], os.path.join(d, 'search'), True)],
+                    [sequences], None)
+        # No more chunks are written than can be searched at once, plus one
+        self.assertLessEqual(len(commands), 3)
+
+    def test_run_twice_in_one_process_with_shm_budget(self):
+        class NoHits:
+            def samples_with_hits(self):
+                return []
+        pipe = SearchPipe()
+        pipe._search = lambda *args: NoHits()
+        with tempdir.TempDir() as d:
+            sequences = os.path.join(d, 'reads.fa')
+            with open(sequences, 'w') as f:
+                f.write('>read\nATGC\n')
+            for _ in range(2):
+                self.assertIsNone(pipe.run_to_otu_table(
+                    sequences=[sequences],
+                    threads=1,
+                    known_otu_tables=None,
+                    assignment_method='pplacer',
+                    output_jplace=None,
+                    evalue=None,
+                    min_orf_length=SearchPipe.DEFAULT_MIN_ORF_LENGTH,
+                    restrict_read_length=None,
+                    filter_minimum_protein=SearchPipe.DEFAULT_FILTER_MINIMUM_PROTEIN,
+                    filter_minimum_nucleotide=SearchPipe.DEFAULT_FILTER_MINIMUM_NUCLEOTIDE,
+                    include_inserts=False,
+                    singlem_packages=[os.path.join(path_to_data, '4.11.22seqs.gpkg.spkg')],
+                    assign_taxonomy=True,
+                    known_sequence_taxonomy=None,
+                    diamond_prefilter=False,
+                    shm_budget=1,
+                    working_directory=None,
+                    working_directory_tmpdir=False,
+                    force=False))
+
     def test__align_proteins_to_hmm(self):
         with open(path_to_data +
                   '/4.12.22seqs.spkg/4.12.22seqs/singlem_package_creatorq4droc.fasta') as f:
@@ -493,6 +572,45 @@ ATTAACAGTAGCTGAAGTTACTGACTTACGTTCACAATTACGTGAAGCTGGTGTTGAGTATAAAGTATACAAAAACACTA
             '-------VAKKVDSVVKLQIPAGKANPAPPVGPALGQAGINIMGFCKEFNAQT-QDQA-----GMIIPVEITVYEDRSFTFITKTPPAAVLLKKAAGI-----E--------TASGEPNRNKVA---------TLNRDKVKEIAELKMPDLNAADVEAAMRMVEGTARSMGIVIED--------',
             a2.seq)
 
+    def test_align_and_extract_reads_streams_alignment(self):
+        events = []
+        def stream_aligned_proteins(protein_sequences, hmm_file, keep_insert_gaps):
+            for name, seq in protein_sequences:
+                events.append(('aligned', name))
+                yield AlignedProteinSequence(name, seq)
+        def extract_reads(sample_name, singlem_package, protein_alignment,
+                          nucleotide_sequence_fasta_file, include_inserts,
+                          read_direction, known_taxonomy):
+            events.append(('extract', sample_name,
+                           [s.name for s in protein_alignment]))
+            return sample_name
+        singlem_package = SingleMPackage.acquire(
+            os.path.join(path_to_data, '4.11.22seqs.gpkg.spkg'))
+        with tempdir.TempDir() as d:
+            indexed_tasks = []
+            for i, sample_name in [(1, 'sample1'), (3, 'sample2'), (4, 'sample3')]:
+                path = os.path.join(d, '%s.faa' % sample_name)
+                with open(path, 'w') as f:
+                    if sample_name != 'sample2':
+                        f.write('>read1\nMAKK\n>read2\nMAKR\n')
+                indexed_tasks.append((i, (
+                    sample_name, singlem_package, path, path, False, 'forward')))
+            pipe = SearchPipe()
+            pipe._stream_aligned_proteins = stream_aligned_proteins
+            pipe._extract_reads = extract_reads
+            self.assertEqual(
+                [(1, 'sample1'), (4, 'sample3'), (3, 'sample2')],
+                pipe._align_and_extract_reads(indexed_tasks, {}))
+        # Each task is extracted as soon as its part of the alignment is read,
+        # with the task index removed from the names.
+        self.assertEqual([
+            ('aligned', '1_read1'), ('aligned', '1_read2'), ('aligned', '4_read1'),
+            ('extract', 'sample1', ['read1', 'read2']),
+            ('aligned', '4_read2'),
+            ('extract', 'sample3', ['read1', 'read2']),
+            ('extract', 'sample2', [])],
+            events)
+
     def test_protein_package_non60_length(self):
         expected = [
             "\t".join(self.headers),
@@ -650,6 +768,40 @@ TTCAGCTGCACGACGTACCATAGTGTTTTTGTATACTTTATACTCAACACCAGCTTCACGTAATTGTGAACGTAAGTCAG
                     extern.run(cmd).replace(os.path.basename(n.name).replace('.fa',''),''))
 
 
+    def test_paired_reads_one_read_each_pplacer(self):
+        # Reads should be merged, and the placements of the forward and
+        # reverse reads pooled
+        expected = [
+            "\t".join(self.headers_with_extras),
+            '4.11.22seqs		TTACGTTCACAATTACGTGAAGCTGGTGTTGAGTATAAAGTATACAAAAACACTATGGTA	2	4.88	Root; d__Bacteria; p__Firmicutes	HWI-ST1243:156:D1K83ACXX:7:1106:18671:79482 seq2	60 60	False',
+            '']
+        inseqs = '''>HWI-ST1243:156:D1K83ACXX:7:1106:18671:79482 1:N:0:TAAGGCGACTAAGCCT
+ATTAACAGTAGCTGAAGTTACTGACTTACGTTCACAATTACGTGAAGCTGGTGTTGAGTATAAAGTATACAAAAACACTATGGTACGTCGTGCAGCTGAA
+>seq2
+AAAAAAAAAAAAAAAAA
+'''
+        inseqs_reverse = '''>HWI-ST1243:156:D1K83ACXX:7:1106:18671:79482 1:N:0:TAAGGCGACTAAGCCT
+AAAAAAAAAAAAAAAAA
+>seq2
+TTCAGCTGCACGACGTACCATAGTGTTTTTGTATACTTTATACTCAACACCAGCTTCACGTAATTGTGAACGTAAGTCAGTAACTTCAGCTACTGTTAAT
+''' # reverse complement of the forward, so should collapse.
+        with tempfile.NamedTemporaryFile(mode='w',suffix='.fa') as n:
+            n.write(inseqs)
+            n.flush()
+            with tempfile.NamedTemporaryFile(mode='w',suffix='.fa') as n2:
+                n2.write(inseqs_reverse)
+                n2.flush()
+
+                cmd = "{} pipe --sequences {} --otu_table /dev/stdout --singlem_packages {} --reverse {} --output_extras --assignment_method pplacer".format(
+                    path_to_script,
+                    n.name,
+                    os.path.join(path_to_data,'4.11.22seqs.gpkg.spkg'),
+                    n2.name)
+                self.assertEqualOtuTable(
+                    list([line.split("\t") for line in expected]),
+                    extern.run(cmd).replace(os.path.basename(n.name).replace('.fa',''),''))
+
+
     def test_paired_reads_one_read_each_diamond(self):
         # Reads should be merged
         expected = [
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import unittest
+import os.path
+import sys
+import json
+import socket
+import tempdir
+import threading
+import http.client
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from singlem.pipe_server import PipeServer, InvalidJobException
+from singlem.pipe import SearchPipe
+
+path_to_data = os.path.join(os.path.dirname(os.path.realpath(__file__)),'data')
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path):
+        http.client.HTTPConnection.__init__(self, 'localhost')
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+class Tests(unittest.TestCase):
+    package = os.path.join(path_to_data, '4.11.22seqs.gpkg.spkg')
+
+    def test_job_kwargs(self):
+        server = PipeServer([self.package], num_threads=2)
+        kwargs = server.job_kwargs({'sequences': ['a.fa'], 'threads': 4, 'evalue': '1e-5'})
+        self.assertEqual(['a.fa'], kwargs['sequences'])
+        self.assertEqual(2, kwargs['threads'])
+        self.assertEqual('1e-5', kwargs['evalue'])
+        self.assertEqual(None, kwargs['working_directory'])
+        self.assertEqual([self.package], kwargs['singlem_packages'])
+        with self.assertRaises(InvalidJobException):
+            server.job_kwargs({'threads': 1})
+        with self.assertRaises(InvalidJobException):
+            server.job_kwargs({'sequences': ['a.fa'], 'working_directory': 'wd'})
+
+    def test_job_kwargs_allowed_options(self):
+        server = PipeServer([self.package], num_threads=2)
+        kwargs = server.job_kwargs({
+            'sequences': ['a.fa'], 'reverse': ['b.fa'], 'assignment_method': 'diamond',
+            'output_extras': True})
+        self.assertEqual(['b.fa'], kwargs['reverse_read_files'])
+        self.assertEqual('diamond', kwargs['assignment_method'])
+        self.assertTrue(kwargs['collect_read_names'])
+        self.assertFalse('output_extras' in kwargs)
+        # Paths to write to are refused, as are other unknown arguments
+        for key in ['output_jplace', 'timing_report', 'taxonomy_cache',
+                    'reverse_read_files', 'hmm_database', 'not_an_option']:
+            with self.assertRaises(InvalidJobException):
+                server.job_kwargs({'sequences': ['a.fa'], key: 'out.txt'})
+
+    def test_unix_socket(self):
+        server = PipeServer([self.package], num_threads=1)
+        with tempdir.TempDir() as d:
+            socket_path = os.path.join(d, 'singlem.sock')
+            http_server = server.create_http_server(socket_path=socket_path)
+            thread = threading.Thread(target=http_server.serve_forever)
+            thread.start()
+            try:
+                connection = UnixHTTPConnection(socket_path)
+                connection.request('GET', '/status')
+                response = connection.getresponse()
+                self.assertEqual(200, response.status)
+                status = json.loads(response.read().decode())
+                self.assertEqual([self.package], status['singlem_packages'])
+                self.assertEqual(0, status['threads_in_use'])
+
+                connection = UnixHTTPConnection(socket_path)
+                connection.request('POST', '/pipe', body=json.dumps({'threads': 1}))
+                response = connection.getresponse()
+                self.assertEqual(400, response.status)
+            finally:
+                http_server.shutdown()
+                thread.join()
+                server.shutdown(http_server, socket_path)
+            self.assertFalse(os.path.exists(socket_path))
+
+    def test_two_jobs_with_one_worker(self):
+        class NoHits:
+            def samples_with_hits(self):
+                return []
+        original_search = SearchPipe._search
+        # Replaced before the worker is forked, so that it is inherited
+        SearchPipe._search = lambda self, *args: NoHits()
+        try:
+            server = PipeServer([self.package], num_threads=1)
+            with tempdir.TempDir() as d:
+                sequences = os.path.join(d, 'reads.fa')
+                with open(sequences, 'w') as f:
+                    f.write('>read\nATGC\n')
+                socket_path = os.path.join(d, 'singlem.sock')
+                http_server = server.create_http_server(socket_path=socket_path)
+                thread = threading.Thread(target=http_server.serve_forever)
+                thread.start()
+                try:
+                    # Each job removes its temporary working directory, which
+                    # must not be used by the next job run by the worker.
+                    for _ in range(2):
+                        connection = UnixHTTPConnection(socket_path)
+                        connection.request('POST', '/pipe', body=json.dumps({
+                            'sequences': [sequences], 'working_directory_tmpdir': True}))
+                        response = connection.getresponse()
+                        self.assertEqual(200, response.status)
+                        self.assertEqual(
+                            'gene\tsample\tsequence\tnum_hits\tcoverage\ttaxonomy\n',
+                            response.read().decode())
+                finally:
+                    http_server.shutdown()
+                    thread.join()
+                    server.shutdown(http_server, socket_path)
+        finally:
+            SearchPipe._search = original_search
+
+if __name__ == "__main__":
+    unittest.main()
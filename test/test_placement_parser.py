@@ -32,13 +32,14 @@ import extern
 import sys
 import json
 import re
+import tracemalloc
 
 path_to_script = os.path.join(os.path.dirname(os.path.realpath(__file__)),'..','bin','singlem')
 path_to_data = os.path.join(os.path.dirname(os.path.realpath(__file__)),'data')
 
 sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
-from singlem.placement_parser import PlacementParser
-from singlem.taxonomy_bihash import TaxonomyBihash
+from singlem.placement_parser import PlacementParser, _JplaceReader
+from singlem.taxonomy_tree import TaxonomyTree
 
 class Tests(unittest.TestCase):
     maxDiff = None
@@ -138,8 +139,8 @@ c__Bacilli,p__Firmicutes,class,c__Bacilli,Root,d__Bacteria,p__Firmicutes,c__Baci
 c__Clostridia,p__Firmicutes,class,c__Clostridia,Root,d__Bacteria,p__Firmicutes,c__Clostridia,,,,
 o__Clostridiales,c__Clostridia,order,o__Clostridiales,Root,d__Bacteria,p__Firmicutes,c__Clostridia,o__Clostridiales,,,
 """
-        bihash = TaxonomyBihash.parse_taxtastic_taxonomy(StringIO(taxonomy))
-        parser = PlacementParser(placement, bihash, 0.5)
+        tree = TaxonomyTree.parse_taxtastic_taxonomy(StringIO(taxonomy))
+        parser = PlacementParser(placement, tree, 0.5)
         self.assertEqual(
             ["Root",'d__Bacteria','p__Firmicutes'],
             parser.otu_placement([
@@ -147,7 +148,7 @@ o__Clostridiales,c__Clostridia,order,o__Clostridiales,Root,d__Bacteria,p__Firmic
                 'HWI-ST1243:156:D1K83ACXX:7:1106:18671:79482_2_2_1',
                 ]))
         # Higher threshold
-        parser = PlacementParser(placement, bihash, 0.95)
+        parser = PlacementParser(placement, tree, 0.95)
         self.assertEqual(
             ["Root",'d__Bacteria'],
             parser.otu_placement([
@@ -159,7 +160,7 @@ o__Clostridiales,c__Clostridia,order,o__Clostridiales,Root,d__Bacteria,p__Firmic
         placement['placements'][0]['p'][1][0] = 'o__Clostridiales'
         placement['placements'][1]['p'][0][0] = 'c__Bacilli'
         placement['placements'][1]['p'][1][0] = 'c__Bacilli'
-        parser = PlacementParser(placement, bihash, 0.5)
+        parser = PlacementParser(placement, tree, 0.5)
         self.assertEqual(
             ["Root",'d__Bacteria','p__Firmicutes'],
             parser.otu_placement([
@@ -172,5 +173,119 @@ o__Clostridiales,c__Clostridia,order,o__Clostridiales,Root,d__Bacteria,p__Firmic
                 'HWI-ST1243:156:D1K83ACXX:7:1105:19152:28331_1_4_1',
                 ]))
 
+        # Placements of reverse reads are merged into those of forward reads
+        forward = dict(placement)
+        forward['placements'] = placement['placements'][:1]
+        reverse = dict(placement)
+        reverse['placements'] = placement['placements'][1:]
+        parser = PlacementParser(forward, tree, 0.5)
+        parser.merge_reverse(PlacementParser(reverse, tree, 0.5))
+        self.assertEqual(
+            ["Root",'d__Bacteria','p__Firmicutes','c__Bacilli'],
+            parser.otu_placement([
+                'HWI-ST1243:156:D1K83ACXX:7:1105:19152:28331_1_4_1',
+                ]))
+        self.assertEqual(
+            ["Root",'d__Bacteria','p__Firmicutes'],
+            parser.otu_placement([
+                'HWI-ST1243:156:D1K83ACXX:7:1105:19152:28331_1_4_1',
+                'HWI-ST1243:156:D1K83ACXX:7:1106:18671:79482_2_2_1',
+                ]))
+
+        # Streamed from a file, with 'fields' after 'placements' and a buffer
+        # too small to hold any one placement.
+        jplace = '{"placements": %s, "fields": %s, "version": 3}' % (
+            json.dumps(placement['placements']), json.dumps(placement['fields']))
+        original_chunk_size = _JplaceReader._CHUNK_SIZE
+        _JplaceReader._CHUNK_SIZE = 7
+        try:
+            parser = PlacementParser.parse_jplace(StringIO(jplace), tree, 0.5)
+        finally:
+            _JplaceReader._CHUNK_SIZE = original_chunk_size
+        self.assertEqual(
+            ["Root",'d__Bacteria','p__Firmicutes','c__Bacilli'],
+            parser.otu_placement([
+                'HWI-ST1243:156:D1K83ACXX:7:1105:19152:28331_1_4_1',
+                ]))
+        self.assertEqual(
+            ["Root",'d__Bacteria','p__Firmicutes'],
+            parser.otu_placement([
+                'HWI-ST1243:156:D1K83ACXX:7:1105:19152:28331_1_4_1',
+                'HWI-ST1243:156:D1K83ACXX:7:1106:18671:79482_2_2_1',
+                ]))
+
+    def test_parse_jplace_decodes_placements_once(self):
+        fields = ["classification", "like_weight_ratio"]
+        placements = [
+            {"p": [["d__Bacteria", 1.0]], "nm": [["read%i_1_1_1" % i, 1]]}
+            for i in range(20)]
+        # The tree and metadata contain brackets, braces and escaped quotes
+        # within strings, which must not be mistaken for structure.
+        jplace = json.dumps({
+            "tree": "((a:0.1{0},b:0.2{1}){2}];",
+            "placements": placements,
+            "metadata": {"invocation": ["pplacer", '"[{\\"]]}']},
+            "fields": fields,
+            "version": 3})
+        decoded = []
+        original_placements = _JplaceReader.placements
+        def counting_placements(reader):
+            for placement in original_placements(reader):
+                decoded.append(placement)
+                yield placement
+        original_chunk_size = _JplaceReader._CHUNK_SIZE
+        _JplaceReader._CHUNK_SIZE = 3
+        _JplaceReader.placements = counting_placements
+        try:
+            parser = PlacementParser.parse_jplace(StringIO(jplace), None, 0.5)
+        finally:
+            _JplaceReader._CHUNK_SIZE = original_chunk_size
+            _JplaceReader.placements = original_placements
+        self.assertEqual(placements, decoded)
+        self.assertEqual(
+            dict(("read%i_1_1_1" % i, [("d__Bacteria", 1.0)]) for i in range(20)),
+            parser._orf_name_to_placement)
+
+    def test_jplace_reader_number_split_across_chunks(self):
+        original_chunk_size = _JplaceReader._CHUNK_SIZE
+        _JplaceReader._CHUNK_SIZE = 1
+        try:
+            reader = _JplaceReader(StringIO('{"a": 12.5e-1, "b": [1]}'))
+            entries = [(key, reader.value()) for key in reader.keys()]
+        finally:
+            _JplaceReader._CHUNK_SIZE = original_chunk_size
+        self.assertEqual([('a', 1.25), ('b', [1])], entries)
+
+    def test_parse_jplace_peak_memory(self):
+        fields = ["classification", "distal_length", "edge_num",
+                  "like_weight_ratio", "likelihood", "pendant_length"]
+        placements = json.dumps([
+            {"p": [["p__Firmicutes", 0.289785332337, 24, 0.825736915661, -1119.74125853, 0.102097663521],
+                   ["d__Bacteria", 8.90258789062e-06, 25, 0.0808307526527, -1122.06517725, 0.112723096201]],
+             "nm": [["read%i_1_1_1" % i, 1]]}
+            for i in range(5000)])
+
+        def peak_memory(jplace):
+            tracemalloc.start()
+            try:
+                parser = PlacementParser.parse_jplace(StringIO(jplace), None, 0.5)
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            self.assertEqual(5000, len(parser._orf_name_to_placement))
+            return peak
+
+        original_chunk_size = _JplaceReader._CHUNK_SIZE
+        _JplaceReader._CHUNK_SIZE = 4096
+        try:
+            fields_first = peak_memory(
+                '{"fields": %s, "placements": %s, "version": 3}' % (json.dumps(fields), placements))
+            fields_last = peak_memory(
+                '{"placements": %s, "fields": %s, "version": 3}' % (placements, json.dumps(fields)))
+        finally:
+            _JplaceReader._CHUNK_SIZE = original_chunk_size
+        # Placements are not kept in full while looking for 'fields'
+        self.assertLess(fields_last, fields_first * 1.2)
+
 if __name__ == "__main__":
     unittest.main()
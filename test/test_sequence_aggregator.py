@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import unittest
+import os.path
+import sys
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from singlem.sequence_aggregator import SequenceAggregator
+from singlem.sequence_classes import UnalignedAlignedNucleotideSequence
+
+class Tests(unittest.TestCase):
+    def sequences(self):
+        return [
+            UnalignedAlignedNucleotideSequence('r1', 'r1_1_1_1', 'AAA', 'A'*10, 6),
+            UnalignedAlignedNucleotideSequence('r2', 'r2_1_1_1', 'CCC', 'C'*20, 6),
+            UnalignedAlignedNucleotideSequence('r3', 'r3_1_1_1', 'AAA', 'A'*12, 3)]
+
+    def test_counts_and_coverages(self):
+        aggregator = SequenceAggregator(collect_names=False)
+        for s in self.sequences():
+            aggregator.add(s)
+        self.assertEqual(['AAA', 'CCC'], aggregator.sequences)
+        self.assertEqual([2, 1], list(aggregator.counts()))
+        expected = [s.coverage_increment() for s in self.sequences()]
+        self.assertEqual(
+            [expected[0] + expected[2], expected[1]], list(aggregator.coverages()))
+        self.assertEqual(None, aggregator.names)
+        self.assertEqual(None, aggregator.taxonomies)
+
+    def test_collect_per_read_details(self):
+        aggregator = SequenceAggregator(
+            collect_names=True, collect_taxonomies=True, collect_orf_names=True)
+        for s, tax in zip(self.sequences(), ['Root; a', 'Root; b', 'Root; c']):
+            aggregator.add(s, tax, s.orf_name)
+        self.assertEqual([['r1', 'r3'], ['r2']], aggregator.names)
+        self.assertEqual([[6, 3], [6]], aggregator.aligned_lengths)
+        self.assertEqual([['Root; a', 'Root; c'], ['Root; b']], aggregator.taxonomies)
+        self.assertEqual([['r1_1_1_1', 'r3_1_1_1'], ['r2_1_1_1']], aggregator.orf_names)
+
+    def test_empty(self):
+        aggregator = SequenceAggregator()
+        self.assertEqual(0, len(aggregator))
+        self.assertEqual([], list(aggregator.counts()))
+        self.assertEqual([], list(aggregator.coverages()))
+
+if __name__ == "__main__":
+    unittest.main()
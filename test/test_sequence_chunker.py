@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import unittest
+import os.path
+import sys
+import gzip
+import tempdir
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from singlem.sequence_chunker import SequenceChunker
+
+class Tests(unittest.TestCase):
+    def test_small_file_not_split(self):
+        with tempdir.TempDir() as d:
+            path = os.path.join(d, 'sample.fna')
+            with open(path, 'w') as f:
+                f.write('>1\nATG\n>2\nAAA\n')
+            chunks = list(SequenceChunker(2).chunks(path, None, os.path.join(d, 'chunks')))
+            self.assertEqual([(path, None)], chunks)
+            self.assertEqual([], os.listdir(os.path.join(d, 'chunks')))
+
+    def test_split_gzip_fastq(self):
+        with tempdir.TempDir() as d:
+            path = os.path.join(d, 'sample.fastq.gz')
+            with gzip.open(path, 'wt') as f:
+                for i in range(5):
+                    f.write('@r{} comment\nACGT\n+\nIIII\n'.format(i))
+            chunks = []
+            for (forward, reverse) in SequenceChunker(2).chunks(
+                    path, None, os.path.join(d, 'chunks')):
+                self.assertEqual(None, reverse)
+                with open(forward) as f:
+                    chunks.append((os.path.relpath(forward, d), f.read()))
+            self.assertEqual([
+                ('chunks/0/sample.fq', '@r0\nACGT\n+\nIIII\n@r1\nACGT\n+\nIIII\n'),
+                ('chunks/1/sample.fq', '@r2\nACGT\n+\nIIII\n@r3\nACGT\n+\nIIII\n'),
+                ('chunks/2/sample.fq', '@r4\nACGT\n+\nIIII\n')],
+                chunks)
+
+    def test_progress(self):
+        with tempdir.TempDir() as d:
+            path = os.path.join(d, 'sample.fna')
+            with open(path, 'w') as f:
+                for i in range(5):
+                    f.write('>{}\nACGT\n'.format(i))
+            chunker = SequenceChunker(2)
+            progress = []
+            for _ in chunker.chunks(path, None, os.path.join(d, 'chunks')):
+                progress.append(chunker.sequences_read)
+            self.assertEqual([2, 4, 5], progress)
+            # The whole file has been read by the end
+            self.assertEqual(1.0, chunker.fraction_read)
+
+    def test_split_pairs(self):
+        with tempdir.TempDir() as d:
+            forward = os.path.join(d, 'sample_1.fa')
+            reverse = os.path.join(d, 'sample_2.fa')
+            with open(forward, 'w') as f:
+                f.write('>1\nATG\n>2\nAAA\n>3\nCCC\n')
+            with open(reverse, 'w') as f:
+                f.write('>1\nGGG\n>2\nTTT\n>3\nCAT\n')
+            chunks = []
+            for (forward_chunk, reverse_chunk) in SequenceChunker(2).chunks(
+                    forward, reverse, os.path.join(d, 'chunks')):
+                with open(forward_chunk) as f1, open(reverse_chunk) as f2:
+                    chunks.append((os.path.relpath(forward_chunk, d), f1.read(),
+                                   os.path.relpath(reverse_chunk, d), f2.read()))
+            self.assertEqual([
+                ('chunks/0/sample_1.fa', '>1\nATG\n>2\nAAA\n',
+                 'chunks/0/reverse/sample_2.fa', '>1\nGGG\n>2\nTTT\n'),
+                ('chunks/1/sample_1.fa', '>3\nCCC\n',
+                 'chunks/1/reverse/sample_2.fa', '>3\nCAT\n')],
+                chunks)
+
+    def test_unequal_pairs(self):
+        with tempdir.TempDir() as d:
+            forward = os.path.join(d, 'sample_1.fa')
+            reverse = os.path.join(d, 'sample_2.fa')
+            with open(forward, 'w') as f:
+                f.write('>1\nATG\n>2\nAAA\n>3\nCCC\n')
+            with open(reverse, 'w') as f:
+                f.write('>1\nGGG\n')
+            with self.assertRaises(Exception):
+                list(SequenceChunker(2).chunks(forward, reverse, os.path.join(d, 'chunks')))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -22,7 +22,7 @@
 #=======================================================================
 
 
-import sys, os, unittest, tempfile
+import sys, os, unittest, tempfile, gzip
 sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
 
 from singlem.sequence_extractor import SequenceExtractor
@@ -50,5 +50,20 @@ AAAAA
             self.assertEqual('2', seqs[1].name)
             self.assertEqual('AAAAA', seqs[1].seq)
 
+    def test_extract_and_read_gzip(self):
+        with tempfile.NamedTemporaryFile(suffix='.fa.gz') as f:
+            with gzip.open(f.name, 'wt') as g:
+                g.write('>1\nATG\n>2 comment\nAAAAA\n')
+            seqs = SequenceExtractor().extract_and_read(['2'], f.name)
+            self.assertEqual(1, len(seqs))
+            self.assertEqual('2', seqs[0].name)
+            self.assertEqual('AAAAA', seqs[0].seq)
+
+    def test_extract_from_sequences(self):
+        seqs = SequenceExtractor().extract_from_sequences(
+            ['3','1'], {'1': 'ATG', '2': 'AAAAA', '3': 'CC'})
+        self.assertEqual(['1','3'], [s.name for s in seqs])
+        self.assertEqual(['ATG','CC'], [s.seq for s in seqs])
+
 if __name__ == "__main__":
     unittest.main()
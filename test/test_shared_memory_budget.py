@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import unittest
+import os.path
+import sys
+import tempdir
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from singlem.shared_memory_budget import SharedMemoryBudget
+
+class Tests(unittest.TestCase):
+    def write_file(self, path, num_bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write('A'*num_bytes)
+
+    def test_within_budget(self):
+        with tempdir.TempDir() as shm:
+            with tempdir.TempDir() as disk:
+                budget = SharedMemoryBudget(shm, disk, 100)
+                self.write_file(os.path.join(shm, 'search', 'hits.fa'), 50)
+                budget.stage_completed('search', [os.path.join(shm, 'search')])
+                self.assertFalse(os.path.islink(os.path.join(shm, 'search')))
+                self.assertEqual([], os.listdir(disk))
+
+    def test_spill_largest(self):
+        with tempdir.TempDir() as shm:
+            with tempdir.TempDir() as disk:
+                budget = SharedMemoryBudget(shm, disk, 100)
+                self.write_file(os.path.join(shm, 'small.txt'), 10)
+                self.write_file(os.path.join(shm, 'search', 'hits.fa'), 80)
+                budget.stage_completed('search', [os.path.join(shm, 'search')])
+                self.write_file(os.path.join(shm, 'align', 'aln.fa'), 40)
+                budget.stage_completed('align', [os.path.join(shm, 'align')])
+
+                # Only the largest directory needs to be moved
+                self.assertTrue(os.path.islink(os.path.join(shm, 'search')))
+                self.assertFalse(os.path.islink(os.path.join(shm, 'align')))
+                self.assertEqual(['0_search'], os.listdir(disk))
+                with open(os.path.join(shm, 'search', 'hits.fa')) as f:
+                    self.assertEqual('A'*80, f.read())
+
+    def test_release(self):
+        with tempdir.TempDir() as shm:
+            with tempdir.TempDir() as disk:
+                budget = SharedMemoryBudget(shm, disk, 10)
+                batch = os.path.join(shm, 'batch0')
+                self.write_file(os.path.join(batch, 'search', 'hits.fa'), 80)
+                budget.stage_completed('search', [os.path.join(batch, 'search')])
+                self.assertEqual(['0_search'], os.listdir(disk))
+                os.remove(os.path.join(batch, 'search'))
+                os.rmdir(batch)
+                budget.release(batch)
+                self.assertEqual([], os.listdir(disk))
+
+    def test_make_directory(self):
+        with tempdir.TempDir() as shm:
+            with tempdir.TempDir() as disk:
+                budget = SharedMemoryBudget(shm, disk, 100)
+                self.write_file(os.path.join(shm, 'small.txt'), 10)
+                fits = os.path.join(shm, 'fits')
+                budget.make_directory(fits, 90)
+                self.assertFalse(os.path.islink(fits))
+                self.assertEqual([], os.listdir(disk))
+
+                chunks = os.path.join(shm, 'chunks')
+                budget.make_directory(chunks, 91)
+                self.assertTrue(os.path.islink(chunks))
+                self.assertEqual(['0_chunks'], os.listdir(disk))
+                self.write_file(os.path.join(chunks, '0', 'reads.fa'), 80)
+                self.assertEqual(['0'], os.listdir(os.path.join(disk, '0_chunks')))
+
+                budget.remove_directory(chunks)
+                self.assertFalse(os.path.lexists(chunks))
+                self.assertEqual([], os.listdir(disk))
+                budget.remove_directory(fits)
+                self.assertEqual(['small.txt'], os.listdir(shm))
+
+if __name__ == "__main__":
+    unittest.main()
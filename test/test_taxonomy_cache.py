@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import unittest
+import os.path
+import sys
+import tempdir
+import time
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from singlem.singlem import HmmDatabase
+from singlem.taxonomy_cache import TaxonomyCache
+
+path_to_data = os.path.join(os.path.dirname(os.path.realpath(__file__)),'data')
+
+class Tests(unittest.TestCase):
+    def packages(self):
+        return list(HmmDatabase([
+            os.path.join(path_to_data, '4.11.22seqs.gpkg.spkg'),
+            os.path.join(path_to_data, '4.12.22seqs.spkg')]))
+
+    def test_store_and_lookup(self):
+        pkg1, pkg2 = self.packages()
+        with tempdir.TempDir() as d:
+            path = os.path.join(d, 'cache.sqlite3')
+            cache = TaxonomyCache(path)
+            self.assertEqual({}, cache.lookup(pkg1, 'pplacer', ['AAA']))
+            cache.store(pkg1, 'pplacer', {'AAA': 'Root; d__Bacteria', 'CCC': 'Root'})
+            self.assertEqual({'AAA': 'Root; d__Bacteria'},
+                             cache.lookup(pkg1, 'pplacer', ['AAA', 'GGG']))
+            # Keyed on package and assignment method
+            self.assertEqual({}, cache.lookup(pkg2, 'pplacer', ['AAA']))
+            self.assertEqual({}, cache.lookup(pkg1, 'diamond', ['AAA']))
+            cache.close()
+
+            # Persists between runs
+            cache = TaxonomyCache(path)
+            self.assertEqual({'AAA': 'Root; d__Bacteria', 'CCC': 'Root'},
+                             cache.lookup(pkg1, 'pplacer', ['AAA', 'CCC']))
+            cache.close()
+
+    def test_evict_least_recently_used(self):
+        pkg = self.packages()[0]
+        with tempdir.TempDir() as d:
+            cache = TaxonomyCache(os.path.join(d, 'cache.sqlite3'), 2)
+            for seq in ['AAA', 'CCC', 'GGG', 'AAA']:
+                cache.store(pkg, 'pplacer', {seq: 'Root'})
+                time.sleep(0.01)
+            cache.evict()
+            self.assertEqual({'AAA': 'Root', 'GGG': 'Root'},
+                             cache.lookup(pkg, 'pplacer', ['AAA', 'CCC', 'GGG']))
+            cache.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import unittest
+import os.path
+import tempfile
+import sys
+from io import StringIO
+
+path_to_data = os.path.join(os.path.dirname(os.path.realpath(__file__)),'data')
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from singlem.singlem_package import SingleMPackage
+from singlem.taxonomy_tree import TaxonomyTree
+
+class Tests(unittest.TestCase):
+    maxDiff = None
+
+    taxonomy = """tax_id,parent_id,rank,tax_name,root,kingdom,phylum,class,order,family,genus,species
+Root,Root,root,Root,Root,,,,,,,
+d__Bacteria,Root,kingdom,d__Bacteria,Root,d__Bacteria,,,,,,
+o__Actinomycetales,c__Actinobacteria,order,o__Actinomycetales,Root,d__Bacteria,p__Actinobacteria,c__Actinobacteria,o__Actinomycetales,,,
+p__Actinobacteria,d__Bacteria,phylum,p__Actinobacteria,Root,d__Bacteria,p__Actinobacteria,,,,,
+c__Actinobacteria,p__Actinobacteria,class,c__Actinobacteria,Root,d__Bacteria,p__Actinobacteria,c__Actinobacteria,,,,
+o__Coriobacteriales,c__Actinobacteria,order,o__Coriobacteriales,Root,d__Bacteria,p__Actinobacteria,c__Actinobacteria,o__Coriobacteriales,,,
+p__Firmicutes,d__Bacteria,phylum,p__Firmicutes,Root,d__Bacteria,p__Firmicutes,,,,,
+"""
+
+    def assertTreeEqual(self, expected, tree):
+        self.assertEqual(expected.names, tree.names)
+        self.assertEqual(expected.parents.tolist(), tree.parents.tolist())
+        self.assertEqual(expected.depths.tolist(), tree.depths.tolist())
+
+    def test_parse(self):
+        tree = TaxonomyTree.parse_taxtastic_taxonomy(StringIO(self.taxonomy))
+        self.assertEqual(
+            ['Root', 'd__Bacteria', 'o__Actinomycetales', 'p__Actinobacteria',
+             'c__Actinobacteria', 'o__Coriobacteriales', 'p__Firmicutes'],
+            tree.names)
+        self.assertEqual([-1, 0, 4, 1, 3, 4, 1], tree.parents.tolist())
+        self.assertEqual([0, 1, 4, 2, 3, 4, 2], tree.depths.tolist())
+        self.assertEqual((0, 1, 3, 4, 2), tree.ancestor_ids(tree.node_id('o__Actinomycetales')))
+        self.assertEqual((0,), tree.ancestor_ids(tree.node_id('Root')))
+        self.assertEqual((0, 1, 6), tree.ancestor_ids(tree.node_id('p__Firmicutes')))
+
+    def test_lca_id(self):
+        tree = TaxonomyTree.parse_taxtastic_taxonomy(StringIO(self.taxonomy))
+        def lca(name1, name2):
+            return tree.names[tree.lca_id(tree.node_id(name1), tree.node_id(name2))]
+        self.assertEqual('c__Actinobacteria', lca('o__Actinomycetales', 'o__Coriobacteriales'))
+        self.assertEqual('d__Bacteria', lca('o__Actinomycetales', 'p__Firmicutes'))
+        self.assertEqual('p__Actinobacteria', lca('p__Actinobacteria', 'o__Coriobacteriales'))
+        self.assertEqual('p__Firmicutes', lca('p__Firmicutes', 'p__Firmicutes'))
+        self.assertEqual('Root', lca('Root', 'o__Actinomycetales'))
+
+    def test_write_read(self):
+        tree = TaxonomyTree.parse_taxtastic_taxonomy(StringIO(self.taxonomy))
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'tree.npz')
+            tree.write(path)
+            self.assertTreeEqual(tree, TaxonomyTree.read(path))
+
+    def test_acquire_cached(self):
+        singlem_package = SingleMPackage.acquire(
+            os.path.join(path_to_data, '4.11.22seqs.gpkg.spkg'))
+        with open(singlem_package.graftm_package().taxtastic_taxonomy_path()) as f:
+            expected = TaxonomyTree.parse_taxtastic_taxonomy(f)
+        with tempfile.TemporaryDirectory() as d:
+            tree = TaxonomyTree.acquire(singlem_package, cache_directory=d)
+            self.assertTreeEqual(expected, tree)
+            self.assertEqual(
+                ['%s.npz' % singlem_package.singlem_package_sha256()], os.listdir(d))
+            self.assertTreeEqual(expected, TaxonomyTree.acquire(singlem_package, cache_directory=d))
+
+if __name__ == "__main__":
+    unittest.main()
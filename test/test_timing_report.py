@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import unittest
+import os.path
+import sys
+import json
+import tempdir
+import extern
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from singlem.timing_report import TimingReport
+
+class Tests(unittest.TestCase):
+    def test_stages_and_commands(self):
+        with tempdir.TempDir() as d:
+            report = TimingReport(d)
+            with report.stage('search', 'batch0'):
+                self.assertEqual('hello\n', report.run('echo hello'))
+                with open(os.path.join(d, 'hits.fa'), 'w') as f:
+                    f.write('>a\nACGT\n')
+            self.assertEqual('', report.run('true'))
+
+            report_path = os.path.join(d, 'report.json')
+            report.write(report_path)
+            with open(report_path) as f:
+                result = json.load(f)
+            self.assertEqual(1, len(result['stages']))
+            stage = result['stages'][0]
+            self.assertEqual('search', stage['stage'])
+            self.assertEqual('batch0', stage['batch'])
+            self.assertEqual(8, stage['working_directory_bytes'])
+            self.assertEqual(8, stage['working_directory_bytes_added'])
+            self.assertTrue(stage['wall_seconds'] >= 0)
+            self.assertEqual(
+                [('search', 'echo hello'), (None, 'true')],
+                [(c['stage'], c['command']) for c in result['commands']])
+            self.assertEqual(0, result['commands'][0]['exit_status'])
+
+    def test_failed_command(self):
+        report = TimingReport()
+        with self.assertRaises(extern.ExternCalledProcessError):
+            report.run('echo fail >&2; exit 2')
+        self.assertEqual(2, report.report()['commands'][0]['exit_status'])
+
+if __name__ == "__main__":
+    unittest.main()